@@ -0,0 +1,107 @@
+"""Compare Activity/Leaderboard model instances with compact rows
+
+Run from the backend directory:
+
+    python benchmarks/bench_rows.py [--rows 10000]
+
+For each representation it reports retained memory per row, and for the
+list-endpoint serialization step the time, peak memory and number of
+allocated blocks. No database is needed: documents are synthetic and
+model instances are built the way the ORM builds them from query results.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'octofit_tracker.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from octofit_tracker.models import Activity, Leaderboard  # noqa: E402
+from octofit_tracker.rows import (  # noqa: E402
+    ActivityRow, LeaderboardRow, _make_activity, _make_leaderboard, document_fields, serialize_rows,
+)
+from octofit_tracker.serializers import ActivitySerializer, LeaderboardSerializer  # noqa: E402
+
+
+def activity_docs(n, rng):
+    start = datetime(2024, 1, 1)
+    return [{
+        '_id': f'{i:024x}', 'user_id': str(rng.randint(1, 1000)), 'activity_type': 'running',
+        'duration': rng.randint(10, 180), 'distance': rng.uniform(0, 40),
+        'calories': rng.randint(50, 1500), 'date': start + timedelta(minutes=i), 'notes': '',
+    } for i in range(n)]
+
+
+def leaderboard_docs(n, rng):
+    return [{
+        '_id': f'{i:024x}', 'user_id': str(i), 'team_id': str(i % 10), 'total_activities': rng.randint(1, 500),
+        'total_duration': rng.randint(10, 50000), 'total_distance': rng.uniform(0, 5000),
+        'total_calories': rng.randint(100, 500000), 'rank': i + 1, 'last_updated': datetime(2024, 1, 1),
+    } for i in range(n)]
+
+
+def model_factory(model, fields):
+    def make(doc):
+        return model.from_db('default', fields, [doc[field] for field in fields])
+    return make
+
+
+def measure_build(make, docs):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    built = [make(doc) for doc in docs]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    retained = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return built, retained / len(docs)
+
+
+def measure_serialize(serialize, objects):
+    tracemalloc.start()
+    start = time.perf_counter()
+    serialize(objects)
+    elapsed = (time.perf_counter() - start) * 1000
+    snapshot = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    blocks = sum(stat.count for stat in snapshot.statistics('filename'))
+    return elapsed, peak, blocks
+
+
+def report(name, model, row_type, make_row, serializer_class, docs):
+    fields = list(document_fields(row_type))
+    instances, model_bytes = measure_build(model_factory(model, fields), docs)
+    rows, row_bytes = measure_build(make_row, docs)
+
+    model_ms, model_peak, model_blocks = measure_serialize(
+        lambda objs: serializer_class(objs, many=True).data, instances)
+    row_ms, row_peak, row_blocks = measure_serialize(serialize_rows, rows)
+
+    print(f'{name} ({len(docs)} rows)')
+    print(f'  {"":10} {"bytes/row":>10} {"serialize ms":>13} {"peak KiB":>10} {"live blocks":>12}')
+    print(f'  {"model":10} {model_bytes:>10.0f} {model_ms:>13.1f} {model_peak / 1024:>10.0f} {model_blocks:>12}')
+    print(f'  {"row":10} {row_bytes:>10.0f} {row_ms:>13.1f} {row_peak / 1024:>10.0f} {row_blocks:>12}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10000)
+    args = parser.parse_args()
+    rng = random.Random(7)
+
+    report('Activity', Activity, ActivityRow, _make_activity, ActivitySerializer,
+           activity_docs(args.rows, rng))
+    report('Leaderboard', Leaderboard, LeaderboardRow, _make_leaderboard, LeaderboardSerializer,
+           leaderboard_docs(args.rows, rng))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Benchmark compute_trends on synthetic activity histories
+
+Run from the backend directory:
+
+    python benchmarks/bench_trends.py [--sizes 10000 100000]
+
+Times the vectorized computation (column building excluded and reported
+separately) against a plain Python loop computing the same daily totals,
+moving average and longest streak.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from octofit_tracker.analytics import ActivityColumns, compute_trends  # noqa: E402
+
+ACTIVITY_TYPES = ['running', 'cycling', 'swimming', 'weightlifting', 'combat training', 'flight training']
+
+
+def synthetic_activities(n, years=5, seed=42):
+    rng = random.Random(seed)
+    end = datetime(2026, 10, 19)
+    return [{
+        'date': end - timedelta(days=rng.randint(0, 365 * years), minutes=rng.randint(0, 1440)),
+        'activity_type': rng.choice(ACTIVITY_TYPES),
+        'duration': rng.randint(10, 180),
+        'distance': round(rng.uniform(0, 40), 2),
+        'calories': rng.randint(50, 1500),
+    } for _ in range(n)]
+
+
+def python_loop_trends(docs, window=7):
+    daily = defaultdict(lambda: defaultdict(float))
+    for doc in docs:
+        daily[doc['activity_type']][doc['date'].date()] += doc['calories']
+    result = {}
+    for activity_type, totals in daily.items():
+        first, last = min(totals), max(totals)
+        days = [first + timedelta(days=i) for i in range((last - first).days + 1)]
+        series = [totals.get(day, 0.0) for day in days]
+        moving = [sum(series[max(0, i - window + 1):i + 1]) / window for i in range(len(series))]
+        longest = run = 0
+        for value in series:
+            run = run + 1 if value else 0
+            longest = max(longest, run)
+        result[activity_type] = (moving[-1], longest)
+    return result
+
+
+def timed(func, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 50000, 200000])
+    args = parser.parse_args()
+
+    print(f'{"activities":>10} {"columns ms":>11} {"numpy ms":>9} {"python ms":>10}')
+    for size in args.sizes:
+        docs = synthetic_activities(size)
+        columns_ms = timed(lambda: ActivityColumns.from_documents(docs), repeat=3)
+        columns = ActivityColumns.from_documents(docs)
+        numpy_ms = timed(lambda: compute_trends(columns, today=date(2026, 10, 19)))
+        python_ms = timed(lambda: python_loop_trends(docs), repeat=3)
+        print(f'{size:>10} {columns_ms:>11.1f} {numpy_ms:>9.1f} {python_ms:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError
+
+ARCHIVE_COLLECTION = 'activities_archive'
+# GPS tracks, one document per activity under the activity's _id
+TRACK_COLLECTION = 'activity_tracks'
+DUPLICATE_KEY_ERROR = 11000
+
+USER_DATE_INDEX = [('user_id', ASCENDING), ('date', DESCENDING)]
+# A retried POST carries the same natural key, so it cannot be stored twice
+NATURAL_KEY_FIELDS = ['user_id', 'activity_type', 'date', 'duration']
+
+
+def ensure_activity_indexes(db):
+    """Compound (user_id, date) index used by per-user time-range queries"""
+    db.activities.create_index(USER_DATE_INDEX)
+    db.activities.create_index([(field, ASCENDING) for field in NATURAL_KEY_FIELDS],
+                               unique=True, name='activity_natural_key')
+    db.activities.create_index([('date', ASCENDING)])
+    # Admin changelist: keyset pages in (date, _id) order and the activity_type filter
+    db.activities.create_index([('date', DESCENDING), ('_id', DESCENDING)])
+    db.activities.create_index([('activity_type', ASCENDING), ('date', DESCENDING)])
+    db[ARCHIVE_COLLECTION].create_index(USER_DATE_INDEX)
+
+
+def totals_group(key):
+    """$group stage summing leaderboard totals per `key` ('$user_id', or None for one row)"""
+    return {'$group': {
+        '_id': key,
+        'total_activities': {'$sum': 1},
+        'total_duration': {'$sum': {'$ifNull': ['$duration', 0]}},
+        'total_distance': {'$sum': {'$ifNull': ['$distance', 0]}},
+        'total_calories': {'$sum': {'$ifNull': ['$calories', 0]}},
+    }}
+
+
+def natural_key_query(activity):
+    return {field: activity.get(field) for field in NATURAL_KEY_FIELDS}
+
+
+def activity_range_query(user_id, since=None, until=None, activity_type=None):
+    query = {'user_id': user_id}
+    if since or until:
+        query['date'] = {}
+        if since:
+            query['date']['$gte'] = since
+        if until:
+            query['date']['$lt'] = until
+    if activity_type:
+        query['activity_type'] = activity_type
+    return query
+
+
+def archive_chunk(db, before, batch_size):
+    """Move up to `batch_size` activities older than `before` into the archive
+
+    Copies first and deletes second, so an interrupted run at worst leaves a
+    document in both collections; the next run skips the duplicate insert and
+    finishes the delete. Returns the number of activities moved.
+    """
+    docs = list(db.activities.find({'date': {'$lt': before}})
+                .sort('date', ASCENDING).limit(batch_size))
+    if not docs:
+        return 0
+    try:
+        db[ARCHIVE_COLLECTION].insert_many(docs, ordered=False)
+    except BulkWriteError as exc:
+        if any(error.get('code') != DUPLICATE_KEY_ERROR for error in exc.details.get('writeErrors', [])):
+            raise
+    db.activities.delete_many({'_id': {'$in': [doc['_id'] for doc in docs]}})
+    return len(docs)
@@ -1,40 +1,98 @@
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
 from django.contrib import admin
+from django.db.models import Q
+
+from .changelist import EstimatedCountPaginator, KeysetChangeList, distinct_filter
 from .models import User, Team, Activity, Leaderboard, Workout
 
 
+class LargeCollectionAdmin(admin.ModelAdmin):
+    """Changelist settings for collections too large to count or scan per page load
+
+    With ADMIN_PERFORMANCE_MODE on, the changelist uses an estimated total,
+    pages by keyset over `keyset_ordering`, takes filter choices from cached
+    distinct() calls and searches `exact_search_fields` by equality so the
+    search is a point read on an index instead of a regex scan.
+    """
+    keyset_ordering = ()
+    exact_search_fields = ()
+    performance_list_filter = ()
+
+    @property
+    def show_full_result_count(self):
+        return not settings.ADMIN_PERFORMANCE_MODE
+
+    def get_ordering(self, request):
+        if settings.ADMIN_PERFORMANCE_MODE and self.keyset_ordering:
+            return list(self.keyset_ordering)
+        return super().get_ordering(request)
+
+    def get_paginator(self, request, queryset, per_page, orphans=0, allow_empty_first_page=True):
+        if settings.ADMIN_PERFORMANCE_MODE:
+            return EstimatedCountPaginator(queryset, per_page, orphans, allow_empty_first_page)
+        return super().get_paginator(request, queryset, per_page, orphans, allow_empty_first_page)
+
+    def get_changelist(self, request, **kwargs):
+        if settings.ADMIN_PERFORMANCE_MODE:
+            return KeysetChangeList
+        return super().get_changelist(request, **kwargs)
+
+    def get_list_filter(self, request):
+        if settings.ADMIN_PERFORMANCE_MODE:
+            return self.performance_list_filter
+        return super().get_list_filter(request)
+
+    def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip()
+        if not settings.ADMIN_PERFORMANCE_MODE or not search_term:
+            return super().get_search_results(request, queryset, search_term)
+        matches = reduce(or_, (Q(**{field: search_term}) for field in self.exact_search_fields))
+        return queryset.filter(matches), False
+
+
 @admin.register(User)
 class UserAdmin(admin.ModelAdmin):
     list_display = ['_id', 'username', 'email', 'created_at']
-    search_fields = ['username', 'email']
+    search_fields = ['^username', '=email']
     readonly_fields = ['_id', 'created_at']
 
 
 @admin.register(Team)
 class TeamAdmin(admin.ModelAdmin):
     list_display = ['_id', 'name', 'created_by', 'created_at']
-    search_fields = ['name']
+    search_fields = ['^name']
     readonly_fields = ['_id', 'created_at']
 
 
 @admin.register(Activity)
-class ActivityAdmin(admin.ModelAdmin):
+class ActivityAdmin(LargeCollectionAdmin):
     list_display = ['_id', 'user_id', 'activity_type', 'duration', 'distance', 'calories', 'date']
     list_filter = ['activity_type', 'date']
     search_fields = ['user_id', 'activity_type']
     readonly_fields = ['_id']
+    # (date, _id) and (activity_type, date) indexes from ensure_indexes back these
+    keyset_ordering = ('-date', '-_id')
+    exact_search_fields = ('user_id',)
+    performance_list_filter = [distinct_filter('activity_type'), 'date']
 
 
 @admin.register(Leaderboard)
-class LeaderboardAdmin(admin.ModelAdmin):
+class LeaderboardAdmin(LargeCollectionAdmin):
     list_display = ['_id', 'user_id', 'team_id', 'total_activities', 'total_duration', 'total_distance', 'total_calories', 'rank']
     list_filter = ['team_id']
     search_fields = ['user_id', 'team_id']
     readonly_fields = ['_id', 'last_updated']
+    keyset_ordering = ('-total_calories', '_id')
+    exact_search_fields = ('user_id', 'team_id')
+    performance_list_filter = [distinct_filter('team_id')]
 
 
 @admin.register(Workout)
 class WorkoutAdmin(admin.ModelAdmin):
     list_display = ['_id', 'name', 'category', 'difficulty_level', 'duration', 'created_at']
     list_filter = ['category', 'difficulty_level']
-    search_fields = ['name', 'category']
+    search_fields = ['^name', '=category']
     readonly_fields = ['_id', 'created_at']
@@ -0,0 +1,148 @@
+from datetime import date
+
+import numpy as np
+
+METRICS = ('duration', 'distance', 'calories')
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+ACTIVITY_PROJECTION = {'_id': 0, 'date': 1, 'activity_type': 1,
+                       'duration': 1, 'distance': 1, 'calories': 1}
+
+
+class ActivityColumns:
+    """Column arrays for a set of activities, one entry per activity"""
+
+    def __init__(self, days, type_codes, type_names, duration, distance, calories):
+        self.days = days              # datetime64[D]
+        self.type_codes = type_codes  # int64 index into type_names
+        self.type_names = type_names  # activity_type per code, in first-seen order
+        self.duration = duration      # float64
+        self.distance = distance      # float64
+        self.calories = calories      # float64
+
+    def __len__(self):
+        return len(self.days)
+
+    @classmethod
+    def from_documents(cls, docs):
+        codes = {}
+        dates, types, duration, distance, calories = [], [], [], [], []
+        for doc in docs:
+            dates.append(doc['date'].toordinal())
+            types.append(codes.setdefault((doc.get('activity_type') or 'unknown').lower(), len(codes)))
+            duration.append(doc.get('duration') or 0)
+            distance.append(doc.get('distance') or 0)
+            calories.append(doc.get('calories') or 0)
+        return cls(
+            (np.array(dates, dtype=np.int64) - EPOCH_ORDINAL).astype('datetime64[D]'),
+            np.array(types, dtype=np.int64),
+            list(codes),
+            np.array(duration, dtype=np.float64),
+            np.array(distance, dtype=np.float64),
+            np.array(calories, dtype=np.float64),
+        )
+
+
+def load_activity_columns(db, user_ids):
+    """Fetch the columns needed for trends with a single projected query"""
+    cursor = db.activities.find(
+        {'user_id': {'$in': list(user_ids)}, 'date': {'$ne': None}},
+        ACTIVITY_PROJECTION,
+        batch_size=10000,
+    )
+    return ActivityColumns.from_documents(cursor)
+
+
+def _run_lengths(active):
+    """Length of the run of active days ending at each day, per row"""
+    counts = np.cumsum(active, axis=1)
+    resets = np.maximum.accumulate(np.where(active, 0, counts), axis=1)
+    return counts - resets
+
+
+def _moving_average(daily, window):
+    padded = np.concatenate([np.zeros((daily.shape[0], window)), daily], axis=1)
+    sums = np.cumsum(padded, axis=1)
+    return (sums[:, window:] - sums[:, :-window]) / window
+
+
+def compute_trends(columns, metric='calories', window=7, weeks=8, today=None):
+    """Moving averages, week-over-week deltas, streaks and personal bests
+
+    Every statistic is computed for all activity types at once on a
+    (types x days) matrix built with one bincount; the 'all' row sums them.
+    """
+    if metric not in METRICS:
+        raise ValueError(f'Unknown metric: {metric}')
+    today = np.datetime64(today or date.today(), 'D')
+    if not len(columns):
+        return {'metric': metric, 'window': window, 'types': {}}
+
+    start = columns.days.min()
+    # Align the first column to a Monday so weeks are calendar weeks (1970-01-01 was a Thursday)
+    start -= np.timedelta64((int(start.astype(np.int64)) + 3) % 7, 'D')
+    n_days = int((max(today, columns.days.max()) - start).astype(int)) + 1
+    day_index = (columns.days - start).astype(int)
+
+    type_codes = columns.type_codes
+    n_types = len(columns.type_names)
+    values = getattr(columns, metric)
+
+    flat = type_codes * n_days + day_index
+    daily = np.bincount(flat, weights=values, minlength=n_types * n_days).reshape(n_types, n_days)
+    counts = np.bincount(flat, minlength=n_types * n_days).reshape(n_types, n_days)
+    daily = np.vstack([daily, daily.sum(axis=0)])
+    counts = np.vstack([counts, counts.sum(axis=0)])
+
+    moving = _moving_average(daily, window)
+
+    n_weeks = -(-n_days // 7)
+    weekly = np.pad(daily, ((0, 0), (0, n_weeks * 7 - n_days))).reshape(daily.shape[0], n_weeks, 7).sum(axis=2)
+    weekly = weekly[:, -(weeks + 1):]
+    deltas = np.diff(weekly, axis=1)
+    previous = weekly[:, :-1]
+    pct = np.divide(deltas * 100, previous, out=np.full_like(deltas, np.nan), where=previous != 0)
+
+    runs = _run_lengths(counts > 0)
+    today_index = int((today - start).astype(int))
+    current = np.maximum(runs[:, today_index], runs[:, today_index - 1] if today_index else 0)
+
+    best_value = {}
+    best_day = {}
+    for field in METRICS:
+        field_values = getattr(columns, field)
+        best = np.full(n_types, -np.inf)
+        np.maximum.at(best, type_codes, field_values)
+        # Earliest day each type reached its best; activities arrive in no particular order
+        hits = np.nonzero(field_values == best[type_codes])[0]
+        earliest = np.full(n_types, n_days)
+        np.minimum.at(earliest, type_codes[hits], day_index[hits])
+        best_value[field] = best
+        best_day[field] = start + earliest.astype('timedelta64[D]')
+
+    shown = min(30, n_days)
+    window_start = start + np.timedelta64(n_days - shown, 'D')
+    first_week = start + np.timedelta64((n_weeks - weekly.shape[1]) * 7, 'D')
+    names = columns.type_names + ['all']
+    result = {'metric': metric, 'window': window, 'types': {}}
+    for row, name in enumerate(names):
+        stats = {
+            'moving_average': {
+                'start': str(window_start),
+                'values': np.round(moving[row, -shown:], 2).tolist(),
+            },
+            'weekly_totals': {
+                'start': str(first_week),
+                'values': np.round(weekly[row], 2).tolist(),
+            },
+            'week_over_week': np.round(deltas[row], 2).tolist(),
+            'week_over_week_pct': [None if np.isnan(v) else round(float(v), 1) for v in pct[row]],
+            'longest_streak': int(runs[row].max()),
+            'current_streak': int(current[row]),
+        }
+        if row < n_types:
+            stats['personal_bests'] = {
+                field: {'value': float(best_value[field][row]), 'date': str(best_day[field][row])}
+                for field in METRICS
+            }
+        result['types'][name] = stats
+    return result
@@ -0,0 +1,121 @@
+from django.utils import timezone
+
+from . import jobs
+from .activity_store import ARCHIVE_COLLECTION
+from .feed import remove_activity
+from .ingest import apply_once, record_activities, refresh_user_totals, retract_activities, wait_for_ingest
+from .search import index_document, remove_document
+from .sync import SEQ_FIELD, SYNCED_COLLECTIONS, TOMBSTONE_COLLECTION, record_deletion, stamp, tombstone_id
+
+WATCHED_COLLECTIONS = ('activities', 'teams', 'workouts', 'leaderboard')
+STATE_COLLECTION = 'change_stream_state'
+STREAM_NAME = 'watch_changes'
+CHANGE_STREAM_HISTORY_LOST = 286
+
+# Collections mirrored into the search index and the reference snapshot
+SEARCH_KINDS = {'teams': 'team', 'workouts': 'workout'}
+
+
+def watch_pipeline():
+    return [{'$match': {'ns.coll': {'$in': list(WATCHED_COLLECTIONS)}}}]
+
+
+def load_resume_token(db):
+    state = db[STATE_COLLECTION].find_one({'_id': STREAM_NAME})
+    return state['token'] if state else None
+
+
+def save_resume_token(db, token):
+    db[STATE_COLLECTION].update_one(
+        {'_id': STREAM_NAME},
+        {'$set': {'token': token, 'updated_at': timezone.now()}},
+        upsert=True,
+    )
+
+
+def apply_activity_delete(db, activity_id):
+    """Correct derived data for a deleted activity, whose event carries only its _id
+
+    Moves into the archive change no totals. Deletes through the ORM (API,
+    admin) are tombstoned with the activity before it goes: the API retracts
+    its own totals and notes `source`, so that owner is only recomputed as a
+    check; any other tombstoned delete is retracted here, once. A delete with
+    no tombstone has no known owner: leaderboard totals and rank histograms
+    are rebuilt in the background.
+    """
+    if db[ARCHIVE_COLLECTION].find_one({'_id': activity_id}, {'_id': 1}) is not None:
+        return
+    tombstone = db[TOMBSTONE_COLLECTION].find_one({'_id': tombstone_id('activities', activity_id)})
+    if tombstone and tombstone.get('source'):
+        if tombstone.get('user_id'):
+            refresh_user_totals(db, tombstone['user_id'])
+        return
+    if tombstone and tombstone.get('activity'):
+        apply_once(db, 'delete', [tombstone['activity']], lambda activities: retract_activities(db, activities))
+        return
+    remove_activity(db, activity_id)
+    jobs.enqueue(db, 'rebuild_leaderboard_totals')
+    jobs.enqueue(db, 'rebuild_rank_histograms')
+
+
+def apply_activity_change(db, operation, doc, activity_id=None):
+    """Keep leaderboard totals right for activity writes that bypassed the API
+
+    Inserts without a `source` tag get their deltas applied, once per
+    activity. Updates and replacements recompute that user's totals, since
+    the previous values are not part of the event. Deletes go to
+    apply_activity_delete. Nothing is applied while a rebuild has ingestion
+    paused.
+    """
+    wait_for_ingest(db)
+    if operation == 'delete':
+        apply_activity_delete(db, activity_id)
+        return
+    if doc is None:
+        return
+    if operation == 'insert':
+        if 'source' not in doc:
+            apply_once(db, 'insert', [doc], lambda activities: record_activities(db, activities))
+    elif operation in ('update', 'replace'):
+        refresh_user_totals(db, doc['user_id'])
+
+
+def is_stamp(event):
+    """Whether an event is only a change sequence being set, which needs no handling"""
+    if event['operationType'] != 'update':
+        return False
+    description = event.get('updateDescription', {})
+    return set(description.get('updatedFields', {})) == {SEQ_FIELD} and not description.get('removedFields')
+
+
+def needs_change_seq(event):
+    """Whether a write came without a fresh change sequence, i.e. bypassed the API"""
+    operation = event['operationType']
+    if operation in ('insert', 'replace'):
+        return SEQ_FIELD not in (event.get('fullDocument') or {})
+    if operation == 'update':
+        return SEQ_FIELD not in event.get('updateDescription', {}).get('updatedFields', {})
+    return False
+
+
+def apply_change(db, event):
+    """Bring derived data up to date for one change event and return its collection"""
+    collection = event['ns']['coll']
+    operation = event['operationType']
+    doc = event.get('fullDocument')
+    if is_stamp(event):
+        return collection
+    if collection in SYNCED_COLLECTIONS:
+        if operation == 'delete':
+            record_deletion(db, collection, event['documentKey']['_id'])
+        elif needs_change_seq(event):
+            stamp(db, collection, [event['documentKey']['_id']])
+    if collection == 'activities':
+        apply_activity_change(db, operation, doc, event['documentKey']['_id'])
+    elif collection in SEARCH_KINDS:
+        kind = SEARCH_KINDS[collection]
+        if operation == 'delete':
+            remove_document(db, kind, event['documentKey']['_id'])
+        elif doc is not None:
+            index_document(db, kind, doc)
+    return collection
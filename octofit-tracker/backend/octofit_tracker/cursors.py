@@ -0,0 +1,16 @@
+import base64
+
+from bson import json_util
+
+
+def encode_cursor(values):
+    """Opaque, URL-safe page cursor for a list of keyset values"""
+    return base64.urlsafe_b64encode(json_util.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Values of a cursor, or None if it is malformed"""
+    try:
+        return json_util.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        return None
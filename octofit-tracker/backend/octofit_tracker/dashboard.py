@@ -0,0 +1,109 @@
+import hashlib
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .ids import id_filter, stringify_ids
+from .invalidation import generation
+from .mongo import get_db, get_read_db
+from .rows import fetch_activity_rows, fetch_leaderboard_rows, serialize_rows
+
+RECENT_ACTIVITIES = 20
+TOP_USERS = 10
+USER_FIELDS = {'password': 0}
+
+# Collections whose generation is part of the cache key: the shared sections
+# that change rarely. Activities and the leaderboard change on every write by
+# anyone, so keying on them would miss every time; the user, activities and
+# leaderboard sections are only as fresh as DASHBOARD_CACHE_SECONDS.
+DEPENDS_ON = ('teams', 'workouts')
+
+
+def user_section(user_id):
+    user = get_db().users.find_one({'_id': id_filter(user_id)}, USER_FIELDS)
+    return stringify_ids(user) if user else None
+
+
+def team_section(user_id):
+    team = get_db().teams.find_one({'members': str(user_id)})
+    if team is None:
+        return None
+    stringify_ids(team)
+    team.setdefault('members', [])
+    return team
+
+
+def activities_section(user_id):
+    return serialize_rows(fetch_activity_rows(get_db().activities, {'user_id': str(user_id)},
+                                              limit=RECENT_ACTIVITIES))
+
+
+def leaderboard_section(user_id):
+    return serialize_rows(fetch_leaderboard_rows(get_read_db('leaderboard').leaderboard, limit=TOP_USERS))
+
+
+def workouts_section(user_id):
+    workouts = []
+    for workout in get_read_db('workouts').workouts.find():
+        stringify_ids(workout)
+        workout.setdefault('exercises', [])
+        workouts.append(workout)
+    return workouts
+
+
+SECTIONS = {
+    'user': user_section,
+    'team': team_section,
+    'activities': activities_section,
+    'leaderboard': leaderboard_section,
+    'workouts': workouts_section,
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.DASHBOARD_WORKERS,
+                                           thread_name_prefix='dashboard')
+    return _executor
+
+
+def build_dashboard(user_id):
+    """Run every section concurrently on the shared client
+
+    Latency is that of the slowest section. A section that fails or misses
+    DASHBOARD_TIMEOUT is returned as null and named in `errors`, so one slow
+    query does not fail the whole page.
+    """
+    futures = {name: get_executor().submit(section, user_id) for name, section in SECTIONS.items()}
+    wait(futures.values(), timeout=settings.DASHBOARD_TIMEOUT)
+    payload = {'errors': {}}
+    for name, future in futures.items():
+        if not future.done():
+            future.cancel()
+            payload[name] = None
+            payload['errors'][name] = 'timed out'
+        elif future.exception() is not None:
+            payload[name] = None
+            payload['errors'][name] = str(future.exception())
+        else:
+            payload[name] = future.result()
+    return payload
+
+
+def cache_key(user_id):
+    """Per-user key that changes when a team or workout is written"""
+    generations = '.'.join(str(generation(name)) for name in DEPENDS_ON)
+    return f'dashboard:{user_id}:{generations}'
+
+
+def payload_etag(payload):
+    body = json.dumps(payload, sort_keys=True, cls=DjangoJSONEncoder, default=str)
+    return '"' + hashlib.sha1(body.encode()).hexdigest() + '"'
@@ -0,0 +1,206 @@
+from collections import defaultdict
+from datetime import timezone as dt_timezone
+
+from django.conf import settings
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from .rows import ActivityRow, _make_activity, document_fields
+
+FEED_COLLECTION = 'team_feeds'
+# Timeline entries carry the activity row without its free-text notes
+ENTRY_FIELDS = [field for field in document_fields(ActivityRow) if field != 'notes']
+FEED_SORT = [('date', DESCENDING), ('_id', DESCENDING)]
+# Timeline documents: `entries`, `version` (bumped by every write, so a rebuild
+# can tell it raced one) and `complete` (the entries are all the team has, so
+# pages past them are empty rather than read from activities)
+
+
+def ensure_feed_indexes(db):
+    """members finds an author's teams when fanning out, entries._id the timelines holding an activity"""
+    db.teams.create_index([('members', ASCENDING)])
+    db[FEED_COLLECTION].create_index([('entries._id', ASCENDING)])
+
+
+def feed_entry(activity):
+    return {field: activity.get(field) for field in ENTRY_FIELDS}
+
+
+def instance_activity(instance):
+    """Timeline fields of an Activity model instance"""
+    return {field: getattr(instance, field, None) for field in ENTRY_FIELDS}
+
+
+def entry_key(entry):
+    return entry['date'], entry['_id']
+
+
+def cursor_key(values):
+    """(date, _id) from decoded cursor values, with the date naive UTC like pymongo's"""
+    if not isinstance(values, list) or len(values) != 2:
+        return None
+    when, activity_id = values
+    if getattr(when, 'tzinfo', None) is not None:
+        when = when.astimezone(dt_timezone.utc).replace(tzinfo=None)
+    return when, activity_id
+
+
+def fan_out(db, activities):
+    """Push new activities onto the capped timelines of their authors' teams
+
+    Teams above TEAM_FEED_MAX_MEMBERS are skipped: every member's write would
+    contend on one document, so their feed is read from activities instead.
+    A timeline that fills up may have had entries sliced off, so it is no
+    longer complete.
+    """
+    by_user = defaultdict(list)
+    for activity in activities:
+        by_user[str(activity['user_id'])].append(feed_entry(activity))
+    if not by_user:
+        return
+    authors = list(by_user)
+    teams = db.teams.aggregate([
+        {'$match': {'members': {'$in': authors}}},
+        {'$project': {
+            'size': {'$size': {'$ifNull': ['$members', []]}},
+            'authors': {'$setIntersection': ['$members', authors]},
+        }},
+    ])
+    updates = []
+    for team in teams:
+        if team['size'] > settings.TEAM_FEED_MAX_MEMBERS:
+            continue
+        entries = [entry for user_id in team['authors'] for entry in by_user[user_id]]
+        updates.append(UpdateOne(
+            {'_id': str(team['_id'])},
+            {
+                '$push': {'entries': {
+                    '$each': entries,
+                    '$sort': dict(FEED_SORT),
+                    '$slice': settings.TEAM_FEED_SIZE,
+                }},
+                '$inc': {'version': 1},
+            },
+            upsert=True,
+        ))
+    if updates:
+        feeds = db[FEED_COLLECTION]
+        feeds.bulk_write(updates, ordered=False)
+        feeds.update_many(
+            {'_id': {'$in': [update._filter['_id'] for update in updates]},
+             f'entries.{settings.TEAM_FEED_SIZE - 1}': {'$exists': True}, 'complete': True},
+            {'$set': {'complete': False}},
+        )
+
+
+def remove_activity(db, activity_id):
+    """Drop a deleted activity from every timeline holding it"""
+    db[FEED_COLLECTION].update_many({'entries._id': activity_id},
+                                    {'$pull': {'entries': {'_id': activity_id}}, '$inc': {'version': 1}})
+
+
+def replace_activity(db, activity):
+    """Swap an edited activity's timeline entries for its current values
+
+    Pulling from every timeline first also covers an activity moved to
+    another user, whose teams then get it through the fan-out.
+    """
+    remove_activity(db, activity['_id'])
+    fan_out(db, [activity])
+
+
+def member_added(db, team):
+    """Rebuild a team's timeline so it includes a new member's recent activities"""
+    if len(team.get('members', [])) > settings.TEAM_FEED_MAX_MEMBERS:
+        # Read on demand from now on; a stored timeline would only go stale
+        db[FEED_COLLECTION].delete_one({'_id': str(team['_id'])})
+    else:
+        rebuild_timeline(db, team)
+
+
+def member_removed(db, team_id, user_id):
+    db[FEED_COLLECTION].update_one({'_id': str(team_id)},
+                                   {'$pull': {'entries': {'user_id': str(user_id)}}, '$inc': {'version': 1}})
+
+
+def read_entries(db, members, after, limit):
+    """Fan-out-on-read: members' activities older than `after`, newest first"""
+    if not members or limit < 1:
+        return []
+    query = {'user_id': {'$in': members}}
+    if after is not None:
+        when, activity_id = after
+        query['$or'] = [{'date': {'$lt': when}}, {'date': when, '_id': {'$lt': activity_id}}]
+    projection = dict.fromkeys(ENTRY_FIELDS, 1)
+    return list(db.activities.find(query, projection).sort(FEED_SORT).limit(limit))
+
+
+def timeline_entries(timeline, members, after, limit):
+    """Entries of a stored timeline older than `after`, by current members only"""
+    members = set(members)
+    entries = []
+    previous = None
+    for entry in timeline.get('entries', []):
+        key = entry_key(entry)
+        if key == previous or entry['user_id'] not in members:
+            continue  # an activity fanned out twice, or a member who left
+        previous = key
+        if after is None or key < after:
+            entries.append(entry)
+            if len(entries) >= limit:
+                break
+    return entries
+
+
+def team_feed(db, team, after, limit):
+    """One page of a team's feed and the key to continue from (None on the last page)
+
+    The team's timeline document serves the newest TEAM_FEED_SIZE entries in
+    one _id fetch. Pages past its end, teams without a timeline and teams too
+    large to fan out to are read from activities on the (user_id, date) index,
+    unless the timeline is complete and so already holds everything.
+    """
+    members = [str(member) for member in team.get('members', [])]
+    entries = []
+    complete = False
+    if len(members) <= settings.TEAM_FEED_MAX_MEMBERS:
+        timeline = db[FEED_COLLECTION].find_one({'_id': str(team['_id'])})
+        if timeline is not None:
+            entries = timeline_entries(timeline, members, after, limit + 1)
+            # A full timeline may be mid-way through losing its complete flag
+            complete = timeline.get('complete') and len(timeline.get('entries', [])) < settings.TEAM_FEED_SIZE
+    if len(entries) <= limit and not complete:
+        start = entry_key(entries[-1]) if entries else after
+        entries += read_entries(db, members, start, limit + 1 - len(entries))
+    page = entries[:limit]
+    next_key = entry_key(page[-1]) if len(entries) > limit else None
+    return [_make_activity(entry) for entry in page], next_key
+
+
+def rebuild_timeline(db, team):
+    """Rewrite a team's timeline from activities, e.g. for teams that predate the feed
+
+    The rewrite only lands if the timeline's version is the one read before
+    the activities were, so an entry fanned out or pulled meanwhile is not
+    overwritten; on a conflict the timeline is read again.
+    """
+    members = [str(member) for member in team.get('members', [])]
+    team_id = str(team['_id'])
+    feeds = db[FEED_COLLECTION]
+    while True:
+        current = feeds.find_one({'_id': team_id}, {'version': 1})
+        entries = read_entries(db, members, None, settings.TEAM_FEED_SIZE)
+        version = current.get('version') if current else None
+        timeline = {
+            'entries': entries,
+            'version': (version or 0) + 1,
+            'complete': len(entries) < settings.TEAM_FEED_SIZE,
+        }
+        if current is None:
+            try:
+                feeds.insert_one(dict(timeline, _id=team_id))
+                return
+            except DuplicateKeyError:
+                continue  # a fan-out created it first
+        if feeds.replace_one({'_id': team_id, 'version': version}, timeline).matched_count:
+            return
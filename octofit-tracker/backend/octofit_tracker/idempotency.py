@@ -0,0 +1,45 @@
+import hashlib
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from pymongo.errors import DuplicateKeyError
+
+from .throttling import request_client
+
+IDEMPOTENCY_COLLECTION = 'idempotency_keys'
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+
+
+def ensure_idempotency_indexes(db, ttl_seconds):
+    """Stored responses expire on their own; lookups hit the _id index"""
+    db[IDEMPOTENCY_COLLECTION].create_index('created_at', expireAfterSeconds=ttl_seconds)
+
+
+def request_fingerprint(data):
+    payload = json.dumps(data, sort_keys=True, cls=DjangoJSONEncoder, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def scoped_key(request, key):
+    """A client's key for one endpoint; clients picking the same key never see each other's responses"""
+    return f'{request_client(request)}:{request.path}:{key}'
+
+
+def lookup_response(db, key):
+    """Return the stored {'status', 'body', 'fingerprint'} for a key, or None"""
+    return db[IDEMPOTENCY_COLLECTION].find_one({'_id': key})
+
+
+def store_response(db, key, fingerprint, status_code, body):
+    """Remember the response for a key; the first stored response wins"""
+    try:
+        db[IDEMPOTENCY_COLLECTION].insert_one({
+            '_id': key,
+            'fingerprint': fingerprint,
+            'status': status_code,
+            'body': json.loads(json.dumps(body, cls=DjangoJSONEncoder, default=str)),
+            'created_at': timezone.now(),
+        })
+    except DuplicateKeyError:
+        pass
@@ -0,0 +1,69 @@
+from bson import ObjectId
+from django.conf import settings
+from django.http import Http404
+
+
+def id_candidates(value):
+    """Every stored form an API id may have
+
+    New documents use native ObjectIds. Until `manage.py migrate_ids` has run,
+    older documents may still carry integer ids (populate_db) or 24-char string
+    ids (the former CharField primary keys), so those forms are included while
+    LEGACY_ID_LOOKUPS is on.
+    """
+    if isinstance(value, ObjectId):
+        return [value]
+    value = str(value)
+    candidates = []
+    if ObjectId.is_valid(value):
+        candidates.append(ObjectId(value))
+    if settings.LEGACY_ID_LOOKUPS:
+        if value.isdigit():
+            candidates.append(int(value))
+        candidates.append(value)
+    return candidates
+
+
+def id_filter(value):
+    """Filter value for `_id` lookups: a point read on the _id index
+
+    Raises Http404 when the value cannot be an id at all.
+    """
+    candidates = id_candidates(value)
+    if not candidates:
+        raise Http404('Invalid id')
+    if len(candidates) == 1:
+        return candidates[0]
+    return {'$in': candidates}
+
+
+def ids_filter(values):
+    """Filter value for `_id` lookups over several ids"""
+    return {'$in': [candidate for value in values for candidate in id_candidates(value)]}
+
+
+def stringify_ids(doc):
+    """Make a raw document JSON-safe and add the `id` alias the frontend reads"""
+    if '_id' in doc:
+        doc['_id'] = str(doc['_id'])
+        doc['id'] = doc['_id']
+    return doc
+
+
+def fetch_by_ids(collection, values, projection=None):
+    """Documents for several ids with one `$in` query, in the order requested
+
+    The result has one entry per requested id, None where nothing matched.
+    """
+    values = [str(value) for value in values]
+    query = ids_filter(values)
+    found = {}
+    if query['$in']:
+        for doc in collection.find({'_id': query}, projection):
+            found[doc['_id']] = doc
+    results = []
+    for value in values:
+        doc = next((found[candidate] for candidate in id_candidates(value) if candidate in found), None)
+        # Repeated ids get their own copy, since callers rewrite documents in place
+        results.append(dict(doc) if doc is not None else None)
+    return results
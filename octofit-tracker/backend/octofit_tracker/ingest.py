@@ -0,0 +1,312 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import timedelta
+
+from bson import ObjectId
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from .activity_store import ARCHIVE_COLLECTION, totals_group
+from .feed import fan_out, remove_activity
+from .invalidation import publish
+from .ranking import record_period_totals, write_period_totals
+from .sync import SEQ_FIELD, reserve_seqs
+
+DUPLICATE_KEY_ERROR = 11000
+# Activities whose leaderboard deltas were applied by the writer carry a `source`
+# field; `manage.py watch_changes` applies deltas only for untagged inserts.
+API_SOURCE = 'api'
+# Holders of an ingestion pause, e.g. a rebuild that must not race the write path
+PAUSE_COLLECTION = 'ingest_pauses'
+# One marker per activity whose insert or delete deltas were applied, so a
+# retry after a crash applies only what is missing; kept longer than any
+# change stream resume token or journal retry stays around
+APPLIED_COLLECTION = 'applied_changes'
+APPLIED_TTL = 7 * 24 * 60 * 60
+
+
+class ActivityJournal:
+    """Durable local queue of validated activities waiting to be flushed to MongoDB"""
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=FULL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS journal ('
+                ' seq INTEGER PRIMARY KEY AUTOINCREMENT,'
+                ' activity_id TEXT NOT NULL UNIQUE,'
+                ' payload TEXT NOT NULL,'
+                ' enqueued_at REAL NOT NULL)'
+            )
+            conn.commit()
+            self._local.conn = conn
+        return conn
+
+    def append(self, activity):
+        """Journal an activity and return the id it will be stored under"""
+        doc = dict(activity)
+        doc['_id'] = str(doc.get('_id') or ObjectId())
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                'INSERT INTO journal (activity_id, payload, enqueued_at) VALUES (?, ?, ?)',
+                (doc['_id'], json.dumps(doc, cls=DjangoJSONEncoder), time.time()),
+            )
+        return doc['_id']
+
+    def peek(self, limit):
+        """Return up to `limit` of the oldest journaled entries as (seq, activity) pairs"""
+        rows = self._connection().execute(
+            'SELECT seq, payload FROM journal ORDER BY seq LIMIT ?', (limit,)
+        ).fetchall()
+        return [(seq, _decode_activity(payload)) for seq, payload in rows]
+
+    def ack(self, seqs):
+        """Drop entries that have been written to MongoDB"""
+        if not seqs:
+            return
+        conn = self._connection()
+        with conn:
+            conn.executemany('DELETE FROM journal WHERE seq = ?', [(seq,) for seq in seqs])
+
+    def __len__(self):
+        return self._connection().execute('SELECT COUNT(*) FROM journal').fetchone()[0]
+
+
+def _decode_activity(payload):
+    doc = json.loads(payload)
+    doc['_id'] = ObjectId(doc['_id'])
+    if isinstance(doc.get('date'), str):
+        doc['date'] = parse_datetime(doc['date'])
+    return doc
+
+
+_journal = None
+
+
+def get_journal():
+    global _journal
+    if _journal is None:
+        _journal = ActivityJournal(settings.ACTIVITY_JOURNAL_PATH)
+    return _journal
+
+
+def pause_ingest(db, holder):
+    """Hold writes to derived activity data until `holder` calls resume_ingest
+
+    While any pause is held, flush_journal leaves queued activities in the
+    journal, and sync creates, API deletes and watch_changes wait in
+    wait_for_ingest. Returns once every process has seen the pause, i.e.
+    after the flag's cache time.
+    """
+    db[PAUSE_COLLECTION].update_one({'_id': holder}, {'$set': {'since': timezone.now()}}, upsert=True)
+    time.sleep(settings.INGEST_PAUSE_POLL)
+
+
+def resume_ingest(db, holder):
+    db[PAUSE_COLLECTION].delete_one({'_id': holder})
+
+
+@contextmanager
+def ingest_pause(db, holder):
+    """Hold ingestion for the duration of a block; keep the block short, sync writers wait on it"""
+    pause_ingest(db, holder)
+    try:
+        yield
+    finally:
+        resume_ingest(db, holder)
+
+
+_pause_cache = {'checked': None, 'paused': False}
+
+
+def ingest_paused(db):
+    """Whether a pause is held, read from MongoDB at most every INGEST_PAUSE_POLL seconds per process
+
+    Pauses older than INGEST_PAUSE_TIMEOUT belong to a holder that died and
+    are ignored.
+    """
+    now = time.monotonic()
+    checked = _pause_cache['checked']
+    if checked is None or now - checked >= settings.INGEST_PAUSE_POLL:
+        cutoff = timezone.now() - timedelta(seconds=settings.INGEST_PAUSE_TIMEOUT)
+        _pause_cache['paused'] = db[PAUSE_COLLECTION].find_one({'since': {'$gt': cutoff}}, {'_id': 1}) is not None
+        _pause_cache['checked'] = now
+    return _pause_cache['paused']
+
+
+def wait_for_ingest(db):
+    """Block while ingestion is paused; call before writing activities or their derived data"""
+    while ingest_paused(db):
+        time.sleep(settings.INGEST_PAUSE_POLL)
+
+
+def leaderboard_deltas(activities):
+    """Aggregate leaderboard increments per user for a batch of activities"""
+    deltas = defaultdict(lambda: {
+        'total_activities': 0,
+        'total_duration': 0,
+        'total_distance': 0.0,
+        'total_calories': 0,
+    })
+    for activity in activities:
+        delta = deltas[str(activity['user_id'])]
+        delta['total_activities'] += 1
+        delta['total_duration'] += activity.get('duration') or 0
+        delta['total_distance'] += activity.get('distance') or 0
+        delta['total_calories'] += activity.get('calories') or 0
+    return dict(deltas)
+
+
+def record_activities(db, activities):
+    """Apply the derived-data updates for activities that were just stored"""
+    deltas = leaderboard_deltas(activities)
+    if not deltas:
+        return
+    now = timezone.now()
+    db.leaderboard.bulk_write([
+        UpdateOne(
+            {'user_id': user_id},
+            {
+                '$inc': delta,
+                '$set': {'last_updated': now},
+                '$setOnInsert': {'_id': ObjectId()},
+            },
+            upsert=True,
+        )
+        for user_id, delta in deltas.items()
+    ], ordered=False)
+    record_period_totals(db, activities)
+    fan_out(db, activities)
+    publish('leaderboard')
+
+
+def retract_activities(db, activities):
+    """Undo record_activities for activities that were just deleted"""
+    deltas = leaderboard_deltas(activities)
+    if not deltas:
+        return
+    now = timezone.now()
+    db.leaderboard.bulk_write([
+        UpdateOne(
+            {'user_id': user_id},
+            {'$inc': {field: -value for field, value in delta.items()}, '$set': {'last_updated': now}},
+        )
+        for user_id, delta in deltas.items()
+    ], ordered=False)
+    record_period_totals(db, activities, sign=-1)
+    for activity in activities:
+        remove_activity(db, activity['_id'])
+    publish('leaderboard')
+
+
+def ensure_applied_indexes(db):
+    db[APPLIED_COLLECTION].create_index('applied_at', expireAfterSeconds=APPLIED_TTL)
+
+
+def refresh_user_totals(db, user_id):
+    """Recompute one user's leaderboard totals from their live and archived activities"""
+    totals = {'total_activities': 0, 'total_duration': 0, 'total_distance': 0.0, 'total_calories': 0}
+    pipeline = [
+        {'$match': {'user_id': user_id}},
+        totals_group(None),
+    ]
+    for collection in ('activities', ARCHIVE_COLLECTION):
+        for row in db[collection].aggregate(pipeline):
+            for field in totals:
+                totals[field] += row[field]
+    db.leaderboard.bulk_write([UpdateOne(
+        {'user_id': user_id},
+        {'$set': dict(totals, last_updated=timezone.now())},
+    )])
+
+
+def apply_once(db, kind, activities, apply):
+    """Call `apply` with the activities whose `kind` change ('insert', 'delete') is not applied yet
+
+    Each activity is marked by _id before it is applied and completed after.
+    A marker left incomplete means a crash came part way through, so instead
+    of applying those deltas again the owners' totals are recomputed.
+    """
+    keyed = {f'{kind}:{activity["_id"]}': activity for activity in activities}
+    if not keyed:
+        return
+    keys = list(keyed)
+    fresh = set(keys)
+    try:
+        db[APPLIED_COLLECTION].insert_many(
+            [{'_id': key, 'done': False, 'applied_at': timezone.now()} for key in keys], ordered=False)
+    except BulkWriteError as exc:
+        for error in exc.details.get('writeErrors', []):
+            if error.get('code') != DUPLICATE_KEY_ERROR:
+                raise
+            fresh.discard(keys[error['index']])
+    seen = [key for key in keys if key not in fresh]
+    interrupted = {
+        str(keyed[marker['_id']]['user_id'])
+        for marker in db[APPLIED_COLLECTION].find({'_id': {'$in': seen}, 'done': False}, {'_id': 1})
+    } if seen else set()
+    if fresh:
+        apply([keyed[key] for key in keys if key in fresh])
+    for user_id in interrupted:
+        refresh_user_totals(db, user_id)
+        write_period_totals(db, [user_id], ('activities', ARCHIVE_COLLECTION))
+    db[APPLIED_COLLECTION].update_many({'_id': {'$in': keys}}, {'$set': {'done': True}})
+
+
+def flush_journal(db, journal, batch_size):
+    """Move one batch from the journal into the activities collection
+
+    Returns the number of journal entries flushed, none while ingestion is
+    paused. Deltas are applied through apply_once for every entry that is in
+    MongoDB under its own _id, whether this call or an earlier one that
+    crashed before acking inserted it, so each is counted exactly once. If
+    some inserts fail for another reason than a duplicate key, the others
+    still get their deltas and the batch is left in the journal for a retry.
+    """
+    if ingest_paused(db):
+        return 0
+    entries = journal.peek(batch_size)
+    if not entries:
+        return 0
+
+    rejected = set()
+    failure = None
+    with reserve_seqs(db, len(entries)) as first_seq:
+        docs = [dict(doc, source=API_SOURCE, **{SEQ_FIELD: first_seq + offset})
+                for offset, (_, doc) in enumerate(entries)]
+        try:
+            db.activities.insert_many(docs, ordered=False)
+        except BulkWriteError as exc:
+            for error in exc.details.get('writeErrors', []):
+                rejected.add(error['index'])
+                if error.get('code') != DUPLICATE_KEY_ERROR:
+                    failure = exc
+
+    stored = [doc for index, doc in enumerate(docs) if index not in rejected]
+    if rejected:
+        # A rejected entry stored under its own _id came from an earlier
+        # attempt; a natural-key duplicate of another activity is not ours
+        candidates = [docs[index]['_id'] for index in rejected]
+        ours = {doc['_id'] for doc in db.activities.find({'_id': {'$in': candidates}}, {'_id': 1})}
+        stored += [docs[index] for index in sorted(rejected) if docs[index]['_id'] in ours]
+    apply_once(db, 'insert', stored, lambda activities: record_activities(db, activities))
+    if failure is not None:
+        raise failure
+    journal.ack([seq for seq, _ in entries])
+    return len(entries)
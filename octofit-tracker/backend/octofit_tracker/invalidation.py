@@ -0,0 +1,74 @@
+import fcntl
+import mmap
+import os
+import struct
+import threading
+
+from django.conf import settings
+
+# One little-endian uint64 generation per collection, at a fixed slot
+SLOTS = ('activities', 'teams', 'workouts', 'leaderboard', 'users', 'revocations')
+SLOT = struct.Struct('<Q')
+
+
+class GenerationCounters:
+    """Per-collection generation numbers shared by every process on the host
+
+    A writer bumps a collection's generation after changing it; readers compare
+    the generation with the one their cached data was built from. Reads are a
+    single aligned 8-byte load from a shared memory map, so checking on every
+    request is free.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.lock = threading.Lock()
+        self.buffer = None
+
+    def _map(self):
+        if self.buffer is None:
+            size = SLOT.size * len(SLOTS)
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if os.fstat(fd).st_size < size:
+                    os.ftruncate(fd, size)
+                self.buffer = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+        return self.buffer
+
+    def get(self, collection):
+        return SLOT.unpack_from(self._map(), SLOT.size * SLOTS.index(collection))[0]
+
+    def bump(self, collection):
+        """Advance a collection's generation and return the new value"""
+        offset = SLOT.size * SLOTS.index(collection)
+        buffer = self._map()
+        with self.lock, open(self.path, 'rb') as f:
+            # Other processes may bump too; serialize the read-modify-write
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                generation = SLOT.unpack_from(buffer, offset)[0] + 1
+                SLOT.pack_into(buffer, offset, generation)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return generation
+
+
+_counters = None
+
+
+def get_counters():
+    global _counters
+    if _counters is None:
+        _counters = GenerationCounters(settings.INVALIDATION_PATH)
+    return _counters
+
+
+def generation(collection):
+    return get_counters().get(collection)
+
+
+def publish(collection):
+    """Tell every process that cached data derived from `collection` is stale"""
+    return get_counters().bump(collection)
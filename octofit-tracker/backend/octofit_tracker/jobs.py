@@ -0,0 +1,357 @@
+import hashlib
+import json
+import os
+import socket
+from datetime import timedelta
+
+from bson import ObjectId
+from django.conf import settings
+from django.utils import timezone
+from pymongo import ASCENDING, DESCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from .activity_store import ARCHIVE_COLLECTION, archive_chunk, totals_group
+from .feed import rebuild_timeline
+from .ingest import ingest_pause
+from .rank_history import COLUMNS, parse_day, write_history_chunk
+from .ranking import RANK_METRICS, write_histograms, write_period_totals
+from .search import SEARCHABLE, index_batch
+from .sync import SEQ_FIELD, SYNCED_COLLECTIONS, stamp
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+DEFAULT_CHUNK_SIZE = 1000
+# Leaderboard rows per rank history checkpoint
+SNAPSHOT_CHUNK_SIZE = 20000
+LEASE_SECONDS = 300
+# Leaderboard totals of a user without any activities
+EMPTY_TOTALS = {'total_activities': 0, 'total_duration': 0, 'total_distance': 0.0, 'total_calories': 0}
+
+JOB_HANDLERS = {}
+
+
+def job(name):
+    """Register a job handler
+
+    A handler is a generator called as ``handler(db, params, checkpoint)``. It
+    processes one chunk per iteration and yields ``(checkpoint, processed)``
+    after each chunk; the runner persists both so an interrupted job resumes
+    from the last checkpoint. Handlers must be safe to re-run for a chunk.
+    """
+    def register(func):
+        JOB_HANDLERS[name] = func
+        return func
+    return register
+
+
+def ensure_job_indexes(db):
+    db.jobs.create_index('key', unique=True)
+    db.jobs.create_index([('status', ASCENDING), ('created_at', ASCENDING)])
+
+
+def job_key(name, params):
+    payload = json.dumps({'name': name, 'params': params}, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def enqueue(db, name, params=None):
+    """Queue a job unless an identical one is already pending or running
+
+    Returns the job document.
+    """
+    if name not in JOB_HANDLERS:
+        raise ValueError(f'Unknown job: {name}')
+    params = params or {}
+    key = job_key(name, params)
+    now = timezone.now()
+    existing = db.jobs.find_one({'key': key})
+    if existing and existing['status'] in (PENDING, RUNNING):
+        return existing
+    if existing:
+        # Finished jobs keep their key; re-queue them from scratch
+        return db.jobs.find_one_and_update(
+            {'_id': existing['_id'], 'status': {'$in': [DONE, FAILED]}},
+            {'$set': {'status': PENDING, 'checkpoint': None, 'processed': 0,
+                      'error': None, 'created_at': now, 'updated_at': now}},
+            return_document=ReturnDocument.AFTER,
+        ) or db.jobs.find_one({'key': key})
+    doc = {
+        '_id': ObjectId(),
+        'key': key,
+        'name': name,
+        'params': params,
+        'status': PENDING,
+        'checkpoint': None,
+        'processed': 0,
+        'error': None,
+        'locked_by': None,
+        'locked_until': None,
+        'created_at': now,
+        'updated_at': now,
+    }
+    try:
+        db.jobs.insert_one(doc)
+    except DuplicateKeyError:
+        return db.jobs.find_one({'key': key})
+    return doc
+
+
+def claim_next(db, worker_id):
+    """Lease the oldest runnable job, including running jobs whose lease expired"""
+    now = timezone.now()
+    return db.jobs.find_one_and_update(
+        {'$or': [
+            {'status': PENDING},
+            {'status': RUNNING, 'locked_until': {'$lt': now}},
+        ]},
+        {'$set': {'status': RUNNING, 'locked_by': worker_id,
+                  'locked_until': now + timedelta(seconds=LEASE_SECONDS),
+                  'updated_at': now}},
+        sort=[('created_at', ASCENDING)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def run_job(db, job_doc, worker_id, progress=None):
+    """Run a claimed job to completion, checkpointing after every chunk"""
+    handler = JOB_HANDLERS.get(job_doc['name'])
+    if handler is None:
+        db.jobs.update_one({'_id': job_doc['_id']},
+                           {'$set': {'status': FAILED, 'error': 'Unknown job'}})
+        return FAILED
+
+    processed = job_doc.get('processed') or 0
+    try:
+        for checkpoint, count in handler(db, job_doc.get('params') or {}, job_doc.get('checkpoint')):
+            processed += count
+            now = timezone.now()
+            result = db.jobs.update_one(
+                {'_id': job_doc['_id'], 'locked_by': worker_id},
+                {'$set': {'checkpoint': checkpoint, 'processed': processed, 'updated_at': now,
+                          'locked_until': now + timedelta(seconds=LEASE_SECONDS)}},
+            )
+            if result.matched_count == 0:
+                # Another worker took over after our lease expired
+                return RUNNING
+            if progress:
+                progress(job_doc, processed)
+    except Exception as exc:
+        db.jobs.update_one({'_id': job_doc['_id']},
+                           {'$set': {'status': FAILED, 'error': str(exc),
+                                     'updated_at': timezone.now()}})
+        return FAILED
+
+    db.jobs.update_one({'_id': job_doc['_id'], 'locked_by': worker_id},
+                       {'$set': {'status': DONE, 'locked_by': None, 'locked_until': None,
+                                 'updated_at': timezone.now()}})
+    return DONE
+
+
+def default_worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def _leaderboard_page(db, checkpoint, chunk_size, projection):
+    """Next leaderboard rows in rank order (total_calories desc, _id) after a keyset checkpoint"""
+    query = {}
+    if checkpoint['id'] is not None:
+        query = {'$or': [
+            {'total_calories': {'$lt': checkpoint['calories']}},
+            {'total_calories': checkpoint['calories'], '_id': {'$gt': checkpoint['id']}},
+        ]}
+    return list(db.leaderboard.find(query, projection)
+                .sort([('total_calories', DESCENDING), ('_id', ASCENDING)])
+                .limit(chunk_size))
+
+
+@job('recompute_ranks')
+def recompute_ranks(db, params, checkpoint):
+    """Assign leaderboard ranks by total_calories, walking the collection by keyset"""
+    chunk_size = params.get('chunk_size', DEFAULT_CHUNK_SIZE)
+    checkpoint = checkpoint or {'rank': 0, 'calories': None, 'id': None}
+    while True:
+        rows = _leaderboard_page(db, checkpoint, chunk_size, {'total_calories': 1})
+        if not rows:
+            return
+        rank = checkpoint['rank']
+        updates = []
+        for row in rows:
+            rank += 1
+            updates.append(UpdateOne({'_id': row['_id']}, {'$set': {'rank': rank}}))
+        db.leaderboard.bulk_write(updates, ordered=False)
+        checkpoint = {'rank': rank, 'calories': rows[-1].get('total_calories'), 'id': rows[-1]['_id']}
+        yield checkpoint, len(rows)
+
+
+@job('rebuild_leaderboard_totals')
+def rebuild_leaderboard_totals(db, params, checkpoint):
+    """Recompute every user's leaderboard totals from live and archived activities
+
+    Users are walked by user_id: a chunk is the range up to the chunk_size-th
+    next leaderboard row, and the last range is open-ended so users with
+    activities but no row yet are picked up. Each range is totalled over both
+    collections and written with ingestion paused, so no concurrent $inc is
+    overwritten; rows in the range with no activities left are zeroed.
+    """
+    chunk_size = params.get('chunk_size', DEFAULT_CHUNK_SIZE)
+    while True:
+        query = {'user_id': {'$gt': checkpoint}} if checkpoint is not None else {}
+        user_ids = [row['user_id'] for row in db.leaderboard.find(query, {'user_id': 1})
+                    .sort('user_id', ASCENDING).limit(chunk_size)]
+        last = user_ids[-1] if len(user_ids) == chunk_size else None
+        bounds = dict(query.get('user_id', {}))
+        if last is not None:
+            bounds['$lte'] = last
+        with ingest_pause(db, 'rebuild_leaderboard_totals'):
+            written = _write_leaderboard_totals(db, bounds, user_ids)
+        if last is None:
+            yield checkpoint, written
+            return
+        checkpoint = last
+        yield checkpoint, written
+
+
+def _write_leaderboard_totals(db, bounds, user_ids):
+    pipeline = [totals_group('$user_id')]
+    if bounds:
+        pipeline.insert(0, {'$match': {'user_id': bounds}})
+    totals = {}
+    for collection in ('activities', ARCHIVE_COLLECTION):
+        for row in db[collection].aggregate(pipeline, allowDiskUse=True):
+            user_totals = totals.setdefault(str(row.pop('_id')), {})
+            for field, value in row.items():
+                user_totals[field] = user_totals.get(field, 0) + value
+    # Stamped at write time, not job start, so exports that ran while earlier
+    # chunks were written still pick this one up
+    now = timezone.now()
+    updates = [
+        UpdateOne({'user_id': user_id},
+                  {'$set': dict(user_totals, last_updated=now), '$setOnInsert': {'_id': ObjectId()}},
+                  upsert=True)
+        for user_id, user_totals in totals.items()
+    ]
+    updates += [
+        UpdateOne({'user_id': user_id}, {'$set': dict(EMPTY_TOTALS, last_updated=now)})
+        for user_id in user_ids if str(user_id) not in totals
+    ]
+    if updates:
+        db.leaderboard.bulk_write(updates, ordered=False)
+    return len(updates)
+
+
+@job('archive_activities')
+def archive_activities(db, params, checkpoint):
+    """Move activities older than the archive horizon into the cold collection"""
+    chunk_size = params.get('chunk_size', DEFAULT_CHUNK_SIZE)
+    if checkpoint is None:
+        days = params.get('older_than_days', settings.ACTIVITY_ARCHIVE_AFTER_DAYS)
+        checkpoint = {'before': timezone.now() - timedelta(days=days)}
+    while True:
+        moved = archive_chunk(db, checkpoint['before'], chunk_size)
+        if not moved:
+            return
+        yield checkpoint, moved
+
+
+@job('rebuild_search_index')
+def rebuild_search_index(db, params, checkpoint):
+    """(Re)index users, teams and workouts for /api/search/"""
+    chunk_size = params.get('chunk_size', DEFAULT_CHUNK_SIZE)
+    kinds = list(SEARCHABLE)
+    checkpoint = checkpoint or {'kind': kinds[0], 'id': None}
+    for kind in kinds[kinds.index(checkpoint['kind']):]:
+        collection = db[SEARCHABLE[kind][0]]
+        last_id = checkpoint['id'] if kind == checkpoint['kind'] else None
+        while True:
+            query = {'_id': {'$gt': last_id}} if last_id is not None else {}
+            docs = list(collection.find(query).sort('_id', ASCENDING).limit(chunk_size))
+            if not docs:
+                break
+            last_id = docs[-1]['_id']
+            checkpoint = {'kind': kind, 'id': last_id}
+            yield checkpoint, index_batch(db, kind, docs)
+
+
+@job('backfill_change_seq')
+def backfill_change_seq(db, params, checkpoint):
+    """Stamp documents written before /api/sync/ existed so full syncs include them"""
+    chunk_size = params.get('chunk_size', DEFAULT_CHUNK_SIZE)
+    collections = list(SYNCED_COLLECTIONS)
+    for name in collections[collections.index(checkpoint or collections[0]):]:
+        while True:
+            ids = [doc['_id'] for doc in db[name].find({SEQ_FIELD: {'$exists': False}}, {'_id': 1}).limit(chunk_size)]
+            if not ids:
+                break
+            stamp(db, name, ids)
+            yield name, len(ids)
+
+
+@job('rebuild_team_feeds')
+def rebuild_team_feeds(db, params, checkpoint):
+    """Fill every fan-out team's timeline from activities, walking teams by _id"""
+    chunk_size = params.get('chunk_size', 100)
+    while True:
+        query = {'_id': {'$gt': checkpoint}} if checkpoint is not None else {}
+        teams = list(db.teams.find(query, {'members': 1}).sort('_id', ASCENDING).limit(chunk_size))
+        if not teams:
+            return
+        for team in teams:
+            if len(team.get('members', [])) <= settings.TEAM_FEED_MAX_MEMBERS:
+                rebuild_timeline(db, team)
+        checkpoint = teams[-1]['_id']
+        yield checkpoint, len(teams)
+
+
+@job('rebuild_rank_histograms')
+def rebuild_rank_histograms(db, params, checkpoint):
+    """Recompute per-user period totals and rank histograms from live and archived activities
+
+    Chunks of users, walked by user_id, get their totals set from a $group;
+    the histograms are then counted from those totals one metric at a time.
+    Ingestion is paused around each chunk and each metric, so no activity is
+    counted by both the job and the write path.
+    """
+    chunk_size = params.get('chunk_size', DEFAULT_CHUNK_SIZE)
+    checkpoint = checkpoint or {'phase': 'totals', 'user_id': None}
+    while checkpoint['phase'] == 'totals':
+        query = {'user_id': {'$gt': checkpoint['user_id']}} if checkpoint['user_id'] is not None else {}
+        user_ids = [row['user_id'] for row in db.leaderboard.find(query, {'user_id': 1})
+                    .sort('user_id', ASCENDING).limit(chunk_size)]
+        if not user_ids:
+            checkpoint = {'phase': 'histograms', 'metric': 0}
+            break
+        with ingest_pause(db, 'rebuild_rank_histograms'):
+            write_period_totals(db, user_ids, ('activities', ARCHIVE_COLLECTION))
+        checkpoint = {'phase': 'totals', 'user_id': user_ids[-1]}
+        yield checkpoint, len(user_ids)
+    metrics = list(RANK_METRICS)
+    for index in range(checkpoint['metric'], len(metrics)):
+        with ingest_pause(db, 'rebuild_rank_histograms'):
+            write_histograms(db, metrics[index])
+        yield {'phase': 'histograms', 'metric': index + 1}, 0
+
+
+@job('snapshot_leaderboard')
+def snapshot_leaderboard(db, params, checkpoint):
+    """Record every user's rank and totals for a day (params['day'], default today)
+
+    Schedule it daily, e.g. `manage.py run_worker --enqueue snapshot_leaderboard --once`
+    from cron. Ranks follow the same order as recompute_ranks.
+    """
+    chunk_size = params.get('chunk_size', SNAPSHOT_CHUNK_SIZE)
+    if checkpoint is None:
+        day = params.get('day') or timezone.now().date().isoformat()
+        checkpoint = {'day': day, 'rank': 0, 'calories': None, 'id': None}
+    day = parse_day(checkpoint['day'])
+    projection = dict.fromkeys(['user_id', 'total_calories', *COLUMNS], 1)
+    while True:
+        rows = _leaderboard_page(db, checkpoint, chunk_size, projection)
+        if not rows:
+            return
+        write_history_chunk(db, day, checkpoint['rank'] + 1, rows)
+        checkpoint = dict(checkpoint, rank=checkpoint['rank'] + len(rows),
+                          calories=rows[-1].get('total_calories'), id=rows[-1]['_id'])
+        yield checkpoint, len(rows)
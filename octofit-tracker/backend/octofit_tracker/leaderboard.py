@@ -0,0 +1,110 @@
+import heapq
+import os
+import tempfile
+import zlib
+
+from bson import ObjectId, json_util
+from django.utils import timezone
+from pymongo import ASCENDING, DESCENDING
+
+from .activity_store import ARCHIVE_COLLECTION, totals_group
+from .ids import fetch_by_ids
+from .mongo import get_db
+
+REBUILD_COLLECTION = 'leaderboard_rebuild'
+TOTAL_FIELDS = ('total_activities', 'total_duration', 'total_distance', 'total_calories')
+# Runs merged at once; more than this are first merged into longer runs so
+# the rebuild never holds more open files than the default descriptor limit
+MAX_OPEN_RUNS = 256
+
+
+def ensure_leaderboard_indexes(db, collection='leaderboard'):
+    """user_id for the per-activity $inc, (total_calories, _id) for ranked pages, team_id for filters"""
+    db[collection].create_index([('user_id', ASCENDING)])
+    db[collection].create_index([('total_calories', DESCENDING), ('_id', ASCENDING)])
+    db[collection].create_index([('team_id', ASCENDING)])
+
+
+def partition_of(user_id, partitions):
+    """Stable partition of a user id; crc32 so every process agrees, unlike hash()"""
+    return zlib.crc32(str(user_id).encode()) % partitions
+
+
+def rank_key(row):
+    """Leaderboard order: most calories first, ties by _id like recompute_ranks"""
+    return -(row.get('total_calories') or 0), str(row['_id'])
+
+
+def user_totals(db, user_ids):
+    """Leaderboard rows for a batch of users with one server-side $group per collection"""
+    totals = {user_id: dict.fromkeys(TOTAL_FIELDS, 0) for user_id in user_ids}
+    pipeline = [{'$match': {'user_id': {'$in': list(user_ids)}}}, totals_group('$user_id')]
+    for collection in ('activities', ARCHIVE_COLLECTION):
+        for row in db[collection].aggregate(pipeline):
+            for field in TOTAL_FIELDS:
+                totals[row['_id']][field] += row[field]
+
+    existing = {row['user_id']: row for row in db.leaderboard.find({'user_id': {'$in': list(user_ids)}})}
+    users = fetch_by_ids(db.users, user_ids, {'name': 1, 'team_id': 1})
+    now = timezone.now()
+    rows = []
+    for user_id, user in zip(user_ids, users):
+        # Keep the row's _id and any extra fields it carries
+        row = existing.get(user_id) or {'_id': ObjectId(), 'user_id': user_id}
+        if user is not None:
+            row.setdefault('user_name', user.get('name'))
+            row.setdefault('team_id', user.get('team_id'))
+        row.update(totals[user_id], last_updated=now)
+        rows.append(row)
+    return rows
+
+
+def write_run(rows, directory, prefix='run-'):
+    """Spill rows already in leaderboard order to a file, one JSON row per line"""
+    fd, path = tempfile.mkstemp(dir=directory, prefix=prefix, suffix='.run')
+    with os.fdopen(fd, 'w') as run:
+        for row in rows:
+            run.write(json_util.dumps(row) + '\n')
+    return path
+
+
+def read_run(path):
+    with open(path) as run:
+        for line in run:
+            yield json_util.loads(line)
+
+
+def merge_runs(paths, directory, fan_in=MAX_OPEN_RUNS):
+    """Yield the rows of every sorted run in leaderboard order
+
+    Only one row per run is held in memory. With more runs than `fan_in`,
+    groups of runs are merged into longer runs first.
+    """
+    paths = list(paths)
+    while len(paths) > fan_in:
+        merged = []
+        for start in range(0, len(paths), fan_in):
+            group = paths[start:start + fan_in]
+            merged.append(write_run(heapq.merge(*map(read_run, group), key=rank_key), directory, 'merged-'))
+            for path in group:
+                os.remove(path)
+        paths = merged
+    yield from heapq.merge(*map(read_run, paths), key=rank_key)
+
+
+def init_worker():
+    # Pool processes are spawned, so each sets up Django and opens its own client
+    import django
+    django.setup()
+
+
+def build_run(task):
+    """Pool task: total one batch of a partition's users and spill it as a sorted run"""
+    partition, user_ids, directory = task
+    rows = user_totals(get_db(), user_ids)
+    return write_run(sorted(rows, key=rank_key), directory, f'p{partition}-'), len(rows)
+
+
+def swap_in(db, collection=REBUILD_COLLECTION):
+    """Replace the leaderboard with the rebuilt collection in one rename"""
+    db[collection].rename('leaderboard', dropTarget=True)
@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from octofit_tracker.mongo import get_db
+from octofit_tracker.replica import build_snapshot
+
+
+class Command(BaseCommand):
+    help = 'Write the memory-mapped teams/workouts snapshot served by the list endpoints'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default=settings.REFERENCE_SNAPSHOT_PATH)
+
+    def handle(self, *args, **options):
+        sizes = build_snapshot(get_db(), options['path'])
+        self.stdout.write(self.style.SUCCESS(f'Wrote reference snapshot to {options["path"]}'))
+        for name, size in sizes.items():
+            self.stdout.write(f'  - {name}: {size} bytes')
@@ -0,0 +1,39 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from octofit_tracker.activity_store import ensure_activity_indexes
+from octofit_tracker.feed import ensure_feed_indexes
+from octofit_tracker.idempotency import ensure_idempotency_indexes
+from octofit_tracker.ingest import ensure_applied_indexes
+from octofit_tracker.jobs import ensure_job_indexes
+from octofit_tracker.leaderboard import ensure_leaderboard_indexes
+from octofit_tracker.mongo import get_db
+from octofit_tracker.search import ensure_search_indexes
+from octofit_tracker.sync import ensure_sync_indexes
+from octofit_tracker.tokens import ensure_token_indexes
+
+
+class Command(BaseCommand):
+    help = 'Create the MongoDB indexes the API and workers rely on'
+
+    def handle(self, *args, **kwargs):
+        db = get_db()
+        self.stdout.write('Creating activity indexes...')
+        ensure_activity_indexes(db)
+        self.stdout.write('Creating leaderboard indexes...')
+        ensure_leaderboard_indexes(db)
+        self.stdout.write('Creating team feed indexes...')
+        ensure_feed_indexes(db)
+        self.stdout.write('Creating job indexes...')
+        ensure_job_indexes(db)
+        self.stdout.write('Creating idempotency key indexes...')
+        ensure_idempotency_indexes(db, settings.IDEMPOTENCY_KEY_TTL)
+        self.stdout.write('Creating search indexes...')
+        ensure_search_indexes(db)
+        self.stdout.write('Creating sync indexes...')
+        ensure_sync_indexes(db)
+        self.stdout.write('Creating applied change indexes...')
+        ensure_applied_indexes(db)
+        self.stdout.write('Creating revoked token indexes...')
+        ensure_token_indexes(db)
+        self.stdout.write(self.style.SUCCESS('Indexes are up to date'))
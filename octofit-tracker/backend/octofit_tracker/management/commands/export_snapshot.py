@@ -0,0 +1,100 @@
+import os
+import uuid
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from octofit_tracker.mongo import get_db
+from octofit_tracker.snapshot import (
+    SNAPSHOT_COLLECTIONS, PartitionBuffer, arrow_schema, load_watermarks, partition_path,
+    save_watermarks, watermark_bound, watermark_query,
+)
+
+
+class Command(BaseCommand):
+    help = 'Export activities and leaderboard to partitioned Parquet/Arrow files since the last snapshot'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=settings.SNAPSHOT_DIR,
+                            help='Snapshot root directory')
+        parser.add_argument('--format', choices=['parquet', 'arrow'], default='parquet',
+                            help='parquet for compact files, arrow for memory-mappable IPC files')
+        parser.add_argument('--batch-size', type=int, default=50000,
+                            help='Rows buffered in memory before partition files are written')
+        parser.add_argument('--collection', action='append', choices=sorted(SNAPSHOT_COLLECTIONS),
+                            help='Only export these collections (default: all)')
+        parser.add_argument('--full', action='store_true',
+                            help='Ignore the stored watermarks and export everything')
+
+    def handle(self, *args, **options):
+        try:
+            import pyarrow as pa
+            import pyarrow.feather as feather
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise CommandError('export_snapshot requires pyarrow (pip install pyarrow)')
+
+        self.pa = pa
+        self.writer = (
+            (lambda table, path: pq.write_table(table, path, compression='zstd'))
+            if options['format'] == 'parquet'
+            else (lambda table, path: feather.write_feather(table, path, compression='uncompressed'))
+        )
+        self.extension = options['format']
+        self.output = options['output']
+        self.run_id = uuid.uuid4().hex[:12]
+        os.makedirs(self.output, exist_ok=True)
+
+        db = get_db()
+        watermarks = {} if options['full'] else load_watermarks(self.output)
+        team_of = self._team_lookup(db)
+
+        for collection in options['collection'] or SNAPSHOT_COLLECTIONS:
+            spec = SNAPSHOT_COLLECTIONS[collection]
+            since = watermarks.get(collection)
+            upto = watermark_bound(db, spec)
+            if upto is None:
+                self.stdout.write(f'Skipping {collection}: writes are still in flight')
+                continue
+            cursor = (db[collection].find(watermark_query(spec, since, upto), [*spec['columns'], spec['watermark']])
+                      .sort(spec['watermark'], 1)
+                      .batch_size(min(options['batch_size'], 10000)))
+
+            self.stdout.write(f'Exporting {collection} since {since!r}...')
+            buffer = PartitionBuffer(collection, spec, team_of)
+            pending = []
+            exported = 0
+            for doc in cursor:
+                if doc.get(spec['watermark']) is None:
+                    continue
+                buffer.add(doc)
+                watermarks[collection] = doc[spec['watermark']]
+                exported += 1
+                if buffer.size >= options['batch_size']:
+                    pending += self._write(collection, spec, buffer.drain())
+                    self.stdout.write(f'  - {exported} rows')
+            pending += self._write(collection, spec, buffer.drain())
+
+            # Publish the files before moving the watermark past them
+            for tmp_path in pending:
+                os.replace(tmp_path, tmp_path[:-len('.tmp')])
+            save_watermarks(self.output, watermarks)
+            self.stdout.write(self.style.SUCCESS(f'  - {collection}: {exported} rows in {len(pending)} files'))
+
+    def _team_lookup(self, db):
+        teams = {
+            str(row['user_id']): row.get('team_id')
+            for row in db.leaderboard.find({'team_id': {'$ne': None}}, {'user_id': 1, 'team_id': 1})
+        }
+        return lambda doc: teams.get(str(doc.get('user_id')))
+
+    def _write(self, collection, spec, partitions):
+        schema = arrow_schema(self.pa, spec)
+        written = []
+        for (month, team_id), rows in partitions.items():
+            directory = os.path.join(self.output, partition_path(collection, month, team_id))
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f'part-{self.run_id}-{len(os.listdir(directory)):05d}.{self.extension}.tmp')
+            self.writer(self.pa.Table.from_pylist(rows, schema=schema), path)
+            written.append(path)
+        return written
@@ -0,0 +1,37 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from octofit_tracker.ingest import flush_journal, get_journal
+from octofit_tracker.mongo import get_bulk_db
+
+
+class Command(BaseCommand):
+    help = 'Flush journaled activities to MongoDB in batches and apply leaderboard deltas'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.ACTIVITY_FLUSH_BATCH_SIZE)
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help='Seconds to sleep when the journal is empty')
+        parser.add_argument('--once', action='store_true',
+                            help='Drain the journal and exit instead of running forever')
+
+    def handle(self, *args, **options):
+        db = get_bulk_db()
+        journal = get_journal()
+        batch_size = options['batch_size']
+
+        self.stdout.write(self.style.SUCCESS(f'Flushing activity journal {journal.path}'))
+        try:
+            while True:
+                flushed = flush_journal(db, journal, batch_size)
+                if flushed:
+                    self.stdout.write(f'  - flushed {flushed} activities')
+                    continue
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(self.style.SUCCESS('Activity journal flushed'))
@@ -0,0 +1,75 @@
+import os
+import re
+import subprocess
+import sys
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# "import time:      1251 |      44451 |       numpy"
+IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+TARGETS = {
+    # Everything a management command pays for before handle() runs
+    'setup': 'import django, importlib; django.setup()',
+    # What a web worker imports before serving its first request
+    'urls': 'import django, importlib; django.setup(); importlib.import_module({urlconf!r})',
+}
+
+
+def parse_importtime(output):
+    """Parse `python -X importtime` stderr into (module, self_us, cumulative_us, depth) rows"""
+    rows = []
+    for line in output.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            rows.append((module, int(self_us), int(cumulative_us), len(indent) // 2))
+    return rows
+
+
+def package_totals(rows):
+    """Self time summed per top-level package, so e.g. all of numpy shows as one line"""
+    totals = defaultdict(int)
+    for module, self_us, _, _ in rows:
+        totals[module.split('.')[0]] += self_us
+    return sorted(totals.items(), key=lambda item: item[1], reverse=True)
+
+
+class Command(BaseCommand):
+    help = 'Report which modules dominate startup time, using python -X importtime'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', choices=sorted(TARGETS), default='urls',
+                            help='setup: django.setup() only; urls: also import the URLconf and views')
+        parser.add_argument('--module', action='append', default=[],
+                            help='Also import this module after the target (repeatable), '
+                                 'e.g. octofit_tracker.management.commands.populate_db')
+        parser.add_argument('--top', type=int, default=25)
+
+    def handle(self, *args, **options):
+        code = TARGETS[options['target']].format(urlconf=settings.ROOT_URLCONF)
+        for module in options['module']:
+            code += f'; importlib.import_module({module!r})'
+
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get(
+            'DJANGO_SETTINGS_MODULE', 'octofit_tracker.settings'))
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                                capture_output=True, text=True, env=env, cwd=settings.BASE_DIR)
+        if result.returncode:
+            raise CommandError(result.stderr.strip().splitlines()[-1])
+
+        rows = parse_importtime(result.stderr)
+        total_us = sum(self_us for _, self_us, _, _ in rows)
+        top = options['top']
+        self.stdout.write(f'{len(rows)} modules imported in {total_us / 1000:.1f} ms '
+                          f'(target: {options["target"]})\n')
+
+        self.stdout.write(f'Top {top} packages by self time:')
+        for package, self_us in package_totals(rows)[:top]:
+            self.stdout.write(f'  {self_us / 1000:>8.1f} ms  {package}')
+
+        self.stdout.write(f'\nTop {top} modules by cumulative time:')
+        for module, _, cumulative_us, depth in sorted(rows, key=lambda row: row[2], reverse=True)[:top]:
+            self.stdout.write(f'  {cumulative_us / 1000:>8.1f} ms  {module} (depth {depth})')
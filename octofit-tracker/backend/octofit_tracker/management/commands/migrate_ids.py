@@ -0,0 +1,117 @@
+from bson import ObjectId
+from django.core.management.base import BaseCommand
+from pymongo import UpdateMany, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from octofit_tracker.activity_store import ARCHIVE_COLLECTION
+from octofit_tracker.mongo import get_db
+
+MIGRATED_COLLECTIONS = ['users', 'teams', 'workouts', 'activities', ARCHIVE_COLLECTION, 'leaderboard']
+NOT_OBJECT_ID = {'_id': {'$not': {'$type': 'objectId'}}}
+
+# Scalar fields that hold another document's id, by the collection they point to
+REFERENCES = {
+    'users': [('activities', 'user_id'), (ARCHIVE_COLLECTION, 'user_id'),
+              ('leaderboard', 'user_id'), ('teams', 'created_by')],
+    'teams': [('users', 'team_id'), ('leaderboard', 'team_id')],
+}
+
+
+class Command(BaseCommand):
+    help = 'Convert integer and string _ids to native ObjectIds and rewrite references'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        db = get_db()
+        mapping = db.id_migrations
+        mapping.create_index([('collection', 1), ('old', 1)], unique=True)
+
+        for collection in MIGRATED_COLLECTIONS:
+            moved = self._migrate_collection(db, collection, options['batch_size'])
+            self.stdout.write(f'  - {collection}: {moved} documents moved to ObjectId')
+
+        for collection, references in REFERENCES.items():
+            for target, field in references:
+                updated = self._rewrite_references(db, collection, target, field, options['batch_size'])
+                self.stdout.write(f'  - {target}.{field}: {updated} references rewritten')
+        updated = self._rewrite_members(db)
+        self.stdout.write(f'  - teams.members: {updated} teams rewritten')
+
+        self.stdout.write(self.style.SUCCESS(
+            'ID migration complete. Run `manage.py run_worker --enqueue rebuild_search_index --once` '
+            'and set LEGACY_ID_LOOKUPS=false.'
+        ))
+
+    def _migrate_collection(self, db, collection, batch_size):
+        """Re-insert every document whose _id is not an ObjectId under a new ObjectId
+
+        Each document is copied into its id_migrations entry before it is
+        deleted and re-inserted, so the original is deleted first and unique
+        secondary indexes (users.email, the activities natural key) never see
+        two copies. An interrupted run finishes the moves it left half done
+        from those copies, with the same new ids.
+        """
+        for entry in db.id_migrations.find({'collection': collection, 'doc': {'$exists': True}}):
+            self._move(db, collection, entry)
+        moved = 0
+        while True:
+            docs = list(db[collection].find(NOT_OBJECT_ID).limit(batch_size))
+            if not docs:
+                return moved
+            for doc in docs:
+                old_id = doc['_id']
+                new_id = ObjectId(old_id) if isinstance(old_id, str) and ObjectId.is_valid(old_id) else ObjectId()
+                db.id_migrations.update_one(
+                    {'collection': collection, 'old': old_id},
+                    {'$setOnInsert': {'new': new_id}, '$set': {'doc': doc}},
+                    upsert=True,
+                )
+                self._move(db, collection, db.id_migrations.find_one({'collection': collection, 'old': old_id}))
+                moved += 1
+
+    def _move(self, db, collection, entry):
+        """Replace the document under its old _id with the copy kept in `entry`
+
+        A duplicate key is only "already moved" when the new _id exists;
+        anything else is a real conflict: the original is put back and the
+        error raised.
+        """
+        current = db[collection].find_one({'_id': entry['old']})
+        doc = current if current is not None else entry['doc']
+        db[collection].delete_one({'_id': entry['old']})
+        try:
+            db[collection].insert_one(dict(doc, _id=entry['new']))
+        except DuplicateKeyError:
+            if db[collection].find_one({'_id': entry['new']}, {'_id': 1}) is None:
+                db[collection].insert_one(doc)
+                raise
+        db.id_migrations.update_one({'_id': entry['_id']}, {'$unset': {'doc': ''}})
+
+    def _rewrite_references(self, db, collection, target, field, batch_size):
+        updated = 0
+        batch = []
+        for entry in db.id_migrations.find({'collection': collection}):
+            old_forms = [entry['old'], str(entry['old'])]
+            batch.append(UpdateMany({field: {'$in': old_forms}}, {'$set': {field: str(entry['new'])}}))
+            if len(batch) >= batch_size:
+                updated += db[target].bulk_write(batch, ordered=False).modified_count
+                batch = []
+        if batch:
+            updated += db[target].bulk_write(batch, ordered=False).modified_count
+        return updated
+
+    def _rewrite_members(self, db):
+        new_ids = {str(entry['old']): str(entry['new']) for entry in db.id_migrations.find({'collection': 'users'})}
+        if not new_ids:
+            return 0
+        updates = []
+        for team in db.teams.find({}, {'members': 1}):
+            members = team.get('members') or []
+            rewritten = [new_ids.get(str(member), member) for member in members]
+            if rewritten != members:
+                updates.append(UpdateOne({'_id': team['_id']}, {'$set': {'members': rewritten}}))
+        if updates:
+            db.teams.bulk_write(updates, ordered=False)
+        return len(updates)
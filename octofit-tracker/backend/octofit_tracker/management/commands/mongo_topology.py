@@ -0,0 +1,45 @@
+"""Show the MongoDB deployment and which members each endpoint group may read from
+
+To try read preferences locally, start a three-member replica set:
+
+    for port in 27017 27018 27019; do
+        mkdir -p /tmp/rs0-$port
+        mongod --replSet rs0 --port $port --dbpath /tmp/rs0-$port --fork --logpath /tmp/rs0-$port.log
+    done
+    mongosh --port 27017 --eval 'rs.initiate({_id: "rs0", members: [
+        {_id: 0, host: "localhost:27017"}, {_id: 1, host: "localhost:27018"},
+        {_id: 2, host: "localhost:27019"}]})'
+
+then run the server and this command with
+MONGO_URI='mongodb://localhost:27017,localhost:27018,localhost:27019/?replicaSet=rs0'.
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from pymongo.errors import PyMongoError
+
+from octofit_tracker.mongo import READ_PREFERENCES, get_client
+
+
+class Command(BaseCommand):
+    help = 'Show MongoDB members and the servers eligible for each endpoint read preference'
+
+    def handle(self, *args, **options):
+        client = get_client()
+        try:
+            client.admin.command('ping')  # waits for server discovery
+        except PyMongoError as exc:
+            raise CommandError(f'Cannot reach MongoDB: {exc}')
+
+        topology = client.topology_description
+        self.stdout.write(f'Topology: {topology.topology_type_name}')
+        for address, server in sorted(topology.server_descriptions().items()):
+            rtt = f'{server.round_trip_time * 1000:.1f} ms' if server.round_trip_time is not None else '-'
+            self.stdout.write(f'  {address[0]}:{address[1]}  {server.server_type_name}  rtt {rtt}')
+
+        self.stdout.write('\nEligible servers by endpoint group:')
+        groups = [('writes', 'primary')] + sorted(settings.MONGO_READ_PREFERENCES.items())
+        for endpoint, mode in groups:
+            servers = topology.apply_selector(READ_PREFERENCES[mode], None)
+            addresses = ', '.join(f'{s.address[0]}:{s.address[1]}' for s in servers) or 'none'
+            self.stdout.write(f'  {endpoint:12} {mode:20} {addresses}')
+        self.stdout.write(f'\nBulk ingestion write concern: {settings.MONGO_BULK_WRITE_CONCERN}')
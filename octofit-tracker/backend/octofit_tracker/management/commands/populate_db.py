@@ -1,5 +1,8 @@
+from bson import ObjectId
 from django.core.management.base import BaseCommand
-from pymongo import MongoClient
+from octofit_tracker.activity_store import ensure_activity_indexes
+from octofit_tracker.mongo import get_bulk_db
+from octofit_tracker.sync import record_deletions
 from datetime import datetime, timedelta
 import random
 
@@ -8,9 +11,8 @@ class Command(BaseCommand):
     help = 'Populate the octofit_db database with test data'
 
     def handle(self, *args, **kwargs):
-        # Connect to MongoDB
-        client = MongoClient('localhost', 27017)
-        db = client['octofit_db']
+        # Connect to MongoDB with the bulk-ingestion write concern
+        db = get_bulk_db()
 
         self.stdout.write(self.style.SUCCESS('Starting database population...'))
 
@@ -18,6 +20,8 @@ class Command(BaseCommand):
         self.stdout.write('Clearing existing data...')
         db.users.delete_many({})
         db.teams.delete_many({})
+        # Tombstoned as handled here, so watch_changes does not queue rebuilds for them
+        record_deletions(db, 'activities', db.activities.distinct('_id'), source='populate_db')
         db.activities.delete_many({})
         db.leaderboard.delete_many({})
         db.workouts.delete_many({})
@@ -25,19 +29,20 @@ class Command(BaseCommand):
         # Create unique index on email field
         self.stdout.write('Creating unique index on email field...')
         db.users.create_index('email', unique=True)
+        ensure_activity_indexes(db)
 
         # Insert Teams
         self.stdout.write('Inserting teams...')
         teams = [
             {
-                '_id': 1,
+                '_id': ObjectId(),
                 'name': 'Team Marvel',
                 'description': 'Earth\'s Mightiest Heroes',
                 'members': [],
                 'created_at': datetime.now()
             },
             {
-                '_id': 2,
+                '_id': ObjectId(),
                 'name': 'Team DC',
                 'description': 'Justice League United',
                 'members': [],
@@ -45,99 +50,100 @@ class Command(BaseCommand):
             }
         ]
         db.teams.insert_many(teams)
+        marvel_id, dc_id = (str(team['_id']) for team in teams)
 
         # Insert Users (Superheroes)
         self.stdout.write('Inserting users (superheroes)...')
         users = [
             # Team Marvel
             {
-                '_id': 1,
+                '_id': ObjectId(),
                 'username': 'ironman',
                 'name': 'Tony Stark',
                 'email': 'ironman@marvel.com',
-                'team_id': 1,
+                'team_id': marvel_id,
                 'role': 'hero',
                 'created_at': datetime.now()
             },
             {
-                '_id': 2,
+                '_id': ObjectId(),
                 'username': 'captainamerica',
                 'name': 'Steve Rogers',
                 'email': 'captainamerica@marvel.com',
-                'team_id': 1,
+                'team_id': marvel_id,
                 'role': 'hero',
                 'created_at': datetime.now()
             },
             {
-                '_id': 3,
+                '_id': ObjectId(),
                 'username': 'blackwidow',
                 'name': 'Natasha Romanoff',
                 'email': 'blackwidow@marvel.com',
-                'team_id': 1,
+                'team_id': marvel_id,
                 'role': 'hero',
                 'created_at': datetime.now()
             },
             {
-                '_id': 4,
+                '_id': ObjectId(),
                 'username': 'hulk',
                 'name': 'Bruce Banner',
                 'email': 'hulk@marvel.com',
-                'team_id': 1,
+                'team_id': marvel_id,
                 'role': 'hero',
                 'created_at': datetime.now()
             },
             {
-                '_id': 5,
+                '_id': ObjectId(),
                 'username': 'thor',
                 'name': 'Thor Odinson',
                 'email': 'thor@marvel.com',
-                'team_id': 1,
+                'team_id': marvel_id,
                 'role': 'hero',
                 'created_at': datetime.now()
             },
             # Team DC
             {
-                '_id': 6,
+                '_id': ObjectId(),
                 'username': 'batman',
                 'name': 'Bruce Wayne',
                 'email': 'batman@dc.com',
-                'team_id': 2,
+                'team_id': dc_id,
                 'role': 'hero',
                 'created_at': datetime.now()
             },
             {
-                '_id': 7,
+                '_id': ObjectId(),
                 'username': 'superman',
                 'name': 'Clark Kent',
                 'email': 'superman@dc.com',
-                'team_id': 2,
+                'team_id': dc_id,
                 'role': 'hero',
                 'created_at': datetime.now()
             },
             {
-                '_id': 8,
+                '_id': ObjectId(),
                 'username': 'wonderwoman',
                 'name': 'Diana Prince',
                 'email': 'wonderwoman@dc.com',
-                'team_id': 2,
+                'team_id': dc_id,
                 'role': 'hero',
                 'created_at': datetime.now()
             },
             {
-                '_id': 9,
+                '_id': ObjectId(),
                 'username': 'flash',
                 'name': 'Barry Allen',
                 'email': 'flash@dc.com',
-                'team_id': 2,
+                'team_id': dc_id,
                 'role': 'hero',
                 'created_at': datetime.now()
             },
             {
-                '_id': 10,
+                '_id': ObjectId(),
                 'username': 'aquaman',
                 'name': 'Arthur Curry',
                 'email': 'aquaman@dc.com',
-                'team_id': 2,
+                'team_id': dc_id,
                 'role': 'hero',
                 'created_at': datetime.now()
             }
@@ -147,19 +153,18 @@ class Command(BaseCommand):
         # Update teams with members
         self.stdout.write('Updating teams with members...')
         for team in teams:
-            team_members = [str(user['_id']) for user in users if user['team_id'] == team['_id']]
+            team_members = [str(user['_id']) for user in users if user['team_id'] == str(team['_id'])]
             db.teams.update_one(
                 {'_id': team['_id']},
                 {'$set': {'members': team_members}}
             )
-        self.stdout.write(f'  - Team Marvel: {len([u for u in users if u["team_id"] == 1])} members')
-        self.stdout.write(f'  - Team DC: {len([u for u in users if u["team_id"] == 2])} members')
+        self.stdout.write(f'  - Team Marvel: {len([u for u in users if u["team_id"] == marvel_id])} members')
+        self.stdout.write(f'  - Team DC: {len([u for u in users if u["team_id"] == dc_id])} members')
 
         # Insert Activities
         self.stdout.write('Inserting activities...')
         activities = []
         activity_types = ['running', 'cycling', 'swimming', 'weightlifting', 'combat training', 'flight training']
-        activity_id = 1
 
         for user in users:
             for _ in range(random.randint(5, 10)):
@@ -169,16 +174,16 @@ class Command(BaseCommand):
                 calories = duration * random.uniform(5, 15)
                 
                 activities.append({
-                    '_id': activity_id,
-                    'user_id': user['_id'],
+                    '_id': ObjectId(),
+                    'user_id': str(user['_id']),
                     'type': activity_type,
                     'duration': duration,
                     'distance': round(distance, 2),
                     'calories_burned': round(calories, 2),
                     'date': datetime.now() - timedelta(days=random.randint(0, 30)),
-                    'notes': f'{user["name"]} completed {activity_type}'
+                    'notes': f'{user["name"]} completed {activity_type}',
+                    'source': 'populate_db',  # leaderboard is built below, not by watch_changes
                 })
-                activity_id += 1
 
         db.activities.insert_many(activities)
 
@@ -187,14 +192,14 @@ class Command(BaseCommand):
         leaderboard = []
         
         for user in users:
-            user_activities = [a for a in activities if a['user_id'] == user['_id']]
+            user_activities = [a for a in activities if a['user_id'] == str(user['_id'])]
             total_calories = sum(a['calories_burned'] for a in user_activities)
             total_duration = sum(a['duration'] for a in user_activities)
             total_distance = sum(a['distance'] for a in user_activities)
             activity_count = len(user_activities)
             
             leaderboard.append({
-                'user_id': user['_id'],
+                'user_id': str(user['_id']),
                 'user_name': user['name'],
                 'team_id': user['team_id'],
                 'total_calories': round(total_calories, 2),
@@ -215,7 +220,7 @@ class Command(BaseCommand):
         self.stdout.write('Inserting workout suggestions...')
         workouts = [
             {
-                '_id': 1,
+                '_id': ObjectId(),
                 'name': 'Arc Reactor Cardio',
                 'description': 'High-intensity interval training for tech heroes',
                 'type': 'cardio',
@@ -227,7 +232,7 @@ class Command(BaseCommand):
                 ]
             },
             {
-                '_id': 2,
+                '_id': ObjectId(),
                 'name': 'Super Soldier Strength',
                 'description': 'Captain America\'s workout routine',
                 'type': 'strength',
@@ -239,7 +244,7 @@ class Command(BaseCommand):
                 ]
             },
             {
-                '_id': 3,
+                '_id': ObjectId(),
                 'name': 'Asgardian Power',
                 'description': 'Thor\'s legendary strength training',
                 'type': 'strength',
@@ -251,7 +256,7 @@ class Command(BaseCommand):
                 ]
             },
             {
-                '_id': 4,
+                '_id': ObjectId(),
                 'name': 'Dark Knight Training',
                 'description': 'Batman\'s combat preparation',
                 'type': 'combat training',
@@ -263,7 +268,7 @@ class Command(BaseCommand):
                 ]
             },
             {
-                '_id': 5,
+                '_id': ObjectId(),
                 'name': 'Kryptonian Endurance',
                 'description': 'Superman\'s endurance workout',
                 'type': 'cardio',
@@ -275,7 +280,7 @@ class Command(BaseCommand):
                 ]
             },
             {
-                '_id': 6,
+                '_id': ObjectId(),
                 'name': 'Amazonian Warrior',
                 'description': 'Wonder Woman\'s complete routine',
                 'type': 'strength',
@@ -287,7 +292,7 @@ class Command(BaseCommand):
                 ]
             },
             {
-                '_id': 7,
+                '_id': ObjectId(),
                 'name': 'Speed Force Sprint',
                 'description': 'Flash\'s speed training',
                 'type': 'cardio',
@@ -299,7 +304,7 @@ class Command(BaseCommand):
                 ]
             },
             {
-                '_id': 8,
+                '_id': ObjectId(),
                 'name': 'Atlantean Swim',
                 'description': 'Aquaman\'s underwater workout',
                 'type': 'swimming',
@@ -319,5 +324,3 @@ class Command(BaseCommand):
         self.stdout.write(self.style.SUCCESS(f'  - {len(activities)} activities'))
         self.stdout.write(self.style.SUCCESS(f'  - {len(leaderboard)} leaderboard entries'))
         self.stdout.write(self.style.SUCCESS(f'  - {len(workouts)} workouts'))
-
-        client.close()
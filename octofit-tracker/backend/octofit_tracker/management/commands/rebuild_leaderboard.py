@@ -0,0 +1,91 @@
+"""Recompute the whole leaderboard in parallel and swap it in atomically
+
+Users are hashed into partitions and each partition is cut into batches; pool
+workers total a batch with a server-side $group and spill it as a sorted run.
+The runs are k-way merged to assign ranks while being written to a scratch
+collection, which then replaces the leaderboard in one rename. Memory stays at
+a few batches whatever the number of users.
+
+Activities recorded while this runs are not in the result, so switch ingestion
+to ACTIVITY_INGEST_MODE=queued for the duration and flush afterwards.
+"""
+import multiprocessing
+import os
+import tempfile
+
+from django.core.management.base import BaseCommand
+
+from octofit_tracker import leaderboard
+from octofit_tracker.invalidation import publish
+from octofit_tracker.mongo import get_bulk_db
+
+
+class Command(BaseCommand):
+    help = 'Recompute the whole leaderboard in parallel and swap it in atomically'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--partitions', type=int,
+                            help='Hash partitions of the user ids (default: --workers)')
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Users per $group query and per sorted run')
+        parser.add_argument('--insert-size', type=int, default=1000)
+        parser.add_argument('--spill-dir', help='Directory for sorted runs (default: system temp)')
+
+    def handle(self, *args, **options):
+        db = get_bulk_db()
+        partitions = options['partitions'] or options['workers']
+        batch_size = options['batch_size']
+
+        db[leaderboard.REBUILD_COLLECTION].drop()
+        leaderboard.ensure_leaderboard_indexes(db, leaderboard.REBUILD_COLLECTION)
+
+        with tempfile.TemporaryDirectory(prefix='leaderboard-', dir=options['spill_dir']) as directory:
+            runs = self.build_runs(db, options['workers'], partitions, batch_size, directory)
+            self.stdout.write(f'Merging {len(runs)} runs...')
+            ranked = self.write_ranked(db, leaderboard.merge_runs(runs, directory), options['insert_size'])
+
+        leaderboard.swap_in(db)
+        publish('leaderboard')
+        self.stdout.write(self.style.SUCCESS(f'Leaderboard rebuilt with {ranked} users'))
+
+    def batches(self, db, partitions, batch_size, directory):
+        pending = [[] for _ in range(partitions)]
+        for user in db.users.find({}, {'_id': 1}):
+            user_id = str(user['_id'])
+            partition = leaderboard.partition_of(user_id, partitions)
+            pending[partition].append(user_id)
+            if len(pending[partition]) >= batch_size:
+                yield partition, pending[partition], directory
+                pending[partition] = []
+        for partition, user_ids in enumerate(pending):
+            if user_ids:
+                yield partition, user_ids, directory
+
+    def build_runs(self, db, workers, partitions, batch_size, directory):
+        runs = []
+        users = 0
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(workers, initializer=leaderboard.init_worker) as pool:
+            tasks = self.batches(db, partitions, batch_size, directory)
+            for path, count in pool.imap_unordered(leaderboard.build_run, tasks):
+                runs.append(path)
+                users += count
+                self.stdout.write(f'  - totalled {users} users ({len(runs)} runs)')
+        return runs
+
+    def write_ranked(self, db, rows, insert_size):
+        target = db[leaderboard.REBUILD_COLLECTION]
+        batch = []
+        ranked = 0
+        for ranked, row in enumerate(rows, start=1):
+            row['rank'] = ranked
+            batch.append(row)
+            if len(batch) >= insert_size:
+                target.insert_many(batch, ordered=False)
+                batch = []
+                if ranked % (insert_size * 100) == 0:
+                    self.stdout.write(f'  - ranked {ranked} users')
+        if batch:
+            target.insert_many(batch, ordered=False)
+        return ranked
@@ -0,0 +1,56 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from octofit_tracker import jobs
+from octofit_tracker.mongo import get_db
+
+
+class Command(BaseCommand):
+    help = 'Run queued maintenance jobs (rank recomputation, leaderboard rebuilds, ...)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--enqueue', metavar='JOB',
+                            help=f'Queue a job before running ({", ".join(sorted(jobs.JOB_HANDLERS))})')
+        parser.add_argument('--chunk-size', type=int,
+                            help='Chunk size passed to the queued job')
+        parser.add_argument('--interval', type=float, default=5.0,
+                            help='Seconds to sleep when no job is runnable')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once no job is runnable instead of polling')
+
+    def handle(self, *args, **options):
+        db = get_db()
+        jobs.ensure_job_indexes(db)
+        worker_id = jobs.default_worker_id()
+
+        if options['enqueue']:
+            params = {}
+            if options['chunk_size']:
+                params['chunk_size'] = options['chunk_size']
+            try:
+                queued = jobs.enqueue(db, options['enqueue'], params)
+            except ValueError as exc:
+                raise CommandError(str(exc))
+            self.stdout.write(f'Queued {queued["name"]} ({queued["_id"]}, {queued["status"]})')
+
+        self.stdout.write(self.style.SUCCESS(f'Worker {worker_id} started'))
+        try:
+            while True:
+                job_doc = jobs.claim_next(db, worker_id)
+                if job_doc is None:
+                    if options['once']:
+                        break
+                    time.sleep(options['interval'])
+                    continue
+
+                resumed = ' (resuming)' if job_doc.get('checkpoint') is not None else ''
+                self.stdout.write(f'Running {job_doc["name"]} {job_doc["_id"]}{resumed}')
+                result = jobs.run_job(db, job_doc, worker_id, progress=self._report)
+                style = self.style.SUCCESS if result == jobs.DONE else self.style.ERROR
+                self.stdout.write(style(f'  - {job_doc["name"]} {result}'))
+        except KeyboardInterrupt:
+            pass
+
+    def _report(self, job_doc, processed):
+        self.stdout.write(f'  - {job_doc["name"]}: {processed} processed')
@@ -0,0 +1,79 @@
+from django.core.management.base import BaseCommand
+from pymongo.errors import OperationFailure
+
+from octofit_tracker import jobs
+from octofit_tracker.changes import (
+    CHANGE_STREAM_HISTORY_LOST, SEARCH_KINDS, WATCHED_COLLECTIONS, apply_change, load_resume_token,
+    save_resume_token, watch_pipeline,
+)
+from octofit_tracker.ingest import ensure_applied_indexes
+from octofit_tracker.invalidation import publish
+from octofit_tracker.mongo import get_db
+from octofit_tracker.replica import refresh_reference_snapshot
+
+
+class Command(BaseCommand):
+    help = 'Follow MongoDB change streams and keep caches and derived data in step with direct writes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-events', type=int,
+                            help='Exit after handling this many events (for testing)')
+
+    def handle(self, *args, **options):
+        db = get_db()
+        jobs.ensure_job_indexes(db)
+        ensure_applied_indexes(db)
+        self.handled = 0
+        self.stdout.write(self.style.SUCCESS(f'Watching {", ".join(WATCHED_COLLECTIONS)}'))
+        try:
+            while not self._done(options):
+                try:
+                    self._follow(db, options)
+                except OperationFailure as exc:
+                    if exc.code != CHANGE_STREAM_HISTORY_LOST:
+                        raise
+                    self._recover(db)
+        except KeyboardInterrupt:
+            pass
+
+    def _done(self, options):
+        return options['max_events'] is not None and self.handled >= options['max_events']
+
+    def _follow(self, db, options):
+        """Handle events until interrupted; the resume token is saved after each one"""
+        token = load_resume_token(db)
+        if token is not None:
+            self.stdout.write('Resuming from stored token')
+        stale_snapshot = False
+        with db.watch(watch_pipeline(), full_document='updateLookup', resume_after=token) as stream:
+            while stream.alive and not self._done(options):
+                event = stream.try_next()
+                if event is None:
+                    # Idle: rebuild the snapshot once per burst of team/workout writes
+                    if stale_snapshot:
+                        refresh_reference_snapshot(db)
+                        stale_snapshot = False
+                    if stream.resume_token is not None:
+                        save_resume_token(db, stream.resume_token)
+                    continue
+                collection = apply_change(db, event)
+                publish(collection)
+                stale_snapshot = stale_snapshot or collection in SEARCH_KINDS
+                save_resume_token(db, stream.resume_token)
+                self.handled += 1
+                self.stdout.write(f'  - {event["operationType"]} {collection}')
+            if stale_snapshot:
+                refresh_reference_snapshot(db)
+
+    def _recover(self, db):
+        """The stored token fell off the oplog: rebuild derived data and start from now"""
+        self.stdout.write(self.style.WARNING('Change history lost; queuing full rebuilds'))
+        jobs.enqueue(db, 'rebuild_leaderboard_totals')
+        jobs.enqueue(db, 'rebuild_search_index')
+        jobs.enqueue(db, 'rebuild_rank_histograms')
+        jobs.enqueue(db, 'rebuild_team_feeds')
+        jobs.enqueue(db, 'backfill_change_seq')
+        for collection in WATCHED_COLLECTIONS:
+            publish(collection)
+        refresh_reference_snapshot(db)
+        save_resume_token(db, None)
@@ -0,0 +1,51 @@
+import random
+import threading
+
+from django.conf import settings
+from django.http import JsonResponse
+
+from .mongo import latency_monitor
+
+
+class LoadSheddingMiddleware:
+    """Reject API requests early while the worker is saturated
+
+    Requests beyond LOAD_SHED_MAX_IN_FLIGHT concurrent ones get 503 straight
+    away. When the MongoDB latency average passes LOAD_SHED_DB_LATENCY_MS, a
+    share of requests proportional to the overshoot gets 503 as well; some
+    always pass so the average keeps being measured and recovers.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, request):
+        if not request.path.startswith('/api/'):
+            return self.get_response(request)
+
+        with self._lock:
+            overloaded = self.in_flight >= settings.LOAD_SHED_MAX_IN_FLIGHT
+            if not overloaded:
+                self.in_flight += 1
+        if overloaded:
+            return self.shed('Too many requests in flight')
+        try:
+            if random.random() < self.shed_probability(latency_monitor.ewma_ms):
+                return self.shed('Database is responding slowly')
+            return self.get_response(request)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def shed_probability(self, latency_ms):
+        threshold = settings.LOAD_SHED_DB_LATENCY_MS
+        if latency_ms <= threshold:
+            return 0.0
+        return min(0.9, (latency_ms - threshold) / threshold)
+
+    def shed(self, reason):
+        response = JsonResponse({'error': reason}, status=503)
+        response['Retry-After'] = str(settings.LOAD_SHED_RETRY_AFTER)
+        return response
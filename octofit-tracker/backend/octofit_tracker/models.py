@@ -1,9 +1,11 @@
 from django.db import models
-from bson import ObjectId
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
+from djongo.models import ObjectIdField
 
 
 class User(models.Model):
-    _id = models.CharField(max_length=24, primary_key=True, default=lambda: str(ObjectId()))
+    _id = ObjectIdField()
     username = models.CharField(max_length=100, unique=True)
     name = models.CharField(max_length=255, null=True, blank=True)
     email = models.EmailField(unique=True)
@@ -18,7 +20,7 @@ class User(models.Model):
 
 
 class Team(models.Model):
-    _id = models.CharField(max_length=24, primary_key=True, default=lambda: str(ObjectId()))
+    _id = ObjectIdField()
     name = models.CharField(max_length=100)
     description = models.TextField(blank=True)
     created_by = models.CharField(max_length=24)
@@ -33,7 +35,7 @@ class Team(models.Model):
 
 
 class Activity(models.Model):
-    _id = models.CharField(max_length=24, primary_key=True, default=lambda: str(ObjectId()))
+    _id = ObjectIdField()
     user_id = models.CharField(max_length=24)
     activity_type = models.CharField(max_length=50)
     duration = models.IntegerField()  # in minutes
@@ -51,7 +53,7 @@ class Activity(models.Model):
 
 
 class Leaderboard(models.Model):
-    _id = models.CharField(max_length=24, primary_key=True, default=lambda: str(ObjectId()))
+    _id = ObjectIdField()
     user_id = models.CharField(max_length=24)
     team_id = models.CharField(max_length=24, null=True, blank=True)
     total_activities = models.IntegerField(default=0)
@@ -70,7 +72,7 @@ class Leaderboard(models.Model):
 
 
 class Workout(models.Model):
-    _id = models.CharField(max_length=24, primary_key=True, default=lambda: str(ObjectId()))
+    _id = ObjectIdField()
     name = models.CharField(max_length=100)
     description = models.TextField()
     category = models.CharField(max_length=50, null=True, blank=True)
@@ -85,3 +87,20 @@ class Workout(models.Model):
     
     def __str__(self):
         return self.name
+
+
+@receiver(pre_delete, sender=Activity)
+def tombstone_activity(sender, instance, **kwargs):
+    """Tombstone ORM and admin deletes with the activity itself
+
+    Written before the delete, so by the time watch_changes sees the delete
+    event it can retract exactly this activity's totals. Callers that retract
+    the totals themselves set `tombstone_fields` (e.g. {'source': 'api'}).
+    """
+    from .feed import instance_activity
+    from .mongo import get_db
+    from .sync import record_deletion
+
+    activity = instance_activity(instance)
+    record_deletion(get_db(), 'activities', activity['_id'], user_id=str(activity['user_id']),
+                    activity=activity, **getattr(instance, 'tombstone_fields', {}))
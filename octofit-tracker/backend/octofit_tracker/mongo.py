@@ -0,0 +1,73 @@
+from django.conf import settings
+from pymongo import MongoClient, ReadPreference, WriteConcern, monitoring
+
+_client = None
+
+READ_PREFERENCES = {
+    'primary': ReadPreference.PRIMARY,
+    'primaryPreferred': ReadPreference.PRIMARY_PREFERRED,
+    'secondary': ReadPreference.SECONDARY,
+    'secondaryPreferred': ReadPreference.SECONDARY_PREFERRED,
+    'nearest': ReadPreference.NEAREST,
+}
+
+
+class LatencyMonitor(monitoring.CommandListener):
+    """Exponentially weighted moving average of MongoDB command latency"""
+
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+        self.ewma_ms = 0.0
+
+    def observe(self, duration_ms):
+        self.ewma_ms += self.alpha * (duration_ms - self.ewma_ms)
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.observe(event.duration_micros / 1000)
+
+    def failed(self, event):
+        self.observe(event.duration_micros / 1000)
+
+
+# Registered globally so clients created later, including djongo's, report to it
+latency_monitor = LatencyMonitor()
+monitoring.register(latency_monitor)
+
+
+def get_client():
+    """Return the process-wide MongoClient, creating it on first use
+
+    Connects with the same CLIENT options djongo uses (a host/port pair or a
+    mongodb:// URI naming a replica set) plus MONGO_CLIENT_OPTIONS.
+    """
+    global _client
+    if _client is None:
+        client_settings = settings.DATABASES['default'].get('CLIENT', {})
+        _client = MongoClient(**dict(client_settings, **settings.MONGO_CLIENT_OPTIONS))
+    return _client
+
+
+def get_db(read_preference=None, write_concern=None):
+    """Return the octofit database handle (follows the test database name during tests)
+
+    `read_preference` is a mode name such as 'secondaryPreferred' and
+    `write_concern` a dict such as {'w': 1}; both default to the client's.
+    """
+    return get_client().get_database(
+        settings.DATABASES['default']['NAME'],
+        read_preference=READ_PREFERENCES[read_preference] if read_preference else None,
+        write_concern=WriteConcern(**write_concern) if write_concern is not None else None,
+    )
+
+
+def get_read_db(endpoint):
+    """Database handle using the read preference configured for an endpoint group"""
+    return get_db(read_preference=settings.MONGO_READ_PREFERENCES.get(endpoint, 'primary'))
+
+
+def get_bulk_db():
+    """Database handle for bulk ingestion, using MONGO_BULK_WRITE_CONCERN"""
+    return get_db(write_concern=settings.MONGO_BULK_WRITE_CONCERN)
@@ -0,0 +1,77 @@
+import struct
+from datetime import date, timedelta
+
+from bson import Binary
+from pymongo import UpdateOne
+
+HISTORY_COLLECTION = 'rank_history'
+
+# Leaderboard field -> struct code of its value in a packed day
+COLUMNS = {
+    'total_calories': 'd',
+    'total_duration': 'q',
+    'total_distance': 'd',
+    'total_activities': 'q',
+}
+# One day of one user: rank, then the COLUMNS values, little-endian (40 bytes)
+DAY = struct.Struct('<q' + ''.join(COLUMNS.values()))
+
+
+def pack_day(rank, row):
+    """Pack a day; integer columns are rounded, since imported or summed totals may be floats"""
+    values = [row.get(field) or 0 for field in COLUMNS]
+    values = [round(value) if code == 'q' else float(value) for value, code in zip(values, COLUMNS.values())]
+    return Binary(DAY.pack(rank, *values))
+
+
+def unpack_day(data):
+    rank, *values = DAY.unpack(bytes(data))
+    return rank, dict(zip(COLUMNS, values))
+
+
+def day_index(day):
+    return day.timetuple().tm_yday - 1
+
+
+def write_history_chunk(db, day, first_rank, rows):
+    """Store one day's rank and totals for a run of consecutive leaderboard positions
+
+    Each user has one document per year mapping day-of-year to that day packed
+    into 40 bytes. Recording a day is a $set of one small field, and reading a
+    year of one user's history is a single document fetch.
+    """
+    field = f'days.{day_index(day)}'
+    db[HISTORY_COLLECTION].bulk_write([
+        UpdateOne(
+            {'_id': f'{row["user_id"]}:{day.year}'},
+            {'$set': {field: pack_day(first_rank + offset, row)},
+             '$setOnInsert': {'user_id': str(row['user_id']), 'year': day.year}},
+            upsert=True,
+        )
+        for offset, row in enumerate(rows)
+    ], ordered=False)
+
+
+def user_history(db, user_id, since, until):
+    """Daily rank and totals for a user between two dates, inclusive, oldest first
+
+    Days without a snapshot are left out. One document is read per calendar year.
+    """
+    docs = {
+        doc['year']: doc.get('days', {})
+        for doc in db[HISTORY_COLLECTION].find(
+            {'_id': {'$in': [f'{user_id}:{year}' for year in range(since.year, until.year + 1)]}})
+    }
+    history = []
+    day = since
+    while day <= until:
+        packed = docs.get(day.year, {}).get(str(day_index(day)))
+        if packed is not None:
+            rank, values = unpack_day(packed)
+            history.append({'date': day.isoformat(), 'rank': rank, **values})
+        day += timedelta(days=1)
+    return history
+
+
+def parse_day(value):
+    return date.fromisoformat(value) if isinstance(value, str) else value
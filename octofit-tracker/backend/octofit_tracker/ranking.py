@@ -0,0 +1,198 @@
+import math
+from collections import defaultdict
+
+from django.utils import timezone
+from pymongo import ReturnDocument, UpdateOne
+
+TOTALS_COLLECTION = 'user_period_totals'
+HISTOGRAM_COLLECTION = 'rank_histograms'
+
+# metric -> activity field summed into it (None counts activities)
+RANK_METRICS = {
+    'calories': 'calories',
+    'duration': 'duration',
+    'distance': 'distance',
+    'activities': None,
+}
+PERIODS = ('all', 'month', 'week')
+# $dateToString formats that give the keys period_key does
+PERIOD_FORMATS = {'month': 'month:%Y-%m', 'week': 'week:%G-W%V'}
+
+# Buckets are powers of GAMMA, so a value is known to within 5% from its bucket
+# alone and 1e-3 .. 1e9 fits in about 570 buckets per histogram.
+GAMMA = 1.05
+ZERO_BUCKET = 'zero'
+
+
+def bucket_of(value):
+    """Log-scale bucket index for a value, or None for zero"""
+    if not value or value <= 0:
+        return None
+    return math.floor(math.log(value, GAMMA))
+
+
+def bucket_key(bucket):
+    return ZERO_BUCKET if bucket is None else str(bucket)
+
+
+def period_key(period, when):
+    if period == 'month':
+        return f'month:{when:%Y-%m}'
+    if period == 'week':
+        return 'week:{}-W{:02d}'.format(*when.isocalendar()[:2])
+    return 'all'
+
+
+def period_deltas(activities, sign=1):
+    """Metric increments per (user_id, period key) for a batch of activities (decrements with sign=-1)"""
+    deltas = defaultdict(lambda: dict.fromkeys(RANK_METRICS, 0))
+    for activity in activities:
+        when = activity.get('date') or timezone.now()
+        for period in PERIODS:
+            delta = deltas[(str(activity['user_id']), period_key(period, when))]
+            for metric, field in RANK_METRICS.items():
+                delta[metric] += sign * (1 if field is None else activity.get(field) or 0)
+    return deltas
+
+
+def record_period_totals(db, activities, sign=1):
+    """Add activities to per-user period totals and move users between histogram buckets
+
+    Each (user, period) total is read and incremented in one atomic
+    find_one_and_update, so concurrent writers each move the user out of the
+    bucket the previous writer left them in and the histograms stay exact.
+    Deleted activities are taken out again with sign=-1.
+    """
+    moves = defaultdict(lambda: defaultdict(int))
+    for (user_id, period), delta in period_deltas(activities, sign).items():
+        before = db[TOTALS_COLLECTION].find_one_and_update(
+            {'_id': f'{user_id}:{period}'},
+            {'$inc': delta, '$setOnInsert': {'user_id': user_id, 'period': period}},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE,
+        )
+        for metric, increment in delta.items():
+            old = before.get(metric, 0) if before else None
+            new = (old or 0) + increment
+            counts = moves[f'{metric}:{period}']
+            if old is None:
+                counts[bucket_key(bucket_of(new))] += 1
+            elif bucket_of(old) != bucket_of(new):
+                counts[bucket_key(bucket_of(old))] -= 1
+                counts[bucket_key(bucket_of(new))] += 1
+    updates = [
+        UpdateOne({'_id': histogram_id},
+                  {'$inc': {f'counts.{key}': n for key, n in counts.items()}},
+                  upsert=True)
+        for histogram_id, counts in moves.items() if counts
+    ]
+    if updates:
+        db[HISTOGRAM_COLLECTION].bulk_write(updates, ordered=False)
+
+
+def period_totals_pipeline(user_ids):
+    """Metric totals per (user_id, period key) for a batch of users in one server-side $group"""
+    return [
+        {'$match': {'user_id': {'$in': list(user_ids)}}},
+        {'$project': {
+            'user_id': 1,
+            **{field: 1 for field in RANK_METRICS.values() if field is not None},
+            'period': [{'$dateToString': {'format': PERIOD_FORMATS[period], 'date': '$date'}}
+                       if period in PERIOD_FORMATS else period for period in PERIODS],
+        }},
+        {'$unwind': '$period'},
+        {'$group': {
+            '_id': {'user_id': '$user_id', 'period': '$period'},
+            **{metric: {'$sum': 1 if field is None else {'$ifNull': [f'${field}', 0]}}
+               for metric, field in RANK_METRICS.items()},
+        }},
+    ]
+
+
+def write_period_totals(db, user_ids, collections):
+    """Replace a batch of users' period totals with sums over `collections`
+
+    The totals are set, not incremented, so writing a batch again leaves the
+    same documents.
+    """
+    totals = defaultdict(lambda: dict.fromkeys(RANK_METRICS, 0))
+    pipeline = period_totals_pipeline(user_ids)
+    for collection in collections:
+        for row in db[collection].aggregate(pipeline):
+            key = row.pop('_id')
+            total = totals[(str(key['user_id']), key['period'])]
+            for metric in RANK_METRICS:
+                total[metric] += row[metric]
+    db[TOTALS_COLLECTION].delete_many({'user_id': {'$in': list(user_ids)}})
+    if totals:
+        db[TOTALS_COLLECTION].insert_many([
+            dict(total, _id=f'{user_id}:{period}', user_id=user_id, period=period)
+            for (user_id, period), total in totals.items()
+        ], ordered=False)
+
+
+def histogram_pipeline(metric):
+    """Users per (period, bucket) of one metric, bucketed server-side like bucket_of"""
+    value = f'${metric}'
+    bucket = {'$cond': [
+        {'$gt': [value, 0]},
+        {'$toLong': {'$floor': {'$divide': [{'$ln': value}, math.log(GAMMA)]}}},
+        None,
+    ]}
+    return [{'$group': {'_id': {'period': '$period', 'bucket': bucket}, 'users': {'$sum': 1}}}]
+
+
+def write_histograms(db, metric):
+    """Replace one metric's rank histograms with counts over the stored period totals"""
+    counts = defaultdict(dict)
+    for row in db[TOTALS_COLLECTION].aggregate(histogram_pipeline(metric), allowDiskUse=True):
+        counts[row['_id']['period']][bucket_key(row['_id'].get('bucket'))] = row['users']
+    db[HISTOGRAM_COLLECTION].delete_many({'_id': {'$regex': f'^{metric}:'}})
+    if counts:
+        db[HISTOGRAM_COLLECTION].insert_many([
+            {'_id': f'{metric}:{period}', 'counts': period_counts}
+            for period, period_counts in counts.items()
+        ], ordered=False)
+
+
+def estimate_rank(counts, value):
+    """Rank (1 = best) of `value` among the users counted in a histogram
+
+    Users in higher buckets are counted exactly; the position inside the
+    value's own bucket is interpolated in log space, so the rank is off by at
+    most the number of other users sharing that bucket (`rank_error`).
+    """
+    counts = {key: n for key, n in counts.items() if n > 0}
+    users = sum(counts.values())
+    if not users:
+        return None
+    bucket = bucket_of(value)
+    above = sum(n for key, n in counts.items()
+                if key != ZERO_BUCKET and (bucket is None or int(key) > bucket))
+    others = max(counts.get(bucket_key(bucket), 0) - 1, 0)
+    if bucket is None:
+        inside = 0  # everyone at zero ties
+    else:
+        fraction = math.log(value, GAMMA) - bucket
+        inside = round(others * (1 - fraction))
+    rank = above + inside + 1
+    return {
+        'rank': rank,
+        'users': users,
+        'percentile': round(100 * (users - rank) / users, 1),
+        'top_percent': round(100 * rank / users, 1),
+        'rank_error': others,
+    }
+
+
+def user_rank(db, user_id, metric, period, when=None):
+    """Rank and percentile of a user for a metric in the period containing `when`"""
+    key = period_key(period, when or timezone.now())
+    totals = db[TOTALS_COLLECTION].find_one({'_id': f'{user_id}:{key}'})
+    value = totals.get(metric, 0) if totals else 0
+    result = {'user_id': str(user_id), 'metric': metric, 'period': key, 'value': value}
+    histogram = db[HISTOGRAM_COLLECTION].find_one({'_id': f'{metric}:{key}'}) if totals else None
+    estimate = estimate_rank(histogram.get('counts', {}), value) if histogram else None
+    result.update(estimate or {'rank': None, 'users': None, 'percentile': None,
+                               'top_percent': None, 'rank_error': None})
+    return result
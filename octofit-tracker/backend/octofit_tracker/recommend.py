@@ -0,0 +1,211 @@
+import threading
+import time
+
+import numpy as np
+
+from .invalidation import generation
+
+# Activity types logged by users mapped onto workout categories
+ACTIVITY_CATEGORIES = {
+    'running': 'cardio',
+    'cycling': 'cardio',
+    'flight training': 'cardio',
+    'swimming': 'swimming',
+    'weightlifting': 'strength',
+    'combat training': 'combat training',
+}
+DIFFICULTY_LEVELS = ['beginner', 'intermediate', 'advanced', 'expert']
+# Upper bounds (minutes) of the duration buckets; the last bucket is open-ended
+DURATION_BUCKETS = [30, 45, 60, 90]
+# Calories per minute at which an activity counts as the next difficulty level
+INTENSITY_THRESHOLDS = [5, 8, 11]
+
+CATEGORY_WEIGHT = 1.0
+DIFFICULTY_WEIGHT = 0.3
+DURATION_WEIGHT = 0.2
+
+RECENT_ACTIVITY_LIMIT = 50
+
+
+def workout_category(doc):
+    return (doc.get('category') or doc.get('type') or '').lower() or None
+
+
+def workout_difficulty(doc):
+    return (doc.get('difficulty_level') or doc.get('difficulty') or '').lower() or None
+
+
+def duration_bucket(minutes):
+    return int(np.searchsorted(DURATION_BUCKETS, minutes or 0, side='left'))
+
+
+class WorkoutIndex:
+    """Workouts x features matrix scored against a user profile with one mat-vec
+
+    Columns are [category one-hot | difficulty one-hot | duration bucket one-hot].
+    Categories are discovered from the catalog, so adding a workout with a new
+    category appends a column instead of forcing a rebuild.
+    """
+
+    def __init__(self):
+        self.categories = {}
+        self.ids = []
+        self.positions = {}
+        self.docs = []
+        self.matrix = np.zeros((0, self._width()), dtype=np.float32)
+        self.lock = threading.Lock()
+        self.built_at = 0.0
+        self.generation = None
+
+    def _width(self):
+        return len(self.categories) + len(DIFFICULTY_LEVELS) + len(DURATION_BUCKETS) + 1
+
+    def _category_column(self, category):
+        if category not in self.categories:
+            self.categories[category] = len(self.categories)
+            column = np.zeros((self.matrix.shape[0], 1), dtype=np.float32)
+            split = len(self.categories) - 1
+            self.matrix = np.hstack([self.matrix[:, :split], column, self.matrix[:, split:]])
+        return self.categories[category]
+
+    def _features(self, doc):
+        row = np.zeros(self._width(), dtype=np.float32)
+        offset = len(self.categories)
+        category = workout_category(doc)
+        if category:
+            row[self.categories[category]] = 1.0
+        difficulty = workout_difficulty(doc)
+        if difficulty in DIFFICULTY_LEVELS:
+            row[offset + DIFFICULTY_LEVELS.index(difficulty)] = 1.0
+        row[offset + len(DIFFICULTY_LEVELS) + duration_bucket(doc.get('duration'))] = 1.0
+        return row
+
+    def build(self, docs):
+        with self.lock:
+            self.categories = {}
+            for doc in docs:
+                category = workout_category(doc)
+                if category and category not in self.categories:
+                    self.categories[category] = len(self.categories)
+            self.ids = [str(doc['_id']) for doc in docs]
+            self.positions = {workout_id: i for i, workout_id in enumerate(self.ids)}
+            self.docs = list(docs)
+            self.matrix = np.zeros((len(self.docs), self._width()), dtype=np.float32)
+            for i, doc in enumerate(self.docs):
+                self.matrix[i] = self._features(doc)
+            self.built_at = time.monotonic()
+
+    def upsert(self, doc):
+        with self.lock:
+            category = workout_category(doc)
+            if category:
+                self._category_column(category)
+            workout_id = str(doc['_id'])
+            row = self._features(doc)
+            position = self.positions.get(workout_id)
+            if position is None:
+                self.positions[workout_id] = len(self.ids)
+                self.ids.append(workout_id)
+                self.docs.append(doc)
+                self.matrix = np.vstack([self.matrix, row])
+            else:
+                self.docs[position] = doc
+                self.matrix[position] = row
+
+    def remove(self, workout_id):
+        with self.lock:
+            position = self.positions.pop(str(workout_id), None)
+            if position is None:
+                return
+            # Move the last row into the hole to keep the matrix dense
+            last = len(self.ids) - 1
+            if position != last:
+                self.ids[position] = self.ids[last]
+                self.docs[position] = self.docs[last]
+                self.matrix[position] = self.matrix[last]
+                self.positions[self.ids[position]] = position
+            self.ids.pop()
+            self.docs.pop()
+            self.matrix = self.matrix[:last]
+
+    def profile(self, activities):
+        """Turn a user's recent activities into a preference vector over the columns"""
+        vector = np.zeros(self._width(), dtype=np.float32)
+        if not activities:
+            vector[:len(self.categories)] = CATEGORY_WEIGHT
+            return vector
+
+        durations = np.array([a.get('duration') or 0 for a in activities], dtype=np.float32)
+        calories = np.array([a.get('calories') or 0 for a in activities], dtype=np.float32)
+        total = durations.sum() or 1.0
+
+        category_columns = np.array([
+            self.categories.get(ACTIVITY_CATEGORIES.get((a.get('activity_type') or '').lower(), ''), -1)
+            for a in activities
+        ])
+        known = category_columns >= 0
+        np.add.at(vector, category_columns[known], durations[known] / total * CATEGORY_WEIGHT)
+
+        offset = len(self.categories)
+        intensity = np.divide(calories, durations, out=np.zeros_like(calories), where=durations > 0)
+        levels = np.searchsorted(INTENSITY_THRESHOLDS, intensity, side='right')
+        np.add.at(vector, offset + levels, DIFFICULTY_WEIGHT / len(activities))
+
+        offset += len(DIFFICULTY_LEVELS)
+        buckets = np.searchsorted(DURATION_BUCKETS, durations, side='left')
+        np.add.at(vector, offset + buckets, DURATION_WEIGHT / len(activities))
+        return vector
+
+    def recommend(self, activities, limit=10):
+        """Return (workout doc, score) pairs, best first"""
+        with self.lock:
+            if not self.ids or limit <= 0:
+                return []
+            scores = self.matrix @ self.profile(activities)
+            limit = min(limit, len(scores))
+            top = np.argpartition(-scores, limit - 1)[:limit]
+            top = top[np.argsort(-scores[top], kind='stable')]
+            return [(self.docs[i], float(scores[i])) for i in top]
+
+
+_index = WorkoutIndex()
+
+
+def get_workout_index(db, max_age):
+    """Return the process-wide index, rebuilding it from MongoDB when older than `max_age` seconds
+
+    A change to the workouts collection published by `manage.py watch_changes`
+    also forces a rebuild, so direct database writes show up immediately.
+    """
+    current = generation('workouts')
+    if (not _index.built_at or time.monotonic() - _index.built_at > max_age
+            or _index.generation != current):
+        _index.build(list(db.workouts.find()))
+        _index.generation = current
+    return _index
+
+
+def _adopt(published):
+    """Take this process's own publish as the index's generation
+
+    Only when no other write was published since the index was last current;
+    otherwise the next get_workout_index rebuilds as before.
+    """
+    if published is not None and _index.generation == published - 1:
+        _index.generation = published
+
+
+def workout_saved(doc, published=None):
+    """Fold a created or updated workout into the index without a rebuild
+
+    `published` is the workouts generation the write itself published.
+    """
+    if _index.built_at:
+        _index.upsert(doc)
+        _adopt(published)
+
+
+def workout_removed(workout_id, published=None):
+    if _index.built_at:
+        _index.remove(workout_id)
+        _adopt(published)
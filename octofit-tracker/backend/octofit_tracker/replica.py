@@ -0,0 +1,194 @@
+import fcntl
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .invalidation import generation
+from .mongo import get_db
+
+MAGIC = b'OFR1'
+HEADER = struct.Struct('<4sI')
+
+# collection -> default for the list field the API always includes
+REFERENCE_COLLECTIONS = {
+    'teams': ('members', []),
+    'workouts': ('exercises', []),
+}
+
+
+class ReplicaEncoder(DjangoJSONEncoder):
+    def default(self, o):
+        try:
+            return super().default(o)
+        except TypeError:
+            return str(o)  # ObjectId and other BSON scalars
+
+
+def serialize_collection(docs, list_field, default):
+    """Encode documents exactly as the list endpoints return them"""
+    for doc in docs:
+        if '_id' in doc:
+            doc['id'] = str(doc['_id'])
+        if list_field not in doc:
+            doc[list_field] = list(default)
+    return json.dumps(docs, cls=ReplicaEncoder, separators=(',', ':')).encode()
+
+
+def write_snapshot(path, bodies):
+    """Write {collection: json bytes} to `path` and atomically swap it in
+
+    Layout: magic, header length, JSON header of {collection: [offset, length]}
+    with offsets relative to the end of the header, then the bodies back to back.
+    """
+    index = {}
+    offset = 0
+    for name, body in bodies.items():
+        index[name] = [offset, len(body)]
+        offset += len(body)
+    header = json.dumps(index).encode()
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.reference-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, len(header)))
+            f.write(header)
+            for body in bodies.values():
+                f.write(body)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def build_snapshot(db, path):
+    bodies = {
+        name: serialize_collection(list(db[name].find()), list_field, default)
+        for name, (list_field, default) in REFERENCE_COLLECTIONS.items()
+    }
+    write_snapshot(path, bodies)
+    return {name: len(body) for name, body in bodies.items()}
+
+
+class ReferenceReplica:
+    """Read-only view of the snapshot file shared by every worker through the page cache
+
+    The file is re-mapped whenever it has been replaced on disk, so a rebuild in
+    any process is picked up by all of them on their next request.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.identity = None
+        self.buffer = None
+        self.index = {}
+
+    def _reload(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self.identity, self.buffer, self.index = None, None, {}
+            return
+        identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if identity == self.identity:
+            return
+        with open(self.path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, header_length = HEADER.unpack_from(mapped, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{self.path} is not a reference snapshot')
+        base = HEADER.size + header_length
+        index = {
+            name: (start + base, length)
+            for name, (start, length) in json.loads(mapped[HEADER.size:base]).items()
+        }
+        # Older maps stay alive until the responses still reading them are done
+        self.identity, self.buffer, self.index = identity, memoryview(mapped), index
+
+    def get(self, collection):
+        """Return the pre-serialized JSON body for a collection, or None if unavailable"""
+        with self.lock:
+            self._reload()
+            if collection not in self.index:
+                return None
+            start, length = self.index[collection]
+            return self.buffer[start:start + length]
+
+
+_replica = None
+
+
+def reference_body(collection):
+    """JSON body for the teams/workouts list endpoints, or None when the replica is off or missing"""
+    global _replica
+    if not settings.REFERENCE_SNAPSHOT_ENABLED:
+        return None
+    if _replica is None:
+        _replica = ReferenceReplica(settings.REFERENCE_SNAPSHOT_PATH)
+    return _replica.get(collection)
+
+
+def refresh_reference_snapshot(db):
+    """Rebuild the snapshot unless it already reflects the current generations
+
+    Rebuilds on a host are serialized by an flock on `<path>.lock`, which also
+    holds the generations the current file was built from. Generations are
+    read under the lock before the data, so a build that started from older
+    data can never replace a newer file, and a rebuild nobody needs is skipped.
+    """
+    if not settings.REFERENCE_SNAPSHOT_ENABLED:
+        return
+    path = settings.REFERENCE_SNAPSHOT_PATH
+    with open(path + '.lock', 'a+') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            current = json.dumps({name: generation(name) for name in REFERENCE_COLLECTIONS}, sort_keys=True)
+            lock.seek(0)
+            if lock.read() == current and os.path.exists(path):
+                return
+            build_snapshot(db, path)
+            lock.truncate(0)
+            lock.write(current)
+        finally:
+            lock.flush()
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+_refresher = None
+_refresh_lock = threading.Lock()
+_refresh_queued = False
+
+
+def request_reference_refresh():
+    """Refresh the snapshot on a background thread after a write
+
+    Writes arriving before the queued refresh starts share it, so a burst of
+    team or workout edits costs one rebuild and no request waits for it.
+    """
+    global _refresher, _refresh_queued
+    if not settings.REFERENCE_SNAPSHOT_ENABLED:
+        return
+    with _refresh_lock:
+        if _refresh_queued:
+            return
+        _refresh_queued = True
+        if _refresher is None:
+            _refresher = ThreadPoolExecutor(max_workers=1, thread_name_prefix='reference-snapshot')
+    _refresher.submit(_background_refresh)
+
+
+def _background_refresh():
+    global _refresh_queued
+    with _refresh_lock:
+        _refresh_queued = False
+    refresh_reference_snapshot(get_db())
@@ -0,0 +1,79 @@
+from collections import namedtuple
+
+from pymongo import DESCENDING
+
+# Field order matches ActivitySerializer / LeaderboardSerializer output; `id`
+# holds the document `_id` (namedtuple fields cannot start with an underscore)
+ActivityRow = namedtuple('ActivityRow', [
+    'id', 'user_id', 'activity_type', 'duration', 'distance', 'calories', 'date', 'notes',
+])
+LeaderboardRow = namedtuple('LeaderboardRow', [
+    'id', 'user_id', 'team_id', 'total_activities', 'total_duration',
+    'total_distance', 'total_calories', 'rank', 'last_updated',
+])
+
+# Fields the serializers render as strings even when stored as numbers
+STRING_FIELDS = {'_id', 'user_id', 'team_id'}
+DATETIME_FIELDS = {'date', 'last_updated'}
+
+
+def document_fields(row_type):
+    """Document keys in row order"""
+    return ('_id',) + row_type._fields[1:]
+
+
+def _projection(row_type):
+    return {field: 1 for field in document_fields(row_type)}
+
+
+def _row_factory(row_type):
+    fields = document_fields(row_type)
+    string_fields = [field in STRING_FIELDS for field in fields]
+
+    def make(doc):
+        return row_type._make(
+            str(value) if is_string and value is not None else value
+            for value, is_string in zip((doc.get(field) for field in fields), string_fields)
+        )
+    return make
+
+
+_make_activity = _row_factory(ActivityRow)
+_make_leaderboard = _row_factory(LeaderboardRow)
+
+
+def fetch_activity_rows(collection, query=None, limit=0):
+    """Activities as compact tuples, newest first (Activity.Meta.ordering)"""
+    cursor = collection.find(query or {}, _projection(ActivityRow)).sort('date', DESCENDING).limit(limit)
+    return [_make_activity(doc) for doc in cursor]
+
+
+def fetch_leaderboard_rows(collection, query=None, limit=0):
+    """Leaderboard entries as compact tuples, highest total_calories first"""
+    cursor = (collection.find(query or {}, _projection(LeaderboardRow))
+              .sort('total_calories', DESCENDING).limit(limit))
+    return [_make_leaderboard(doc) for doc in cursor]
+
+
+def format_datetime(value):
+    """Render like DRF's DateTimeField for UTC values (naive values from pymongo are UTC)"""
+    if value.tzinfo is None:
+        return value.isoformat() + 'Z'
+    value = value.isoformat()
+    return value[:-6] + 'Z' if value.endswith('+00:00') else value
+
+
+def serialize_rows(rows):
+    """Turn rows into the same dicts the model serializers produce"""
+    if not rows:
+        return []
+    fields = document_fields(type(rows[0]))
+    date_positions = [i for i, field in enumerate(fields) if field in DATETIME_FIELDS]
+    data = []
+    for row in rows:
+        values = list(row)
+        for i in date_positions:
+            if values[i] is not None:
+                values[i] = format_datetime(values[i])
+        data.append(dict(zip(fields, values)))
+    return data
@@ -0,0 +1,123 @@
+import re
+
+from pymongo import ASCENDING, UpdateOne
+
+SEARCH_COLLECTION = 'search_index'
+MAX_PREFIX = '\uffff'
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+# kind -> (source collection, label field, searchable fields)
+SEARCHABLE = {
+    'user': ('users', 'username', ['username', 'name']),
+    'team': ('teams', 'name', ['name', 'description']),
+    'workout': ('workouts', 'name', ['name', 'description', 'exercises.name']),
+}
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(str(text).lower()) if text else []
+
+
+def _field_values(doc, path):
+    """Resolve a dotted path, flattening lists of subdocuments"""
+    values = [doc]
+    for part in path.split('.'):
+        resolved = []
+        for value in values:
+            if isinstance(value, list):
+                resolved.extend(item.get(part) for item in value if isinstance(item, dict))
+            elif isinstance(value, dict):
+                resolved.append(value.get(part))
+        values = resolved
+    return [value for value in values if value]
+
+
+def search_entry(kind, doc):
+    """Build the search index document for a user, team or workout"""
+    _, label_field, fields = SEARCHABLE[kind]
+    terms = set()
+    for field in fields:
+        for value in _field_values(doc, field):
+            terms.update(tokenize(value))
+    ref_id = str(doc['_id'])
+    label = doc.get(label_field) or ''
+    return {
+        '_id': f'{kind}:{ref_id}',
+        'kind': kind,
+        'ref_id': ref_id,
+        'label': label,
+        'label_key': label_key(label),
+        'terms': sorted(terms),
+    }
+
+
+def label_key(text):
+    """Case-folded form a label and a query are compared in for an exact match"""
+    return str(text).strip().lower()
+
+
+def ensure_search_indexes(db):
+    db[SEARCH_COLLECTION].create_index([('terms', ASCENDING)])
+    db[SEARCH_COLLECTION].create_index([('label_key', ASCENDING)])
+
+
+def index_document(db, kind, doc):
+    entry = search_entry(kind, doc)
+    db[SEARCH_COLLECTION].replace_one({'_id': entry['_id']}, entry, upsert=True)
+
+
+def remove_document(db, kind, ref_id):
+    db[SEARCH_COLLECTION].delete_one({'_id': f'{kind}:{ref_id}'})
+
+
+def index_batch(db, kind, docs):
+    entries = [search_entry(kind, doc) for doc in docs]
+    if entries:
+        db[SEARCH_COLLECTION].bulk_write(
+            [UpdateOne({'_id': entry['_id']}, {'$set': entry}, upsert=True) for entry in entries],
+            ordered=False,
+        )
+    return len(entries)
+
+
+def search_query(q, kinds=None):
+    """Prefix match every query token against the indexed terms"""
+    tokens = tokenize(q)
+    if not tokens:
+        return None
+    query = {'$and': [
+        {'terms': {'$elemMatch': {'$gte': token, '$lt': token + MAX_PREFIX}}}
+        for token in tokens
+    ]}
+    if kinds:
+        query['kind'] = {'$in': list(kinds)}
+    return query
+
+
+def rank_matches(q, rows, limit):
+    """Exact labels first, then shorter labels (closer prefix matches), without duplicates"""
+    unique = {row['_id']: row for row in rows}
+    key = label_key(q)
+    ranked = sorted(unique.values(), key=lambda row: (label_key(row['label']) != key, len(row['label']), row['label']))
+    return ranked[:limit]
+
+
+def search(db, q, kinds=None, limit=10):
+    """Ranked matches for typeahead
+
+    Two index reads of at most `limit` entries each: an exact lookup on
+    label_key, and a prefix scan of the terms index in index order. They are
+    ranked together here, so an exact match is never cut off by `limit` and
+    no server-side sort has to hold every prefix match.
+    """
+    query = search_query(q, kinds)
+    if query is None:
+        return []
+    collection = db[SEARCH_COLLECTION]
+    projection = {'kind': 1, 'ref_id': 1, 'label': 1}
+    exact_query = {'label_key': label_key(q)}
+    if kinds:
+        exact_query['kind'] = {'$in': list(kinds)}
+    rows = list(collection.find(exact_query, projection).limit(limit))
+    rows += collection.find(query, projection).hint([('terms', ASCENDING)]).limit(limit)
+    return [{'kind': r['kind'], 'id': r['ref_id'], 'label': r['label']} for r in rank_matches(q, rows, limit)]
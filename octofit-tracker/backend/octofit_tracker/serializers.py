@@ -1,3 +1,5 @@
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
 from rest_framework import serializers
 from .models import User, Team, Activity, Leaderboard, Workout
 
@@ -11,8 +13,15 @@ class UserSerializer(serializers.ModelSerializer):
         extra_kwargs = {'password': {'write_only': True}}
     
     def create(self, validated_data):
+        if validated_data.get('password'):
+            validated_data['password'] = make_password(validated_data['password'])
         user = User.objects.create(**validated_data)
         return user
+    
+    def update(self, instance, validated_data):
+        if validated_data.get('password'):
+            validated_data['password'] = make_password(validated_data['password'])
+        return super().update(instance, validated_data)
 
 
 class TeamSerializer(serializers.ModelSerializer):
@@ -23,12 +32,30 @@ class TeamSerializer(serializers.ModelSerializer):
         fields = ['_id', 'name', 'description', 'created_by', 'members', 'created_at']
 
 
+class TrackField(serializers.Field):
+    """GPS points as [[lat, lon], ...] or [[lat, lon, seconds], ...], parsed into NumPy arrays"""
+    
+    def to_internal_value(self, data):
+        # tracks needs numpy; importing it here keeps it off worker startup
+        from .tracks import parse_track
+        
+        if not isinstance(data, list):
+            raise serializers.ValidationError('track must be a list of points')
+        if len(data) > settings.TRACK_MAX_POINTS:
+            raise serializers.ValidationError(f'track may have at most {settings.TRACK_MAX_POINTS} points')
+        try:
+            return parse_track(data)
+        except ValueError as exc:
+            raise serializers.ValidationError(str(exc))
+
+
 class ActivitySerializer(serializers.ModelSerializer):
     _id = serializers.CharField(read_only=True)
+    track = TrackField(required=False, write_only=True)
     
     class Meta:
         model = Activity
-        fields = ['_id', 'user_id', 'activity_type', 'duration', 'distance', 'calories', 'date', 'notes']
+        fields = ['_id', 'user_id', 'activity_type', 'duration', 'distance', 'calories', 'date', 'notes', 'track']
 
 
 class LeaderboardSerializer(serializers.ModelSerializer):
@@ -51,6 +51,7 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'corsheaders.middleware.CorsMiddleware',
+    'octofit_tracker.middleware.LoadSheddingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -88,13 +89,37 @@ DATABASES = {
         'ENGINE': 'djongo',
         'NAME': 'octofit_db',
         'ENFORCE_SCHEMA': False,
-        'CLIENT': {
+        # A mongodb:// URI in MONGO_URI (e.g. naming a replicaSet) replaces host and port
+        'CLIENT': {'host': os.environ['MONGO_URI']} if os.environ.get('MONGO_URI') else {
             'host': 'localhost',
             'port': 27017,
         }
     }
 }
 
+# Extra MongoClient options for the shared client in octofit_tracker/mongo.py
+MONGO_CLIENT_OPTIONS = {
+    'appname': 'octofit-tracker',
+    'maxPoolSize': int(os.environ.get('MONGO_MAX_POOL_SIZE', 100)),
+    'serverSelectionTimeoutMS': int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000)),
+    'retryWrites': True,
+}
+
+# Read preference per endpoint group. Writes and anything not listed read from
+# the primary; listed groups may be served by replica-set secondaries.
+MONGO_READ_PREFERENCES = {
+    'leaderboard': os.environ.get('MONGO_LEADERBOARD_READ_PREFERENCE', 'secondaryPreferred'),
+    'workouts': os.environ.get('MONGO_WORKOUTS_READ_PREFERENCE', 'secondaryPreferred'),
+}
+
+# Write concern for bulk ingestion (flush_activities, populate_db). Raise 'w' to
+# 'majority' to survive a primary failover at the cost of slower batches.
+_bulk_w = os.environ.get('MONGO_BULK_W', '1')
+MONGO_BULK_WRITE_CONCERN = {
+    'w': int(_bulk_w) if _bulk_w.isdigit() else _bulk_w,
+    'j': os.environ.get('MONGO_BULK_JOURNAL', 'false').lower() in ('1', 'true'),
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
@@ -169,3 +194,126 @@ CORS_ALLOW_HEADERS = [
     'x-csrftoken',
     'x-requested-with',
 ]
+
+# Activity ingestion
+# 'sync' stores activities on the request path; 'queued' appends them to a
+# local journal and returns 202, leaving the insert to `manage.py flush_activities`.
+ACTIVITY_INGEST_MODE = os.environ.get('ACTIVITY_INGEST_MODE', 'sync')
+ACTIVITY_JOURNAL_PATH = os.environ.get('ACTIVITY_JOURNAL_PATH', str(BASE_DIR / 'activity_journal.sqlite3'))
+ACTIVITY_FLUSH_BATCH_SIZE = int(os.environ.get('ACTIVITY_FLUSH_BATCH_SIZE', 500))
+# Seconds each process caches whether a rebuild has paused ingestion, and how
+# old a pause may get before it is treated as left behind by a dead holder
+INGEST_PAUSE_POLL = float(os.environ.get('INGEST_PAUSE_POLL', 0.5))
+INGEST_PAUSE_TIMEOUT = int(os.environ.get('INGEST_PAUSE_TIMEOUT', 600))
+
+# Activities older than this are moved to the activities_archive collection by
+# the archive_activities job; user_activities only reads them with include_archive.
+ACTIVITY_ARCHIVE_AFTER_DAYS = int(os.environ.get('ACTIVITY_ARCHIVE_AFTER_DAYS', 365))
+
+# Seconds before a worker rebuilds its workout recommendation matrix from MongoDB;
+# writes through WorkoutViewSet update the local matrix immediately.
+RECOMMENDATION_INDEX_MAX_AGE = int(os.environ.get('RECOMMENDATION_INDEX_MAX_AGE', 300))
+
+# Root directory for `manage.py export_snapshot` partitioned Parquet/Arrow files
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', str(BASE_DIR / 'snapshots'))
+# Seconds a timestamp watermark trails the clock so writes stamped just before committing are not skipped
+SNAPSHOT_WATERMARK_LAG = int(os.environ.get('SNAPSHOT_WATERMARK_LAG', 60))
+
+# Memory-mapped, pre-serialized copy of teams and workouts shared by all workers.
+# Build it with `manage.py build_reference_snapshot`; API writes refresh it.
+REFERENCE_SNAPSHOT_ENABLED = os.environ.get('REFERENCE_SNAPSHOT_ENABLED', '').lower() in ('1', 'true')
+REFERENCE_SNAPSHOT_PATH = os.environ.get('REFERENCE_SNAPSHOT_PATH', str(BASE_DIR / 'reference.snapshot'))
+
+# Also match integer and 24-char string _ids from before `manage.py migrate_ids`.
+# Turn off once the migration has run so every id lookup is a single ObjectId point read.
+LEGACY_ID_LOOKUPS = os.environ.get('LEGACY_ID_LOOKUPS', 'true').lower() in ('1', 'true')
+
+# Seconds a stored response for an Idempotency-Key header is replayed
+IDEMPOTENCY_KEY_TTL = int(os.environ.get('IDEMPOTENCY_KEY_TTL', 24 * 60 * 60))
+
+# Django cache. The default local-memory cache is private to each worker; point
+# CACHE_BACKEND/CACHE_LOCATION at Redis or memcached to share it, e.g.
+# django.core.cache.backends.redis.RedisCache and redis://cache:6379/0.
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    },
+}
+
+# Token-bucket rate limiting per client (user or IP) and endpoint.
+# 'local' keeps buckets in each worker process; 'cache' shares them through a
+# shared CACHES backend (Redis, memcached or database; not local memory).
+REST_FRAMEWORK = {
+    'DEFAULT_THROTTLE_CLASSES': ['octofit_tracker.throttling.TokenBucketThrottle'],
+}
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() in ('1', 'true')
+RATE_LIMIT_STORE = os.environ.get('RATE_LIMIT_STORE', 'local')
+RATE_LIMIT_RATE = float(os.environ.get('RATE_LIMIT_RATE', 10))  # tokens per second
+RATE_LIMIT_BURST = int(os.environ.get('RATE_LIMIT_BURST', 20))
+# (rate, burst) overrides by route name for endpoints that are expensive to serve.
+# Writes are limited apart from reads under '<route>:write', so a tight limit on
+# an expensive list does not also throttle creates on the same route.
+RATE_LIMIT_ENDPOINTS = {
+    'activity-list': (1, 5),
+    'leaderboard-list': (2, 10),
+}
+
+# Shed /api/ requests with 503 beyond this many concurrent requests per worker,
+# or progressively once the MongoDB command latency average passes the threshold.
+LOAD_SHED_MAX_IN_FLIGHT = int(os.environ.get('LOAD_SHED_MAX_IN_FLIGHT', 32))
+LOAD_SHED_DB_LATENCY_MS = float(os.environ.get('LOAD_SHED_DB_LATENCY_MS', 250))
+LOAD_SHED_RETRY_AFTER = 1
+
+# Shared file of per-collection generation counters. `manage.py watch_changes`
+# bumps them for writes made directly to MongoDB so every worker drops stale caches.
+INVALIDATION_PATH = os.environ.get('INVALIDATION_PATH', str(BASE_DIR / 'invalidation.generations'))
+
+# /api/sync/: tokens (and deletion tombstones) older than this force a full resync
+SYNC_TOKEN_MAX_AGE = int(os.environ.get('SYNC_TOKEN_MAX_AGE', 30 * 24 * 60 * 60))
+SYNC_PAGE_SIZE = int(os.environ.get('SYNC_PAGE_SIZE', 500))
+# Seconds a reserved change sequence may stay unwritten before syncs stop waiting for it
+SYNC_LEASE_TIMEOUT = int(os.environ.get('SYNC_LEASE_TIMEOUT', 60))
+
+# /api/dashboard/: threads reading sections concurrently, per-section timeout
+# (seconds) and how long a combined payload may be served from the cache
+DASHBOARD_WORKERS = int(os.environ.get('DASHBOARD_WORKERS', 8))
+DASHBOARD_TIMEOUT = float(os.environ.get('DASHBOARD_TIMEOUT', 5))
+DASHBOARD_CACHE_SECONDS = int(os.environ.get('DASHBOARD_CACHE_SECONDS', 15))
+
+# Most ids accepted by one ?ids= / batch/ multi-get on users, teams and workouts
+BATCH_MAX_IDS = int(os.environ.get('BATCH_MAX_IDS', 1000))
+
+# Longest range /api/leaderboard/history/ serves in one request (days)
+RANK_HISTORY_MAX_DAYS = int(os.environ.get('RANK_HISTORY_MAX_DAYS', 3 * 366))
+
+# Admin changelists for activities and the leaderboard: estimated totals, keyset
+# pages and cached distinct() filter choices (refreshed after this many seconds)
+ADMIN_PERFORMANCE_MODE = os.environ.get('ADMIN_PERFORMANCE_MODE', 'true').lower() in ('1', 'true')
+ADMIN_FILTER_CACHE_SECONDS = int(os.environ.get('ADMIN_FILTER_CACHE_SECONDS', 300))
+
+# GPS tracks posted with an activity (`track`): most points accepted, and the
+# default and largest number of points /api/activities/{id}/track/ returns
+TRACK_MAX_POINTS = int(os.environ.get('TRACK_MAX_POINTS', 100000))
+TRACK_RESPONSE_POINTS = int(os.environ.get('TRACK_RESPONSE_POINTS', 500))
+TRACK_RESPONSE_MAX_POINTS = int(os.environ.get('TRACK_RESPONSE_MAX_POINTS', 5000))
+
+# /api/teams/{id}/feed/: entries kept per team timeline, members above which a
+# team is read from activities instead of fanned out to, and page sizes
+TEAM_FEED_SIZE = int(os.environ.get('TEAM_FEED_SIZE', 500))
+TEAM_FEED_MAX_MEMBERS = int(os.environ.get('TEAM_FEED_MAX_MEMBERS', 1000))
+TEAM_FEED_PAGE_SIZE = int(os.environ.get('TEAM_FEED_PAGE_SIZE', 20))
+TEAM_FEED_MAX_PAGE_SIZE = int(os.environ.get('TEAM_FEED_MAX_PAGE_SIZE', 100))
+
+# API authentication. 'session' (the default) keeps DRF's session and basic
+# authentication; 'token' accepts signed bearer tokens from /api/auth/login/,
+# verified without reading the session or users collections, and keeps session
+# authentication for the admin and browsable API. Lifetimes are in seconds.
+API_AUTH_MODE = os.environ.get('API_AUTH_MODE', 'session')
+ACCESS_TOKEN_LIFETIME = int(os.environ.get('ACCESS_TOKEN_LIFETIME', 5 * 60))
+REFRESH_TOKEN_LIFETIME = int(os.environ.get('REFRESH_TOKEN_LIFETIME', 14 * 24 * 60 * 60))
+if API_AUTH_MODE == 'token':
+    REST_FRAMEWORK['DEFAULT_AUTHENTICATION_CLASSES'] = [
+        'octofit_tracker.tokens.BearerTokenAuthentication',
+        'rest_framework.authentication.SessionAuthentication',
+    ]
@@ -0,0 +1,153 @@
+import json
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from django.conf import settings
+from django.utils import timezone
+
+from .sync import SEQ_FIELD, committed_seq
+
+# collection -> how to read it incrementally and where its rows land. The
+# watermark moves with every write, so an edited row is exported again in a
+# later file; readers keep the newest row per _id.
+SNAPSHOT_COLLECTIONS = {
+    'activities': {
+        'watermark': SEQ_FIELD,
+        'partition_date': 'date',
+        'columns': {
+            '_id': 'string', 'user_id': 'string', 'activity_type': 'string',
+            'duration': 'int64', 'distance': 'float64', 'calories': 'float64',
+            'date': 'timestamp', 'notes': 'string',
+        },
+    },
+    'leaderboard': {
+        'watermark': 'last_updated',
+        'partition_date': 'last_updated',
+        'columns': {
+            '_id': 'string', 'user_id': 'string', 'team_id': 'string',
+            'total_activities': 'int64', 'total_duration': 'int64',
+            'total_distance': 'float64', 'total_calories': 'float64',
+            'rank': 'int64', 'last_updated': 'timestamp',
+        },
+    },
+}
+WATERMARK_FILE = '_watermarks.json'
+NO_TEAM = 'none'
+
+
+def partition_path(collection, month, team_id):
+    return os.path.join(collection, f'month={month}', f'team={team_id}')
+
+
+def partition_month(value):
+    return value.strftime('%Y-%m') if isinstance(value, datetime) else 'unknown'
+
+
+def _encode_watermark(value):
+    if isinstance(value, datetime):
+        return {'type': 'datetime', 'value': value.isoformat()}
+    if isinstance(value, ObjectId):
+        return {'type': 'ObjectId', 'value': str(value)}
+    return {'type': 'raw', 'value': value}
+
+
+def _decode_watermark(entry):
+    if entry['type'] == 'datetime':
+        return datetime.fromisoformat(entry['value'])
+    if entry['type'] == 'ObjectId':
+        return ObjectId(entry['value'])
+    return entry['value']
+
+
+def watermark_bound(db, spec):
+    """The highest watermark every write at or below is known to have committed
+
+    Change sequences are bounded by the oldest reservation still being
+    written; timestamps are set just before their write, so they are bounded
+    SNAPSHOT_WATERMARK_LAG seconds in the past. None means nothing is safe
+    to export yet.
+    """
+    if spec['watermark'] == SEQ_FIELD:
+        return committed_seq(db)
+    return timezone.now() - timedelta(seconds=settings.SNAPSHOT_WATERMARK_LAG)
+
+
+def watermark_query(spec, since, upto):
+    """Rows written after `since` up to `upto`; rows without a watermark value are left out"""
+    bounds = {'$lte': upto}
+    if since is not None:
+        bounds['$gt'] = since
+    return {spec['watermark']: bounds}
+
+
+def load_watermarks(output_dir):
+    """Return {collection: last exported watermark value}
+
+    Watermarks recorded for another field than the collection's current one
+    are dropped, so that collection is exported in full once.
+    """
+    path = os.path.join(output_dir, WATERMARK_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return {
+            collection: _decode_watermark(entry) for collection, entry in json.load(f).items()
+            if collection in SNAPSHOT_COLLECTIONS
+            and entry.get('field') == SNAPSHOT_COLLECTIONS[collection]['watermark']
+        }
+
+
+def save_watermarks(output_dir, watermarks):
+    """Atomically replace the watermark file"""
+    path = os.path.join(output_dir, WATERMARK_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({
+            collection: dict(_encode_watermark(value), field=SNAPSHOT_COLLECTIONS[collection]['watermark'])
+            for collection, value in watermarks.items()
+        }, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+class PartitionBuffer:
+    """Rows grouped by (month, team) until there are enough to write a file"""
+
+    def __init__(self, collection, spec, team_of):
+        self.collection = collection
+        self.spec = spec
+        self.team_of = team_of
+        self.rows = defaultdict(list)
+        self.size = 0
+
+    def add(self, doc):
+        row = {column: doc.get(column) for column in self.spec['columns']}
+        for column, kind in self.spec['columns'].items():
+            value = row[column]
+            if value is None:
+                continue
+            if kind == 'string':
+                row[column] = str(value)
+            elif kind == 'int64':
+                row[column] = int(value)
+            elif kind == 'float64':
+                row[column] = float(value)
+        month = partition_month(doc.get(self.spec['partition_date']))
+        team_id = doc.get('team_id') if 'team_id' in self.spec['columns'] else self.team_of(doc)
+        self.rows[(month, str(team_id) if team_id is not None else NO_TEAM)].append(row)
+        self.size += 1
+
+    def drain(self):
+        rows, self.rows, self.size = self.rows, defaultdict(list), 0
+        return rows
+
+
+def arrow_schema(pa, spec):
+    """Fixed Arrow schema for a collection so every partition file agrees"""
+    types = {
+        'string': pa.string(),
+        'int64': pa.int64(),
+        'float64': pa.float64(),
+        'timestamp': pa.timestamp('us'),
+    }
+    return pa.schema([(column, types[kind]) for column, kind in spec['columns'].items()])
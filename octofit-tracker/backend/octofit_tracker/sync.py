@@ -0,0 +1,173 @@
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.core import signing
+from django.utils import timezone
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+
+from .ids import stringify_ids
+from .rows import _make_activity, serialize_rows
+
+SEQ_FIELD = 'change_seq'
+COUNTERS_COLLECTION = 'counters'
+TOMBSTONE_COLLECTION = 'sync_tombstones'
+# One document per sequence range handed out but not yet written
+LEASE_COLLECTION = 'seq_leases'
+SYNCED_COLLECTIONS = ('activities', 'teams', 'workouts')
+TOKEN_SALT = 'octofit.sync'
+
+# Default list fields the list endpoints always include
+LIST_DEFAULTS = {'teams': 'members', 'workouts': 'exercises'}
+
+
+def ensure_sync_indexes(db):
+    for name in SYNCED_COLLECTIONS:
+        db[name].create_index(SEQ_FIELD, sparse=True)
+    db[TOMBSTONE_COLLECTION].create_index(SEQ_FIELD)
+    # Clients whose token is older than the tombstones are sent a reset instead
+    db[TOMBSTONE_COLLECTION].create_index('deleted_at', expireAfterSeconds=settings.SYNC_TOKEN_MAX_AGE)
+    # A writer that died mid-write must not hold every sync token back forever
+    db[LEASE_COLLECTION].create_index('created_at', expireAfterSeconds=settings.SYNC_LEASE_TIMEOUT)
+
+
+@contextmanager
+def reserve_seqs(db, count=1):
+    """Reserve `count` consecutive change sequence numbers and yield the first
+
+    The reservation is leased until the block exits, so wrap the write that
+    stores the sequences: sync tokens never move past a sequence whose
+    write has not committed yet (see committed_seq).
+    """
+    leases = db[LEASE_COLLECTION]
+    # The lease exists before the counter moves, so a reader that sees the
+    # new counter value also sees the lease
+    lease_id = leases.insert_one({'created_at': timezone.now()}).inserted_id
+    try:
+        counter = db[COUNTERS_COLLECTION].find_one_and_update(
+            {'_id': SEQ_FIELD},
+            {'$inc': {'value': count}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        first = counter['value'] - count + 1
+        leases.update_one({'_id': lease_id}, {'$set': {'first': first}})
+        yield first
+    finally:
+        leases.delete_one({'_id': lease_id})
+
+
+def committed_seq(db):
+    """The highest sequence below which every reserved sequence has been written
+
+    Returns None while a reservation has not learned its range yet.
+    """
+    counter = db[COUNTERS_COLLECTION].find_one({'_id': SEQ_FIELD})
+    highest = counter['value'] if counter else 0
+    cutoff = timezone.now() - timedelta(seconds=settings.SYNC_LEASE_TIMEOUT)
+    for lease in db[LEASE_COLLECTION].find({'created_at': {'$gt': cutoff}}):
+        if 'first' not in lease:
+            return None
+        highest = min(highest, lease['first'] - 1)
+    return highest
+
+
+def stamp(db, collection, ids):
+    """Give documents a new change sequence so the next sync sends them"""
+    ids = list(ids)
+    if not ids:
+        return
+    with reserve_seqs(db, len(ids)) as first:
+        db[collection].bulk_write([
+            UpdateOne({'_id': doc_id}, {'$set': {SEQ_FIELD: first + offset}})
+            for offset, doc_id in enumerate(ids)
+        ], ordered=False)
+
+
+def tombstone_id(collection, doc_id):
+    return f'{collection}:{doc_id}'
+
+
+def record_deletion(db, collection, doc_id, **fields):
+    """Tombstone a deleted document; `fields` keep what else the deleter knew about it"""
+    record_deletions(db, collection, [doc_id], **fields)
+
+
+def record_deletions(db, collection, doc_ids, **fields):
+    """Tombstone many deleted documents with one sequence reservation"""
+    doc_ids = list(doc_ids)
+    if not doc_ids:
+        return
+    now = timezone.now()
+    with reserve_seqs(db, len(doc_ids)) as first:
+        db[TOMBSTONE_COLLECTION].bulk_write([
+            UpdateOne(
+                {'_id': tombstone_id(collection, doc_id)},
+                {'$set': {
+                    **fields,
+                    'collection': collection,
+                    'ref_id': str(doc_id),
+                    SEQ_FIELD: first + offset,
+                    'deleted_at': now,
+                }},
+                upsert=True,
+            )
+            for offset, doc_id in enumerate(doc_ids)
+        ], ordered=False)
+
+
+def encode_token(seq):
+    return signing.dumps(seq, salt=TOKEN_SALT, compress=True)
+
+
+def decode_token(token):
+    """Return the sequence in a token, or None if it is invalid or too old to sync from"""
+    try:
+        return signing.loads(token, salt=TOKEN_SALT, max_age=settings.SYNC_TOKEN_MAX_AGE)
+    except signing.BadSignature:
+        return None
+
+
+def _serialize(collection, doc):
+    if collection == 'activities':
+        return serialize_rows([_make_activity(doc)])[0]
+    stringify_ids(doc)
+    doc.setdefault(LIST_DEFAULTS[collection], [])
+    return doc
+
+
+def changes_since(db, since, limit):
+    """Documents and deletions with a change sequence above `since`, oldest first
+
+    Writers reserve a sequence before writing, so a write with a lower
+    sequence can land after one with a higher sequence. Only changes up to
+    committed_seq are sent, so the returned token never skips a write that
+    is still in flight.
+    """
+    since = since or 0
+    # Read the bound before the changes: everything at or below it is visible
+    upto = committed_seq(db)
+    if upto is None or upto < since:
+        upto = since
+    query = {SEQ_FIELD: {'$gt': since, '$lte': upto}}
+    found = []
+    for collection in SYNCED_COLLECTIONS:
+        for doc in db[collection].find(query).sort(SEQ_FIELD, ASCENDING).limit(limit + 1):
+            found.append((doc.pop(SEQ_FIELD), collection, doc, None))
+    for tombstone in db[TOMBSTONE_COLLECTION].find(query).sort(SEQ_FIELD, ASCENDING).limit(limit + 1):
+        found.append((tombstone[SEQ_FIELD], tombstone['collection'], None, tombstone['ref_id']))
+    found.sort(key=lambda change: change[0])
+
+    result = {
+        'changes': {collection: [] for collection in SYNCED_COLLECTIONS},
+        'deleted': {collection: [] for collection in SYNCED_COLLECTIONS},
+        'has_more': len(found) > limit,
+    }
+    found = found[:limit]
+    for _, collection, doc, ref_id in found:
+        if doc is None:
+            result['deleted'][collection].append(ref_id)
+        else:
+            result['changes'][collection].append(_serialize(collection, doc))
+    result['token'] = encode_token(found[-1][0] if found else since)
+    return result
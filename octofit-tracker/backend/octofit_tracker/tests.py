@@ -1,8 +1,68 @@
-from django.test import TestCase
-from rest_framework.test import APITestCase
+import os
+import tempfile
+import time
+from unittest.mock import MagicMock, call, patch
+import numpy as np
+from bson import ObjectId
+from django.db.models import Q
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.test import APIRequestFactory, APITestCase
 from rest_framework import status
-from .models import User, Team, Activity, Leaderboard, Workout
-from datetime import datetime
+from . import dashboard
+from .activity_store import ARCHIVE_COLLECTION, activity_range_query, natural_key_query
+from .analytics import ActivityColumns, compute_trends
+from .changelist import EstimatedCountPaginator, keyset_filter
+from .changes import apply_activity_delete, is_stamp, needs_change_seq
+from .cursors import decode_cursor, encode_cursor
+from .feed import (
+    FEED_COLLECTION, cursor_key, fan_out, member_removed, rebuild_timeline, remove_activity, replace_activity,
+    team_feed, timeline_entries,
+)
+from .idempotency import request_fingerprint, scoped_key
+from .ids import fetch_by_ids, id_candidates, id_filter
+from .ingest import (
+    ActivityJournal, apply_once, flush_journal, ingest_paused, leaderboard_deltas, retract_activities,
+)
+from .invalidation import GenerationCounters
+from .jobs import JOB_HANDLERS, job_key
+from .leaderboard import merge_runs, partition_of, rank_key, write_run
+from .management.commands.import_profile import package_totals, parse_importtime
+from .management.commands.migrate_ids import Command as MigrateIdsCommand
+from .middleware import LoadSheddingMiddleware
+from .models import User, Team, Activity, Leaderboard, Workout, tombstone_activity
+from .mongo import get_bulk_db, get_read_db
+from .rank_history import day_index, pack_day, unpack_day, user_history, write_history_chunk
+from .ranking import PERIOD_FORMATS, bucket_key, bucket_of, estimate_rank, period_key, record_period_totals
+from .recommend import WorkoutIndex, get_workout_index, workout_removed, workout_saved
+from .replica import (
+    ReferenceReplica, refresh_reference_snapshot, request_reference_refresh, serialize_collection, write_snapshot,
+)
+from .rows import ActivityRow, LeaderboardRow, serialize_rows
+from .search import rank_matches, search_entry, search_query
+from .serializers import ActivitySerializer, LeaderboardSerializer, UserSerializer
+from .snapshot import (
+    SNAPSHOT_COLLECTIONS, WATERMARK_FILE, PartitionBuffer, load_watermarks, save_watermarks, watermark_bound,
+    watermark_query,
+)
+from .sync import committed_seq, decode_token, encode_token
+from .throttling import (
+    CacheBucketStore, LocalBucketStore, TokenBucketThrottle, get_bucket_store, take_token,
+)
+from .tokens import (
+    BearerTokenAuthentication, issue_tokens, read_access_token, read_refresh_token, revocations,
+    verify_password,
+)
+from .tracks import (
+    COORDINATE_SCALE, decode_column, decode_varints, downsample, encode_column, encode_polyline,
+    encode_varints, summarize,
+)
+from .views import ActivityViewSet, ChangeSeqMixin, search as search_view
+from datetime import date, datetime, timedelta
 
 
 class UserModelTest(TestCase):
@@ -139,3 +199,1006 @@ class WorkoutAPITest(APITestCase):
         }
         response = self.client.post(url, data, format='json')
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+
+class ActivityJournalTest(SimpleTestCase):
+    def test_append_peek_ack(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            journal = ActivityJournal(os.path.join(tmp, 'journal.sqlite3'))
+            activity_id = journal.append({
+                'user_id': 'user123',
+                'activity_type': 'Running',
+                'duration': 30,
+                'date': datetime(2024, 1, 1, 7, 30),
+            })
+            entries = journal.peek(10)
+            self.assertEqual(len(entries), 1)
+            seq, doc = entries[0]
+            self.assertEqual(str(doc['_id']), activity_id)
+            self.assertEqual(doc['date'], datetime(2024, 1, 1, 7, 30))
+            journal.ack([seq])
+            self.assertEqual(len(journal), 0)
+
+    def test_leaderboard_deltas_are_aggregated_per_user(self):
+        deltas = leaderboard_deltas([
+            {'user_id': 'user1', 'duration': 30, 'distance': 5.0, 'calories': 300},
+            {'user_id': 'user1', 'duration': 20, 'distance': None, 'calories': 100},
+            {'user_id': 'user2', 'duration': 10, 'distance': 1.0, 'calories': None},
+        ])
+        self.assertEqual(deltas['user1']['total_activities'], 2)
+        self.assertEqual(deltas['user1']['total_calories'], 400)
+        self.assertEqual(deltas['user2']['total_distance'], 1.0)
+
+
+    @override_settings(INGEST_PAUSE_POLL=60)
+    def test_pause_flag_is_read_once_per_poll_interval(self):
+        db = MagicMock()
+        with patch.dict('octofit_tracker.ingest._pause_cache', checked=None):
+            db.__getitem__.return_value.find_one.return_value = {'_id': 'rebuild'}
+            self.assertTrue(ingest_paused(db))
+            db.__getitem__.return_value.find_one.return_value = None
+            self.assertTrue(ingest_paused(db))
+        self.assertEqual(db.__getitem__.return_value.find_one.call_count, 1)
+
+    def test_flush_applies_deltas_for_what_landed_before_a_failure(self):
+        journal = MagicMock()
+        journal.peek.return_value = [(1, {'_id': ObjectId(), 'user_id': 'u1', 'calories': 100}),
+                                     (2, {'_id': ObjectId(), 'user_id': 'u2', 'calories': 200}),
+                                     (3, {'_id': ObjectId(), 'user_id': 'u3', 'calories': 300})]
+        db = MagicMock()
+        db.activities.insert_many.side_effect = BulkWriteError({'writeErrors': [
+            {'index': 1, 'code': 11000}, {'index': 2, 'code': 121}]})
+        # Entry 1 is a retry of an earlier, unacked insert; entry 2 never landed
+        db.activities.find.return_value = [{'_id': journal.peek.return_value[1][1]['_id']}]
+        db.__getitem__.return_value.find_one_and_update.return_value = {'value': 3}
+        applied = []
+        with patch('octofit_tracker.ingest.ingest_paused', return_value=False), \
+                patch('octofit_tracker.ingest.apply_once',
+                      side_effect=lambda db, kind, activities, apply: applied.extend(activities)):
+            with self.assertRaises(BulkWriteError):
+                flush_journal(db, journal, 10)
+        self.assertEqual([doc['user_id'] for doc in applied], ['u1', 'u2'])
+        journal.ack.assert_not_called()
+
+class JobRegistryTest(SimpleTestCase):
+    def test_maintenance_jobs_are_registered(self):
+        self.assertIn('recompute_ranks', JOB_HANDLERS)
+        self.assertIn('rebuild_leaderboard_totals', JOB_HANDLERS)
+
+    @override_settings(INGEST_PAUSE_POLL=0)
+    def test_leaderboard_totals_add_archived_activities_and_zero_the_rest(self):
+        db = MagicMock()
+        db.leaderboard.find.return_value.sort.return_value.limit.return_value = [
+            {'user_id': 'u1'}, {'user_id': 'u2'}]
+        live = [{'_id': 'u1', 'total_activities': 2, 'total_duration': 50, 'total_distance': 5.0,
+                 'total_calories': 400}]
+        archived = [{'_id': 'u0', 'total_activities': 1, 'total_duration': 10, 'total_distance': 1.0,
+                     'total_calories': 100}, dict(live[0], total_activities=1, total_calories=100)]
+        collections = {'activities': MagicMock(), ARCHIVE_COLLECTION: MagicMock()}
+        collections['activities'].aggregate.return_value = live
+        collections[ARCHIVE_COLLECTION].aggregate.return_value = archived
+        db.__getitem__.side_effect = lambda name: collections.get(name) or MagicMock()
+        list(JOB_HANDLERS['rebuild_leaderboard_totals'](db, {'chunk_size': 5}, None))
+        updates = {update._filter['user_id']: update._doc['$set']
+                   for update in db.leaderboard.bulk_write.call_args[0][0]}
+        self.assertEqual(sorted(updates), ['u0', 'u1', 'u2'])
+        self.assertEqual(updates['u1']['total_activities'], 3)
+        self.assertEqual(updates['u1']['total_calories'], 500)
+        self.assertEqual(updates['u2']['total_calories'], 0)
+
+    def test_job_key_ignores_param_order(self):
+        self.assertEqual(
+            job_key('recompute_ranks', {'a': 1, 'b': 2}),
+            job_key('recompute_ranks', {'b': 2, 'a': 1}),
+        )
+
+
+class ActivityRangeQueryTest(SimpleTestCase):
+    def test_range_query_uses_half_open_interval(self):
+        since = datetime(2024, 1, 1)
+        until = datetime(2024, 2, 1)
+        query = activity_range_query('user123', since, until, 'Running')
+        self.assertEqual(query, {
+            'user_id': 'user123',
+            'date': {'$gte': since, '$lt': until},
+            'activity_type': 'Running',
+        })
+
+    def test_range_query_without_bounds(self):
+        self.assertEqual(activity_range_query('user123'), {'user_id': 'user123'})
+
+
+class SearchIndexTest(SimpleTestCase):
+    def test_workout_entry_includes_exercise_names(self):
+        entry = search_entry('workout', {
+            '_id': 'w1',
+            'name': 'HIIT Workout',
+            'description': 'High intensity',
+            'exercises': [{'name': 'Jump Squats'}],
+        })
+        self.assertEqual(entry['_id'], 'workout:w1')
+        self.assertEqual(entry['label'], 'HIIT Workout')
+        self.assertIn('squats', entry['terms'])
+
+    def test_query_requires_every_token_prefix(self):
+        query = search_query('Iron  Ma', kinds=['user'])
+        self.assertEqual(len(query['$and']), 2)
+        self.assertEqual(query['$and'][0]['terms']['$elemMatch']['$gte'], 'iron')
+        self.assertEqual(query['kind'], {'$in': ['user']})
+        self.assertIsNone(search_query('  '))
+
+    def test_exact_labels_outrank_prefix_matches(self):
+        rows = [
+            {'_id': 'team:1', 'label': 'Runners Club'},
+            {'_id': 'team:2', 'label': 'Running'},
+            {'_id': 'user:3', 'label': 'run'},
+            {'_id': 'team:2', 'label': 'Running'},
+        ]
+        ranked = rank_matches('Run ', rows, 2)
+        self.assertEqual([row['_id'] for row in ranked], ['user:3', 'team:2'])
+        self.assertEqual(search_entry('user', {'_id': 3, 'username': ' Run'})['label_key'], 'run')
+
+    def test_limit_below_one_is_rejected(self):
+        request = APIRequestFactory().get('/api/search/', {'q': 'run', 'limit': '0'})
+        with patch('octofit_tracker.views.get_db') as get_db:
+            response = search_view(request)
+        self.assertEqual(response.status_code, 400)
+        get_db.assert_not_called()
+
+
+class WorkoutIndexTest(SimpleTestCase):
+    def setUp(self):
+        self.index = WorkoutIndex()
+        self.index.build([
+            {'_id': 'w1', 'name': 'Long Run', 'category': 'Cardio',
+             'difficulty_level': 'intermediate', 'duration': 60},
+            {'_id': 'w2', 'name': 'Heavy Lifting', 'category': 'Strength',
+             'difficulty_level': 'advanced', 'duration': 45},
+        ])
+
+    def test_recent_activity_mix_drives_ranking(self):
+        runner = [{'activity_type': 'Running', 'duration': 60, 'calories': 500}] * 3
+        ranked = [doc['_id'] for doc, _ in self.index.recommend(runner)]
+        self.assertEqual(ranked, ['w1', 'w2'])
+
+    def test_incremental_upsert_and_remove(self):
+        self.index.upsert({'_id': 'w3', 'name': 'Laps', 'category': 'Swimming', 'duration': 30})
+        swimmer = [{'activity_type': 'Swimming', 'duration': 30, 'calories': 200}]
+        self.assertEqual(self.index.recommend(swimmer, limit=1)[0][0]['_id'], 'w3')
+        self.index.remove('w1')
+        self.assertEqual(sorted(self.index.ids), ['w2', 'w3'])
+        self.assertEqual(self.index.matrix.shape[0], 2)
+
+    def test_own_writes_do_not_force_a_rebuild(self):
+        db = MagicMock()
+        db.workouts.find.return_value = [{'_id': 'w1', 'name': 'Long Run', 'category': 'Cardio'}]
+        with patch('octofit_tracker.recommend._index', WorkoutIndex()), \
+                patch('octofit_tracker.recommend.generation', return_value=4):
+            get_workout_index(db, 300)
+            workout_saved({'_id': 'w2', 'name': 'Laps', 'category': 'Swimming'}, published=5)
+            with patch('octofit_tracker.recommend.generation', return_value=5):
+                index = get_workout_index(db, 300)
+            # Someone else's write in between: the next read rebuilds
+            workout_removed('w2', published=7)
+            with patch('octofit_tracker.recommend.generation', return_value=7):
+                get_workout_index(db, 300)
+        self.assertEqual(sorted(index.ids), ['w1'])
+        self.assertEqual(db.workouts.find.call_count, 2)
+
+
+class TrendsTest(SimpleTestCase):
+    def test_streaks_and_personal_bests(self):
+        columns = ActivityColumns.from_documents([
+            {'date': datetime(2024, 1, day), 'activity_type': 'Running',
+             'duration': 30, 'distance': 5.0, 'calories': 100 * day}
+            for day in (1, 2, 3, 5, 6)
+        ])
+        trends = compute_trends(columns, metric='calories', window=2, today=date(2024, 1, 6))
+        running = trends['types']['running']
+        self.assertEqual(running['longest_streak'], 3)
+        self.assertEqual(running['current_streak'], 2)
+        self.assertEqual(running['personal_bests']['calories'],
+                         {'value': 600.0, 'date': '2024-01-06'})
+        self.assertEqual(running['moving_average']['values'][-1], 550.0)
+        self.assertEqual(trends['types']['all']['weekly_totals']['values'], [1700.0])
+
+    def test_tied_personal_bests_date_from_the_first_time(self):
+        columns = ActivityColumns.from_documents([
+            {'date': datetime(2024, 1, day), 'activity_type': 'Running',
+             'duration': 30, 'distance': 5.0, 'calories': 400}
+            for day in (9, 3, 6)
+        ])
+        trends = compute_trends(columns, metric='calories', today=date(2024, 1, 10))
+        self.assertEqual(trends['types']['running']['personal_bests']['calories'],
+                         {'value': 400.0, 'date': '2024-01-03'})
+
+    def test_unknown_metric_is_rejected(self):
+        with self.assertRaises(ValueError):
+            compute_trends(ActivityColumns.from_documents([]), metric='steps')
+
+
+class SnapshotPartitionTest(SimpleTestCase):
+    def test_activities_are_grouped_by_month_and_team(self):
+        buffer = PartitionBuffer('activities', SNAPSHOT_COLLECTIONS['activities'],
+                                 lambda doc: {'1': 'team1'}.get(doc['user_id']))
+        buffer.add({'_id': 1, 'user_id': '1', 'activity_type': 'running', 'duration': 30,
+                    'calories': 250, 'date': datetime(2024, 3, 5)})
+        buffer.add({'_id': 2, 'user_id': '2', 'activity_type': 'cycling', 'duration': 60,
+                    'date': datetime(2024, 4, 1)})
+        partitions = buffer.drain()
+        self.assertEqual(set(partitions), {('2024-03', 'team1'), ('2024-04', 'none')})
+        row = partitions[('2024-03', 'team1')][0]
+        self.assertEqual(row['_id'], '1')
+        self.assertEqual(row['calories'], 250.0)
+        self.assertEqual(buffer.size, 0)
+
+    def test_watermarks_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            save_watermarks(tmp, {'leaderboard': datetime(2024, 3, 5, 12, 0)})
+            self.assertEqual(load_watermarks(tmp), {'leaderboard': datetime(2024, 3, 5, 12, 0)})
+
+    def test_activities_are_exported_by_change_sequence(self):
+        spec = SNAPSHOT_COLLECTIONS['activities']
+        self.assertEqual(watermark_query(spec, 41, 50), {'change_seq': {'$lte': 50, '$gt': 41}})
+        self.assertEqual(watermark_query(spec, None, 50), {'change_seq': {'$lte': 50}})
+
+    @override_settings(SNAPSHOT_WATERMARK_LAG=60)
+    def test_exports_stop_short_of_uncommitted_writes(self):
+        db = MagicMock()
+        db.__getitem__.return_value.find_one.return_value = {'value': 10}
+        db.__getitem__.return_value.find.return_value = [{'first': 8}]
+        self.assertEqual(watermark_bound(db, SNAPSHOT_COLLECTIONS['activities']), 7)
+        bound = watermark_bound(db, SNAPSHOT_COLLECTIONS['leaderboard'])
+        self.assertLessEqual(bound, timezone.now() - timedelta(seconds=60))
+
+    def test_watermarks_of_a_previous_field_are_dropped(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, WATERMARK_FILE), 'w') as f:
+                f.write('{"activities": {"type": "ObjectId", "value": "%s"}}' % ObjectId())
+            self.assertEqual(load_watermarks(tmp), {})
+            save_watermarks(tmp, {'activities': 41})
+            self.assertEqual(load_watermarks(tmp), {'activities': 41})
+
+
+class ReferenceReplicaTest(SimpleTestCase):
+    def test_snapshot_is_served_and_remapped_after_replace(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'reference.snapshot')
+            write_snapshot(path, {
+                'teams': serialize_collection([{'_id': 1, 'name': 'Team Marvel'}], 'members', []),
+                'workouts': b'[]',
+            })
+            replica = ReferenceReplica(path)
+            self.assertEqual(bytes(replica.get('teams')),
+                             b'[{"_id":1,"name":"Team Marvel","id":"1","members":[]}]')
+            self.assertIsNone(replica.get('users'))
+
+            write_snapshot(path, {'teams': b'[]', 'workouts': b'[]'})
+            self.assertEqual(bytes(replica.get('teams')), b'[]')
+
+    def test_refresh_skips_when_generations_are_unchanged(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'reference.snapshot')
+            generations = {'teams': 3, 'workouts': 1}
+
+            def build(db, path):
+                write_snapshot(path, {'teams': b'[]', 'workouts': b'[]'})
+
+            with override_settings(REFERENCE_SNAPSHOT_ENABLED=True, REFERENCE_SNAPSHOT_PATH=path), \
+                    patch('octofit_tracker.replica.generation', side_effect=generations.get), \
+                    patch('octofit_tracker.replica.build_snapshot', side_effect=build) as build_snapshot:
+                refresh_reference_snapshot(None)
+                refresh_reference_snapshot(None)
+                generations['teams'] = 4
+                refresh_reference_snapshot(None)
+            self.assertEqual(build_snapshot.call_count, 2)
+
+    @override_settings(REFERENCE_SNAPSHOT_ENABLED=True)
+    def test_writes_queue_one_background_refresh(self):
+        with patch('octofit_tracker.replica._refresh_queued', False), \
+                patch('octofit_tracker.replica._refresher') as refresher:
+            request_reference_refresh()
+            request_reference_refresh()
+        refresher.submit.assert_called_once()
+
+
+class CompactRowTest(SimpleTestCase):
+    def test_activity_rows_serialize_like_the_model_serializer(self):
+        values = dict(user_id='user123', activity_type='Running', duration=30, distance=5.0,
+                      calories=300, date=datetime(2024, 1, 1, 7, 30), notes='')
+        activity = Activity(_id='a' * 24, **values)
+        row = ActivityRow(id='a' * 24, **values)
+        self.assertEqual(serialize_rows([row]), [dict(ActivitySerializer(activity).data)])
+
+    def test_leaderboard_rows_serialize_like_the_model_serializer(self):
+        values = dict(user_id='user1', team_id=None, total_activities=3, total_duration=90,
+                      total_distance=12.5, total_calories=900, rank=1,
+                      last_updated=datetime(2024, 1, 2))
+        entry = Leaderboard(_id='b' * 24, **values)
+        row = LeaderboardRow(id='b' * 24, **values)
+        self.assertEqual(serialize_rows([row]), [dict(LeaderboardSerializer(entry).data)])
+
+
+class IdConversionTest(SimpleTestCase):
+    def test_object_id_string_is_a_single_point_read(self):
+        oid = ObjectId()
+        with override_settings(LEGACY_ID_LOOKUPS=False):
+            self.assertEqual(id_filter(str(oid)), oid)
+
+    def test_legacy_forms_are_included_until_migrated(self):
+        with override_settings(LEGACY_ID_LOOKUPS=True):
+            self.assertEqual(id_candidates('7'), [7, '7'])
+            self.assertEqual(id_filter('7'), {'$in': [7, '7']})
+
+
+class IdempotencyTest(SimpleTestCase):
+    def test_fingerprint_ignores_key_order(self):
+        first = request_fingerprint({'user_id': '1', 'duration': 30})
+        self.assertEqual(first, request_fingerprint({'duration': 30, 'user_id': '1'}))
+        self.assertNotEqual(first, request_fingerprint({'user_id': '1', 'duration': 31}))
+
+    def test_keys_are_scoped_to_the_endpoint_and_client(self):
+        factory = APIRequestFactory()
+        activities = factory.post('/api/activities/', REMOTE_ADDR='10.0.0.1')
+        self.assertNotEqual(scoped_key(activities, 'abc'),
+                            scoped_key(factory.post('/api/teams/', REMOTE_ADDR='10.0.0.1'), 'abc'))
+        self.assertNotEqual(scoped_key(activities, 'abc'),
+                            scoped_key(factory.post('/api/activities/', REMOTE_ADDR='10.0.0.2'), 'abc'))
+        activities.user = MagicMock(is_authenticated=True, pk=7)
+        self.assertEqual(scoped_key(activities, 'abc'), 'user:7:/api/activities/:abc')
+
+    def test_natural_key_covers_retry_fields(self):
+        activity = {'user_id': '1', 'activity_type': 'running', 'date': datetime(2024, 1, 1),
+                    'duration': 30, 'notes': 'retried'}
+        self.assertEqual(natural_key_query(activity), {
+            'user_id': '1', 'activity_type': 'running', 'date': datetime(2024, 1, 1), 'duration': 30,
+        })
+
+
+class RateLimitTest(SimpleTestCase):
+    def test_burst_then_refill(self):
+        state = None
+        for _ in range(3):
+            allowed, state, _ = take_token(state, 0.0, rate=1, burst=3)
+            self.assertTrue(allowed)
+        allowed, state, wait = take_token(state, 0.0, rate=1, burst=3)
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(wait, 1.0)
+        allowed, _, _ = take_token(state, 1.0, rate=1, burst=3)
+        self.assertTrue(allowed)
+
+    def test_shared_buckets_use_the_wall_clock(self):
+        self.assertIs(CacheBucketStore.clock, time.time)
+        # A host whose clock is behind the last writer's does not refill backwards
+        allowed, state, _ = take_token((1.0, 100.0), 99.0, rate=1, burst=3)
+        self.assertTrue(allowed)
+        self.assertEqual(state[0], 0.0)
+
+    def test_local_store_separates_keys(self):
+        store = LocalBucketStore()
+        self.assertTrue(store.take('a', 0.0, 1, 1)[0])
+        self.assertFalse(store.take('a', 0.0, 1, 1)[0])
+        self.assertTrue(store.take('b', 0.0, 1, 1)[0])
+
+    @override_settings(RATE_LIMIT_STORE='cache')
+    def test_cache_store_refuses_a_per_process_cache(self):
+        with self.assertRaises(ImproperlyConfigured):
+            get_bucket_store()
+
+    def test_cache_store_takes_under_a_lock(self):
+        store = CacheBucketStore(LocMemCache('throttle-test', {}))
+        self.assertTrue(store.take('a', 0.0, 1, 1)[0])
+        self.assertFalse(store.take('a', 0.0, 1, 1)[0])
+        self.assertIsNone(store.cache.get('a:lock'))
+        store.cache.add('b:lock', 1)
+        with patch('octofit_tracker.throttling.time.sleep'):
+            self.assertFalse(store.take('b', 0.0, 1, 1)[0])
+
+    def test_writes_have_their_own_bucket(self):
+        throttle = TokenBucketThrottle()
+        factory = APIRequestFactory()
+        self.assertEqual(throttle.endpoint(factory.get('/api/activities/'), MagicMock()), 'MagicMock')
+        self.assertEqual(throttle.endpoint(factory.post('/api/activities/'), MagicMock()), 'MagicMock:write')
+
+    @override_settings(LOAD_SHED_DB_LATENCY_MS=100)
+    def test_shed_probability_grows_with_latency(self):
+        middleware = LoadSheddingMiddleware(lambda request: None)
+        self.assertEqual(middleware.shed_probability(80), 0.0)
+        self.assertAlmostEqual(middleware.shed_probability(150), 0.5)
+        self.assertEqual(middleware.shed_probability(1000), 0.9)
+
+
+class ImportProfileTest(SimpleTestCase):
+    def test_parse_importtime_output(self):
+        output = '\n'.join([
+            'import time: self [us] | cumulative | imported package',
+            'import time:       120 |        120 |     numpy.core',
+            'import time:      1251 |       1371 |   numpy',
+            'import time:        80 |       1451 | octofit_tracker.analytics',
+        ])
+        rows = parse_importtime(output)
+        self.assertEqual(rows[1], ('numpy', 1251, 1371, 1))
+        self.assertEqual(package_totals(rows), [('numpy', 1371), ('octofit_tracker', 80)])
+
+
+class MongoOptionsTest(SimpleTestCase):
+    @override_settings(MONGO_READ_PREFERENCES={'leaderboard': 'secondaryPreferred'})
+    def test_read_preference_per_endpoint_group(self):
+        self.assertEqual(get_read_db('leaderboard').read_preference.mongos_mode, 'secondaryPreferred')
+        self.assertEqual(get_read_db('teams').read_preference.mongos_mode, 'primary')
+
+    @override_settings(MONGO_BULK_WRITE_CONCERN={'w': 'majority', 'j': True})
+    def test_bulk_write_concern(self):
+        self.assertEqual(get_bulk_db().write_concern.document, {'w': 'majority', 'j': True})
+
+
+class GenerationCountersTest(SimpleTestCase):
+    def test_bumps_are_visible_to_other_mappings(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'generations')
+            writer, reader = GenerationCounters(path), GenerationCounters(path)
+            self.assertEqual(reader.get('workouts'), 0)
+            writer.bump('workouts')
+            self.assertEqual(writer.bump('workouts'), 2)
+            self.assertEqual(reader.get('workouts'), 2)
+            self.assertEqual(reader.get('teams'), 0)
+
+
+class SyncTokenTest(SimpleTestCase):
+    def test_token_round_trip(self):
+        self.assertEqual(decode_token(encode_token(42)), 42)
+
+    def test_tampered_or_expired_tokens_force_a_reset(self):
+        self.assertIsNone(decode_token(encode_token(42) + 'x'))
+        token = encode_token(42)
+        with override_settings(SYNC_TOKEN_MAX_AGE=-1):
+            self.assertIsNone(decode_token(token))
+
+    def test_tokens_stop_below_sequences_still_being_written(self):
+        db = MagicMock()
+        db.__getitem__.return_value.find_one.return_value = {'value': 10}
+        db.__getitem__.return_value.find.return_value = [{'first': 7}, {'first': 9}]
+        self.assertEqual(committed_seq(db), 6)
+        db.__getitem__.return_value.find.return_value = [{'first': 7}, {}]
+        self.assertIsNone(committed_seq(db))
+        db.__getitem__.return_value.find.return_value = []
+        self.assertEqual(committed_seq(db), 10)
+
+    def test_only_writes_without_a_fresh_sequence_are_stamped(self):
+        stamp_event = {'operationType': 'update',
+                       'updateDescription': {'updatedFields': {'change_seq': 7}, 'removedFields': []}}
+        admin_edit = {'operationType': 'update',
+                      'updateDescription': {'updatedFields': {'notes': 'x'}, 'removedFields': []}}
+        api_insert = {'operationType': 'insert', 'fullDocument': {'_id': 1, 'change_seq': 3}}
+        self.assertTrue(is_stamp(stamp_event))
+        self.assertFalse(is_stamp(admin_edit))
+        self.assertTrue(needs_change_seq(admin_edit))
+        self.assertFalse(needs_change_seq(api_insert))
+        self.assertTrue(needs_change_seq({'operationType': 'insert', 'fullDocument': {'_id': 2}}))
+
+
+class ActivityDeleteTest(SimpleTestCase):
+    activity = {'_id': ObjectId(), 'user_id': 'u1', 'duration': 30, 'distance': 5.0, 'calories': 300,
+                'date': datetime(2024, 5, 1)}
+
+    def test_retract_decrements_totals(self):
+        db = MagicMock()
+        db.__getitem__.return_value.find_one_and_update.return_value = {'calories': 1000}
+        with patch('octofit_tracker.ingest.publish'):
+            retract_activities(db, [self.activity])
+        update = db.leaderboard.bulk_write.call_args[0][0][0]
+        self.assertEqual(update._doc['$inc'], {'total_activities': -1, 'total_duration': -30,
+                                               'total_distance': -5.0, 'total_calories': -300})
+        self.assertEqual(db.__getitem__.return_value.find_one_and_update.call_args[0][1]['$inc']['calories'], -300)
+        db.__getitem__.return_value.update_many.assert_called_once()  # pulled from team timelines
+
+    def test_retract_moves_the_user_down_a_bucket(self):
+        db = MagicMock()
+        db.__getitem__.return_value.find_one_and_update.return_value = {'calories': 1000}
+        record_period_totals(db, [self.activity], sign=-1)
+        histograms = db.__getitem__.return_value.bulk_write.call_args[0][0]
+        moves = {update._filter['_id']: update._doc['$inc'] for update in histograms}
+        self.assertEqual(moves['calories:all'], {f'counts.{bucket_key(bucket_of(1000))}': -1,
+                                                 f'counts.{bucket_key(bucket_of(700))}': 1})
+
+    def test_archive_moves_change_nothing(self):
+        db = MagicMock()
+        db.__getitem__.return_value.find_one.return_value = {'_id': self.activity['_id']}
+        with patch('octofit_tracker.changes.jobs.enqueue') as enqueue:
+            apply_activity_delete(db, self.activity['_id'])
+        enqueue.assert_not_called()
+        db.leaderboard.bulk_write.assert_not_called()
+
+    def test_api_deletes_refresh_the_noted_owner(self):
+        db = MagicMock()
+        db.__getitem__.return_value.find_one.side_effect = [None, {'user_id': 'u1', 'source': 'api'}]
+        db.__getitem__.return_value.aggregate.return_value = []
+        with patch('octofit_tracker.changes.jobs.enqueue') as enqueue:
+            apply_activity_delete(db, self.activity['_id'])
+        enqueue.assert_not_called()
+        self.assertEqual(db.leaderboard.bulk_write.call_args[0][0][0]._filter, {'user_id': 'u1'})
+
+    def test_admin_deletes_are_retracted_once(self):
+        db = MagicMock()
+        store = db.__getitem__.return_value
+        store.find_one.side_effect = [None, {'user_id': 'u1', 'activity': self.activity}] * 2
+        store.find_one_and_update.return_value = {'calories': 1000}
+        store.insert_many.side_effect = [None, BulkWriteError({'writeErrors': [{'index': 0, 'code': 11000}]})]
+        store.find.return_value = []
+        with patch('octofit_tracker.ingest.publish'), patch('octofit_tracker.changes.jobs.enqueue') as enqueue:
+            apply_activity_delete(db, self.activity['_id'])
+            apply_activity_delete(db, self.activity['_id'])
+        enqueue.assert_not_called()
+        self.assertEqual(db.leaderboard.bulk_write.call_count, 1)
+        self.assertEqual(db.leaderboard.bulk_write.call_args[0][0][0]._doc['$inc']['total_calories'], -300)
+
+    def test_a_change_interrupted_part_way_is_recomputed(self):
+        db = MagicMock()
+        store = db.__getitem__.return_value
+        store.insert_many.side_effect = BulkWriteError({'writeErrors': [{'index': 0, 'code': 11000}]})
+        store.find.return_value = [{'_id': f'insert:{self.activity["_id"]}'}]
+        store.aggregate.return_value = []
+        apply = MagicMock()
+        apply_once(db, 'insert', [self.activity], apply)
+        apply.assert_not_called()
+        self.assertEqual(db.leaderboard.bulk_write.call_args[0][0][0]._filter, {'user_id': 'u1'})
+        store.delete_many.assert_called_once_with({'user_id': {'$in': ['u1']}})
+
+    def test_orm_deletes_are_tombstoned_with_the_activity(self):
+        instance = Activity(_id=self.activity['_id'], user_id='u1', activity_type='run', duration=30,
+                            distance=5.0, calories=300, date=datetime(2024, 5, 1))
+        instance.tombstone_fields = {'source': 'api'}
+        with patch('octofit_tracker.mongo.get_db'), patch('octofit_tracker.sync.record_deletion') as record:
+            tombstone_activity(Activity, instance)
+        args, fields = record.call_args
+        self.assertEqual(args[1:], ('activities', self.activity['_id']))
+        self.assertEqual(fields['user_id'], 'u1')
+        self.assertEqual(fields['activity']['calories'], 300)
+        self.assertEqual(fields['source'], 'api')
+
+    def test_api_deletes_are_tombstoned_once(self):
+        instance = MagicMock(pk=self.activity['_id'])
+        with patch('octofit_tracker.views.record_deletion') as record, \
+                patch('octofit_tracker.views.publish'), patch('octofit_tracker.views.get_db'):
+            with patch('rest_framework.mixins.DestroyModelMixin.perform_destroy'):
+                ChangeSeqMixin.perform_destroy(ActivityViewSet(), instance)
+            record.assert_not_called()
+            self.assertEqual(instance.tombstone_fields, {'source': 'api'})
+
+    def test_direct_deletes_queue_rebuilds(self):
+        db = MagicMock()
+        db.__getitem__.return_value.find_one.return_value = None
+        with patch('octofit_tracker.changes.jobs.enqueue') as enqueue:
+            apply_activity_delete(db, self.activity['_id'])
+        self.assertEqual([call[0][1] for call in enqueue.call_args_list],
+                         ['rebuild_leaderboard_totals', 'rebuild_rank_histograms'])
+
+
+class DashboardTest(SimpleTestCase):
+    def test_sections_run_concurrently_and_fail_independently(self):
+        def slow(user_id):
+            time.sleep(0.2)
+            return user_id
+
+        def broken(user_id):
+            raise ValueError('boom')
+
+        sections = {'a': slow, 'b': slow, 'c': slow, 'd': broken}
+        with patch.dict(dashboard.SECTIONS, sections, clear=True):
+            start = time.monotonic()
+            payload = dashboard.build_dashboard('u1')
+            elapsed = time.monotonic() - start
+        self.assertLess(elapsed, 0.5)
+        self.assertEqual(payload['a'], 'u1')
+        self.assertIsNone(payload['d'])
+        self.assertEqual(payload['errors'], {'d': 'boom'})
+
+    def test_cache_key_ignores_busy_collections(self):
+        with patch('octofit_tracker.dashboard.generation', return_value=0):
+            key = dashboard.cache_key('u1')
+        with patch('octofit_tracker.dashboard.generation', side_effect=lambda name: 7 if name == 'teams' else 0):
+            self.assertNotEqual(dashboard.cache_key('u1'), key)
+        self.assertNotIn('activities', dashboard.DEPENDS_ON)
+        self.assertNotIn('leaderboard', dashboard.DEPENDS_ON)
+
+    def test_etag_tracks_payload(self):
+        self.assertEqual(dashboard.payload_etag({'a': 1}), dashboard.payload_etag({'a': 1}))
+        self.assertNotEqual(dashboard.payload_etag({'a': 1}), dashboard.payload_etag({'a': 2}))
+
+
+class FetchByIdsTest(SimpleTestCase):
+    class Collection:
+        def __init__(self, docs):
+            self.docs = docs
+            self.queries = []
+
+        def find(self, query, projection=None):
+            self.queries.append(query)
+            wanted = query['_id']['$in']
+            return [doc for doc in self.docs if doc['_id'] in wanted]
+
+    @override_settings(LEGACY_ID_LOOKUPS=True)
+    def test_one_query_in_request_order(self):
+        first, second = ObjectId(), ObjectId()
+        collection = self.Collection([{'_id': first}, {'_id': second}, {'_id': 7}])
+        docs = fetch_by_ids(collection, [str(second), '7', 'missing', str(first), str(second)])
+        self.assertEqual(len(collection.queries), 1)
+        self.assertEqual([doc and doc['_id'] for doc in docs], [second, 7, None, first, second])
+        self.assertIsNot(docs[0], docs[4])
+
+
+class MigrateIdsTest(SimpleTestCase):
+    class Collection:
+        """Just enough of a collection to move documents, with optional unique fields"""
+
+        def __init__(self, docs=(), unique=()):
+            self.docs = [dict(doc) for doc in docs]
+            self.unique = unique
+
+        def _matches(self, doc, query):
+            for field, value in query.items():
+                if isinstance(value, dict) and '$not' in value:
+                    if isinstance(doc.get(field), ObjectId):
+                        return False
+                elif isinstance(value, dict) and '$exists' in value:
+                    if (field in doc) != value['$exists']:
+                        return False
+                elif doc.get(field) != value:
+                    return False
+            return True
+
+        def find(self, query):
+            matches = [doc for doc in self.docs if self._matches(doc, query)]
+            cursor = MagicMock()
+            cursor.__iter__.side_effect = lambda: iter(matches)
+            cursor.limit.side_effect = lambda n: matches[:n]
+            return cursor
+
+        def find_one(self, query, projection=None):
+            return next((dict(doc) for doc in self.docs if self._matches(doc, query)), None)
+
+        def insert_one(self, doc):
+            for field in ('_id',) + self.unique:
+                if any(other.get(field) == doc.get(field) for other in self.docs):
+                    raise DuplicateKeyError(f'duplicate {field}')
+            self.docs.append(dict(doc))
+
+        def delete_one(self, query):
+            self.docs = [doc for doc in self.docs if not self._matches(doc, query)]
+
+        def update_one(self, query, update, upsert=False):
+            doc = self.find_one(query)
+            if doc is None:
+                doc = dict(query, _id=ObjectId(), **update.get('$setOnInsert', {}))
+                self.docs.append(doc)
+            else:
+                doc = next(other for other in self.docs if self._matches(other, query))
+            doc.update(update.get('$set', {}))
+            for field in update.get('$unset', {}):
+                doc.pop(field, None)
+
+    def make_db(self, users):
+        collections = {'users': users, 'id_migrations': self.Collection()}
+        db = MagicMock()
+        db.__getitem__.side_effect = collections.__getitem__
+        db.id_migrations = collections['id_migrations']
+        return db
+
+    def test_unique_secondary_index_keeps_every_document(self):
+        users = self.Collection([{'_id': 1, 'email': 'a@x.io'}, {'_id': 2, 'email': 'b@x.io'}], unique=('email',))
+        db = self.make_db(users)
+        self.assertEqual(MigrateIdsCommand()._migrate_collection(db, 'users', 10), 2)
+        self.assertEqual(sorted(doc['email'] for doc in users.docs), ['a@x.io', 'b@x.io'])
+        self.assertTrue(all(isinstance(doc['_id'], ObjectId) for doc in users.docs))
+        self.assertFalse(any('doc' in entry for entry in db.id_migrations.docs))
+
+    def test_real_conflict_restores_the_original(self):
+        users = self.Collection([{'_id': 1, 'email': 'a@x.io'}], unique=('email',))
+        db = self.make_db(users)
+        users.insert_one = MagicMock(side_effect=[DuplicateKeyError('email'), None])
+        with self.assertRaises(DuplicateKeyError):
+            MigrateIdsCommand()._migrate_collection(db, 'users', 10)
+        users.insert_one.assert_called_with({'_id': 1, 'email': 'a@x.io'})
+        self.assertIn('doc', db.id_migrations.docs[0])
+
+
+class RankHistogramTest(SimpleTestCase):
+    def test_rank_is_within_the_reported_error(self):
+        values = [(i * 7919) % 5000 + 1 for i in range(2000)]
+        counts = {}
+        for value in values:
+            key = bucket_key(bucket_of(value))
+            counts[key] = counts.get(key, 0) + 1
+        for value in values[:50]:
+            exact = sum(1 for other in values if other > value) + 1
+            estimate = estimate_rank(counts, value)
+            self.assertEqual(estimate['users'], len(values))
+            self.assertLessEqual(abs(estimate['rank'] - exact), estimate['rank_error'] + 1)
+
+    def test_zero_values_tie_at_the_bottom(self):
+        counts = {bucket_key(bucket_of(100)): 3, bucket_key(None): 2}
+        self.assertEqual(estimate_rank(counts, 0)['rank'], 4)
+
+    def test_period_keys(self):
+        when = datetime(2024, 12, 30)
+        self.assertEqual(period_key('month', when), 'month:2024-12')
+        self.assertEqual(period_key('week', when), 'week:2025-W01')
+        self.assertEqual(period_key('all', when), 'all')
+
+    def test_server_side_period_keys_match(self):
+        for when in (datetime(2024, 12, 30), datetime(2021, 1, 3), datetime(2024, 5, 6)):
+            for period, format in PERIOD_FORMATS.items():
+                self.assertEqual(when.strftime(format), period_key(period, when))
+
+    @override_settings(INGEST_PAUSE_POLL=0)
+    def test_rebuild_sets_totals_then_counts_histograms(self):
+        db = MagicMock()
+        db.leaderboard.find.return_value.sort.return_value.limit.side_effect = [[{'user_id': 'u1'}], []]
+        store = db.__getitem__.return_value
+        live = [{'_id': {'user_id': 'u1', 'period': 'all'}, 'calories': 300, 'duration': 30,
+                 'distance': 5.0, 'activities': 1}]
+        archived = [dict(live[0], calories=200)]
+        histogram = [{'_id': {'period': 'all', 'bucket': bucket_of(500)}, 'users': 1}]
+        store.aggregate.side_effect = [live, archived] + [histogram] * 4
+        handler = JOB_HANDLERS['rebuild_rank_histograms']
+        checkpoints = [checkpoint for checkpoint, _ in handler(db, {}, None)]
+        self.assertEqual(checkpoints[0], {'phase': 'totals', 'user_id': 'u1'})
+        self.assertEqual(checkpoints[-1], {'phase': 'histograms', 'metric': 4})
+        totals = store.insert_many.call_args_list[0][0][0]
+        self.assertEqual(totals[0]['_id'], 'u1:all')
+        self.assertEqual(totals[0]['calories'], 500)
+        store.delete_many.assert_any_call({'user_id': {'$in': ['u1']}})
+        self.assertEqual(store.insert_many.call_args_list[1][0][0][0]['counts'], {bucket_key(bucket_of(500)): 1})
+        # Paused around the totals chunk and each metric
+        self.assertEqual(store.update_one.call_args[0][0], {'_id': 'rebuild_rank_histograms'})
+        self.assertEqual(store.delete_one.call_args_list, [call({'_id': 'rebuild_rank_histograms'})] * 5)
+
+
+class RankHistoryTest(SimpleTestCase):
+    def test_packed_day_round_trip(self):
+        packed = pack_day(7, {'total_calories': 1200.25, 'total_duration': 90, 'total_distance': 3.5})
+        self.assertEqual(len(packed), 40)
+        self.assertEqual(unpack_day(packed), (7, {'total_calories': 1200.25, 'total_duration': 90,
+                                                  'total_distance': 3.5, 'total_activities': 0}))
+
+    def test_float_totals_are_packed(self):
+        packed = pack_day(3, {'total_calories': 10, 'total_duration': 89.6, 'total_activities': 2.0})
+        self.assertEqual(unpack_day(packed)[1]['total_duration'], 90)
+        self.assertEqual(unpack_day(packed)[1]['total_calories'], 10.0)
+
+    def test_day_index_covers_leap_years(self):
+        self.assertEqual(day_index(date(2024, 1, 1)), 0)
+        self.assertEqual(day_index(date(2024, 12, 31)), 365)
+
+    def test_a_day_is_one_field_per_user(self):
+        db = MagicMock()
+        write_history_chunk(db, date(2024, 2, 1), 11, [{'user_id': 'u1', 'total_calories': 500}])
+        update = db.__getitem__.return_value.bulk_write.call_args[0][0][0]
+        self.assertEqual(update._filter, {'_id': 'u1:2024'})
+        self.assertEqual(list(update._doc['$set']), ['days.31'])
+        db.__getitem__.return_value.find.return_value = [
+            {'year': 2024, 'days': {'31': update._doc['$set']['days.31']}}]
+        history = user_history(db, 'u1', date(2024, 1, 30), date(2024, 2, 2))
+        self.assertEqual([(entry['date'], entry['rank'], entry['total_calories']) for entry in history],
+                         [('2024-02-01', 11, 500.0)])
+
+
+class LeaderboardRebuildTest(SimpleTestCase):
+    def test_partition_is_stable_and_in_range(self):
+        user_id = str(ObjectId())
+        self.assertEqual(partition_of(user_id, 8), partition_of(user_id, 8))
+        self.assertTrue(all(0 <= partition_of(str(n), 8) < 8 for n in range(100)))
+
+    def test_merge_runs_orders_by_calories_then_id(self):
+        ids = [ObjectId() for _ in range(6)]
+        calories = [50, 300, 50, 10, 300, 120]
+        rows = [{'_id': _id, 'total_calories': kcal} for _id, kcal in zip(ids, calories)]
+        with tempfile.TemporaryDirectory() as directory:
+            runs = [write_run(sorted(rows[start:start + 2], key=rank_key), directory)
+                    for start in range(0, len(rows), 2)]
+            merged = list(merge_runs(runs, directory, fan_in=2))
+        self.assertEqual([row['_id'] for row in merged],
+                         [row['_id'] for row in sorted(rows, key=rank_key)])
+        self.assertEqual([row['total_calories'] for row in merged], [300, 300, 120, 50, 50, 10])
+
+
+class TokenAuthTest(SimpleTestCase):
+    def authenticate(self, token):
+        request = APIRequestFactory().get('/api/users/', HTTP_AUTHORIZATION=f'Bearer {token}')
+        return BearerTokenAuthentication().authenticate(request)
+
+    def test_access_token_authenticates_without_a_database_read(self):
+        user_id = ObjectId()
+        tokens = issue_tokens(user_id)
+        with patch.object(revocations, 'is_revoked', return_value=False):
+            user, claims = self.authenticate(tokens['access'])
+        self.assertTrue(user.is_authenticated)
+        self.assertEqual(user.pk, str(user_id))
+
+    def test_refresh_token_is_not_an_access_token(self):
+        tokens = issue_tokens(ObjectId())
+        self.assertIsNone(read_access_token(tokens['refresh']))
+        self.assertIsNotNone(read_refresh_token(tokens['refresh']))
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(tokens['refresh'])
+
+    def test_revoked_token_is_rejected(self):
+        tokens = issue_tokens(ObjectId())
+        with patch.object(revocations, 'is_revoked', return_value=True):
+            with self.assertRaises(AuthenticationFailed):
+                self.authenticate(tokens['access'])
+
+    def test_plain_text_password_is_upgraded_on_login(self):
+        db = MagicMock()
+        user = {'_id': ObjectId(), 'password': 'apipass123'}
+        self.assertFalse(verify_password(db, user, 'wrong'))
+        self.assertTrue(verify_password(db, user, 'apipass123'))
+        stored = db.users.update_one.call_args[0][1]['$set']['password']
+        self.assertTrue(verify_password(db, dict(user, password=stored), 'apipass123'))
+
+    def test_serializer_hashes_password(self):
+        serializer = UserSerializer()
+        with patch.object(User.objects, 'create', side_effect=lambda **data: data):
+            created = serializer.create({'username': 'u', 'email': 'u@example.com', 'password': 'secret'})
+        self.assertNotEqual(created['password'], 'secret')
+        self.assertTrue(created['password'].startswith('pbkdf2_sha256$'))
+
+
+class AdminChangelistTest(SimpleTestCase):
+    def test_cursor_round_trips_dates_and_object_ids(self):
+        values = [timezone.now().replace(microsecond=0), ObjectId()]
+        self.assertEqual(decode_cursor(encode_cursor(values)), values)
+        self.assertIsNone(decode_cursor('not a cursor'))
+
+    def test_keyset_filter_continues_after_last_row(self):
+        when, last_id = timezone.now(), ObjectId()
+        matches = keyset_filter(('-date', '-_id'), [when, last_id])
+        self.assertEqual(matches, Q(date__lt=when) | Q(date=when, _id__lt=last_id))
+
+    def test_unfiltered_count_is_estimated(self):
+        with patch('octofit_tracker.changelist.get_db') as get_db:
+            get_db.return_value.__getitem__.return_value.estimated_document_count.return_value = 50_000_000
+            paginator = EstimatedCountPaginator(Activity.objects.all(), 100)
+            self.assertEqual(paginator.count, 50_000_000)
+        get_db.return_value.__getitem__.assert_called_with('activities')
+
+
+class TrackEncodingTest(SimpleTestCase):
+    def test_polyline_matches_reference_encoding(self):
+        self.assertEqual(encode_polyline(np.array([38.5, 40.7, 43.252]), np.array([-120.2, -120.95, -126.453])),
+                         '_p~iF~ps|U_ulLnnqC_mqNvxq`@')
+
+    def test_columns_round_trip_within_precision(self):
+        lat = 47.6 + np.cumsum(np.full(1000, 3e-5))
+        seconds = np.arange(1000) * 2
+        self.assertTrue(np.allclose(decode_column(encode_column(lat, COORDINATE_SCALE), COORDINATE_SCALE),
+                                    lat, atol=1e-6))
+        encoded = encode_column(seconds)
+        self.assertEqual(len(encoded), 1000)  # one byte per small delta
+        self.assertEqual(decode_column(encoded).tolist(), seconds.tolist())
+
+    def test_varints_cover_the_full_range(self):
+        values = np.array([0, 127, 128, 2 ** 35, 2 ** 64 - 1], dtype=np.uint64)
+        self.assertEqual(decode_varints(encode_varints(values)).tolist(), values.tolist())
+
+    def test_summary_derives_distance_pace_and_splits(self):
+        lat = np.linspace(0, 0.05, 501)  # about 5.56 km due north
+        summary = summarize(lat, np.zeros(501), np.arange(501) * 3)
+        self.assertAlmostEqual(summary['distance_km'], 5.56, places=2)
+        self.assertAlmostEqual(summary['pace_s_per_km'], 1500 / 5.56, delta=1)
+        self.assertEqual(len(summary['splits_s']), 5)
+
+    def test_downsample_keeps_endpoints(self):
+        lat = np.linspace(0, 1, 10000)
+        keep = downsample(lat, np.zeros(10000), 100)
+        self.assertLessEqual(len(keep), 100)
+        self.assertEqual((keep[0], keep[-1]), (0, 9999))
+
+    def test_serializer_rejects_malformed_tracks(self):
+        data = {'user_id': 'u1', 'activity_type': 'running', 'duration': 30,
+                'date': '2024-05-01T07:00:00Z'}
+        self.assertFalse(ActivitySerializer(data=dict(data, track=[[91, 0], [0, 0]])).is_valid())
+        self.assertFalse(ActivitySerializer(data=dict(data, track=[[0, 0, 5], [0, 0, 1]])).is_valid())
+        serializer = ActivitySerializer(data=dict(data, track=[[0, 0, 0], [0.01, 0, 60]]))
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        lat, lon, seconds = serializer.validated_data['track']
+        self.assertEqual(seconds.tolist(), [0, 60])
+
+
+class TeamFeedTest(SimpleTestCase):
+    def entry(self, user_id, day):
+        return {'_id': ObjectId(), 'user_id': user_id, 'activity_type': 'running', 'duration': 30,
+                'distance': 5.0, 'calories': 300, 'date': datetime(2024, 5, day)}
+
+    def feed_db(self, timeline, activities=()):
+        db = MagicMock()
+        db.__getitem__.return_value.find_one.return_value = timeline
+        db.activities.find.return_value.sort.return_value.limit.return_value = list(activities)
+        return db
+
+    def test_timeline_serves_a_full_page_in_one_fetch(self):
+        entries = [self.entry('u1', day) for day in range(28, 20, -1)]
+        db = self.feed_db({'entries': entries})
+        rows, next_key = team_feed(db, {'_id': 't1', 'members': ['u1']}, None, 3)
+        self.assertEqual([row.id for row in rows], [str(entry['_id']) for entry in entries[:3]])
+        self.assertEqual(next_key, (entries[2]['date'], entries[2]['_id']))
+        db.activities.find.assert_not_called()
+
+    def test_pages_past_the_timeline_read_activities(self):
+        entries = [self.entry('u1', 28), self.entry('u2', 27)]
+        older = self.entry('u1', 2)
+        db = self.feed_db({'entries': entries}, [older])
+        rows, next_key = team_feed(db, {'_id': 't1', 'members': ['u1']}, None, 5)
+        # u2 has left the team, so only u1's timeline entry and the older activity remain
+        self.assertEqual([row.id for row in rows], [str(entries[0]['_id']), str(older['_id'])])
+        self.assertIsNone(next_key)
+        query = db.activities.find.call_args[0][0]
+        self.assertEqual(query['$or'][0], {'date': {'$lt': entries[0]['date']}})
+
+    def test_complete_timelines_are_not_followed_into_activities(self):
+        entries = [self.entry('u1', 28), self.entry('u1', 27)]
+        db = self.feed_db({'entries': entries, 'complete': True})
+        rows, next_key = team_feed(db, {'_id': 't1', 'members': ['u1']}, None, 5)
+        self.assertEqual(len(rows), 2)
+        self.assertIsNone(next_key)
+        db.activities.find.assert_not_called()
+
+    def test_rebuild_retries_when_a_fan_out_raced_it(self):
+        db = MagicMock()
+        feeds = db.__getitem__.return_value
+        feeds.find_one.side_effect = [{'version': 4}, {'version': 5}]
+        feeds.replace_one.side_effect = [MagicMock(matched_count=0), MagicMock(matched_count=1)]
+        db.activities.find.return_value.sort.return_value.limit.return_value = [self.entry('u1', 3)]
+        rebuild_timeline(db, {'_id': 't1', 'members': ['u1']})
+        self.assertEqual([c[0][0] for c in feeds.replace_one.call_args_list],
+                         [{'_id': 't1', 'version': 4}, {'_id': 't1', 'version': 5}])
+        timeline = feeds.replace_one.call_args[0][1]
+        self.assertEqual((timeline['version'], timeline['complete']), (6, True))
+
+    def test_duplicate_entries_are_shown_once(self):
+        entry = self.entry('u1', 10)
+        self.assertEqual(len(timeline_entries({'entries': [entry, dict(entry)]}, ['u1'], None, 10)), 1)
+
+    def test_large_teams_are_not_fanned_out(self):
+        db = MagicMock()
+        db.teams.aggregate.return_value = [
+            {'_id': ObjectId(), 'size': 5, 'authors': ['u1']},
+            {'_id': ObjectId(), 'size': 50000, 'authors': ['u1']},
+        ]
+        with override_settings(TEAM_FEED_MAX_MEMBERS=1000):
+            fan_out(db, [self.entry('u1', 1)])
+        updates = db.__getitem__.return_value.bulk_write.call_args[0][0]
+        self.assertEqual(len(updates), 1)
+
+    def test_deleted_activity_is_pulled_from_every_timeline(self):
+        db = MagicMock()
+        activity_id = ObjectId()
+        remove_activity(db, activity_id)
+        db.__getitem__.assert_called_with(FEED_COLLECTION)
+        db.__getitem__.return_value.update_many.assert_called_once_with(
+            {'entries._id': activity_id}, {'$pull': {'entries': {'_id': activity_id}}, '$inc': {'version': 1}})
+
+    def test_edited_activity_replaces_its_entries(self):
+        db = MagicMock()
+        team_id = ObjectId()
+        db.teams.aggregate.return_value = [{'_id': team_id, 'size': 3, 'authors': ['u1']}]
+        edited = dict(self.entry('u1', 3), calories=450)
+        replace_activity(db, edited)
+        feeds = db.__getitem__.return_value
+        feeds.update_many.assert_any_call(
+            {'entries._id': edited['_id']}, {'$pull': {'entries': {'_id': edited['_id']}}, '$inc': {'version': 1}})
+        update = feeds.bulk_write.call_args[0][0][0]
+        self.assertEqual(update._filter, {'_id': str(team_id)})
+        self.assertEqual(update._doc['$push']['entries']['$each'][0]['calories'], 450)
+
+    def test_removed_member_is_trimmed_from_the_timeline(self):
+        db = MagicMock()
+        member_removed(db, 't1', 'u2')
+        db.__getitem__.return_value.update_one.assert_called_once_with(
+            {'_id': 't1'}, {'$pull': {'entries': {'user_id': 'u2'}}, '$inc': {'version': 1}})
+
+    def test_cursor_dates_become_naive_utc(self):
+        activity_id = ObjectId()
+        values = decode_cursor(encode_cursor([datetime(2024, 5, 1, 7, 30), activity_id]))
+        self.assertEqual(cursor_key(values), (datetime(2024, 5, 1, 7, 30), activity_id))
+        self.assertIsNone(cursor_key(['only one value']))
@@ -0,0 +1,130 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.throttling import BaseThrottle
+
+# Cache backends that are private to a process or cannot add() atomically
+UNSHARED_CACHES = ('LocMemCache', 'DummyCache', 'FileBasedCache')
+LOCK_TIMEOUT = 1
+LOCK_ATTEMPTS = 5
+
+
+def take_token(state, now, rate, burst):
+    """Refill a bucket to `now` and try to take one token
+
+    `state` is (tokens, updated_at) or None for a full bucket. Returns
+    (allowed, new_state, seconds_until_next_token).
+    """
+    tokens, updated_at = state if state else (burst, now)
+    # Hosts sharing a bucket may disagree slightly on the time; never refill backwards
+    tokens = min(burst, tokens + max(0.0, now - updated_at) * rate)
+    if tokens >= 1:
+        return True, (tokens - 1, now), 0.0
+    return False, (tokens, now), (1 - tokens) / rate
+
+
+class LocalBucketStore:
+    """Buckets held in this process; each worker enforces its own share of the limit"""
+
+    clock = staticmethod(time.monotonic)
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, now, rate, burst):
+        with self._lock:
+            allowed, state, wait = take_token(self._buckets.get(key), now, rate, burst)
+            self._buckets[key] = state
+        return allowed, wait
+
+
+class CacheBucketStore:
+    """Buckets in a shared Django cache so every worker enforces one limit
+
+    Each bucket's read-modify-write runs under a lock taken with cache.add(),
+    which is atomic on Redis, memcached and the database cache. A request
+    that cannot get the lock after a few short retries is refused, since only
+    a client already sending many concurrent requests contends for it.
+    Buckets are timed by the wall clock, since time.monotonic() has a
+    different origin in every process and on every host.
+    """
+
+    clock = staticmethod(time.time)
+
+    def __init__(self, cache_backend):
+        self.cache = cache_backend
+
+    def take(self, key, now, rate, burst):
+        lock = f'{key}:lock'
+        for attempt in range(LOCK_ATTEMPTS):
+            if self.cache.add(lock, 1, timeout=LOCK_TIMEOUT):
+                break
+            time.sleep(0.002 * (attempt + 1))
+        else:
+            return False, 1 / rate
+        try:
+            allowed, state, wait = take_token(self.cache.get(key), now, rate, burst)
+            # An idle bucket is full again after burst / rate seconds
+            self.cache.set(key, state, timeout=int(burst / rate) + 1)
+        finally:
+            self.cache.delete(lock)
+        return allowed, wait
+
+
+_local_store = LocalBucketStore()
+
+
+def get_bucket_store():
+    if settings.RATE_LIMIT_STORE == 'cache':
+        backend = caches['default']
+        if type(backend).__name__ in UNSHARED_CACHES:
+            raise ImproperlyConfigured(
+                f'RATE_LIMIT_STORE=cache needs a shared cache backend, not {type(backend).__name__}; '
+                'set CACHE_BACKEND and CACHE_LOCATION')
+        return CacheBucketStore(backend)
+    return _local_store
+
+
+def request_client(request):
+    """'user:<id>' for an authenticated request, otherwise 'ip:<address>' (honouring NUM_PROXIES)"""
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return f'user:{user.pk}'
+    return f'ip:{BaseThrottle().get_ident(request)}'
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """Per-client, per-endpoint token bucket
+
+    Clients are identified by user id when authenticated and by IP otherwise.
+    Endpoints are the DRF route name (e.g. 'activity-list'), so RATE_LIMIT_ENDPOINTS
+    can give expensive routes a tighter (rate, burst) than RATE_LIMIT_RATE/BURST.
+    Unsafe methods count against '<route>:write', a bucket of their own.
+    """
+
+    def allow_request(self, request, view):
+        if not settings.RATE_LIMIT_ENABLED:
+            return True
+        endpoint = self.endpoint(request, view)
+        rate, burst = settings.RATE_LIMIT_ENDPOINTS.get(
+            endpoint, (settings.RATE_LIMIT_RATE, settings.RATE_LIMIT_BURST))
+        key = f'throttle:{self.client(request)}:{endpoint}'
+        store = get_bucket_store()
+        allowed, self._wait = store.take(key, store.clock(), rate, burst)
+        return allowed
+
+    def wait(self):
+        return getattr(self, '_wait', None)
+
+    def client(self, request):
+        return request_client(request)
+
+    def endpoint(self, request, view):
+        match = getattr(request, 'resolver_match', None)
+        name = match.url_name if match is not None and match.url_name else view.__class__.__name__
+        return name if request.method in SAFE_METHODS else f'{name}:write'
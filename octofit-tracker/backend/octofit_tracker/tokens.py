@@ -0,0 +1,141 @@
+import threading
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.hashers import check_password, identify_hasher, make_password
+from django.core import signing
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+from rest_framework import exceptions
+from rest_framework.authentication import BaseAuthentication, get_authorization_header
+
+from .invalidation import generation, publish
+from .mongo import get_db
+
+ACCESS_SALT = 'octofit.auth.access'
+REFRESH_SALT = 'octofit.auth.refresh'
+REVOKED_COLLECTION = 'revoked_tokens'
+KEYWORD = b'bearer'
+
+
+def ensure_token_indexes(db):
+    db[REVOKED_COLLECTION].create_index('expires_at', expireAfterSeconds=0)
+
+
+def _issue(user_id, salt):
+    return signing.dumps({'uid': str(user_id), 'jti': uuid.uuid4().hex}, salt=salt, compress=True)
+
+
+def issue_tokens(user_id):
+    return {
+        'access': _issue(user_id, ACCESS_SALT),
+        'refresh': _issue(user_id, REFRESH_SALT),
+        'token_type': 'Bearer',
+        'expires_in': settings.ACCESS_TOKEN_LIFETIME,
+    }
+
+
+def read_token(token, salt, max_age):
+    """Claims of a token, or None if it is forged, malformed or expired"""
+    try:
+        return signing.loads(token, salt=salt, max_age=max_age)
+    except signing.BadSignature:
+        return None
+
+
+def read_access_token(token):
+    return read_token(token, ACCESS_SALT, settings.ACCESS_TOKEN_LIFETIME)
+
+
+def read_refresh_token(token):
+    return read_token(token, REFRESH_SALT, settings.REFRESH_TOKEN_LIFETIME)
+
+
+class RevocationList:
+    """Token ids revoked before they expire, held in memory by every process
+
+    Revocations are stored in MongoDB (expiring with the token) and announced
+    through the 'revocations' generation counter. A process reloads its set
+    only when that generation moves, so checking a token on the hot path is a
+    shared-memory read and a set lookup.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.revoked = set()
+        self.loaded = None
+
+    def refresh(self):
+        current = generation('revocations')
+        if current == self.loaded:
+            return
+        with self.lock:
+            now = timezone.now()
+            self.revoked = {doc['_id'] for doc in get_db()[REVOKED_COLLECTION].find(
+                {'expires_at': {'$gt': now}}, {'_id': 1})}
+            self.loaded = current
+
+    def is_revoked(self, jti):
+        self.refresh()
+        return jti in self.revoked
+
+    def revoke(self, jti, lifetime):
+        get_db()[REVOKED_COLLECTION].update_one(
+            {'_id': jti},
+            {'$set': {'expires_at': timezone.now() + timedelta(seconds=lifetime)}},
+            upsert=True,
+        )
+        self.revoked.add(jti)
+        publish('revocations')
+
+
+revocations = RevocationList()
+
+
+def verify_password(db, user, raw):
+    """Check a login password, upgrading a stored plain-text password to a hash
+
+    Users registered before passwords were hashed still carry them as given.
+    """
+    stored = user.get('password')
+    if not stored or raw is None:
+        return False
+    try:
+        identify_hasher(stored)
+    except ValueError:
+        if not constant_time_compare(stored, raw):
+            return False
+        db.users.update_one({'_id': user['_id']}, {'$set': {'password': make_password(raw)}})
+        return True
+    return check_password(raw, stored)
+
+
+class TokenUser:
+    """The authenticated caller, known from the token alone without a users read"""
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, user_id):
+        self.pk = self.id = user_id
+
+    def __str__(self):
+        return self.pk
+
+
+class BearerTokenAuthentication(BaseAuthentication):
+    """`Authorization: Bearer <access token>` checked by signature and expiry only"""
+
+    def authenticate(self, request):
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != KEYWORD:
+            return None
+        if len(auth) != 2:
+            raise exceptions.AuthenticationFailed('Invalid Authorization header')
+        claims = read_access_token(auth[1].decode(errors='replace'))
+        if claims is None or revocations.is_revoked(claims['jti']):
+            raise exceptions.AuthenticationFailed('Invalid or expired token')
+        return TokenUser(claims['uid']), claims
+
+    def authenticate_header(self, request):
+        return 'Bearer'
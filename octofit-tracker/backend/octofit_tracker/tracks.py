@@ -0,0 +1,186 @@
+import numpy as np
+from bson import Binary
+
+from .activity_store import TRACK_COLLECTION
+
+EARTH_RADIUS_KM = 6371.0088
+
+# Stored coordinates are fixed point at 1e-6 degrees (about 0.1 m); the
+# polyline sent to clients uses the standard 1e-5 precision
+COORDINATE_SCALE = 1e6
+POLYLINE_SCALE = 1e5
+
+
+def parse_track(points):
+    """Validate [[lat, lon], ...] or [[lat, lon, seconds], ...] into (lat, lon, seconds or None)
+
+    Seconds are elapsed time from any origin and must not decrease. Raises
+    ValueError with a message suitable for a 400 response.
+    """
+    try:
+        array = np.asarray(points, dtype=np.float64)
+    except (TypeError, ValueError):
+        raise ValueError('track must be a list of [lat, lon] or [lat, lon, seconds] points')
+    if array.ndim != 2 or array.shape[1] not in (2, 3) or len(array) < 2:
+        raise ValueError('track must be a list of at least two [lat, lon] or [lat, lon, seconds] points')
+    if not np.isfinite(array).all():
+        raise ValueError('track contains non-numeric values')
+    lat, lon = array[:, 0], array[:, 1]
+    if (np.abs(lat) > 90).any() or (np.abs(lon) > 180).any():
+        raise ValueError('track coordinates are out of range')
+    seconds = None
+    if array.shape[1] == 3:
+        seconds = np.rint(array[:, 2] - array[0, 2]).astype(np.int64)
+        if (np.diff(seconds) < 0).any():
+            raise ValueError('track times must not decrease')
+    return lat, lon, seconds
+
+
+def zigzag(values):
+    values = np.asarray(values, dtype=np.int64)
+    return ((values << 1) ^ (values >> 63)).view(np.uint64)
+
+
+def unzigzag(values):
+    values = np.asarray(values, dtype=np.uint64)
+    return (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+
+
+def _groups(values, bits):
+    """Split unsigned ints into little-endian `bits`-bit groups, in stream order
+
+    Returns the groups and a flag set on every group but the last of its value.
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    width = -(-64 // bits)
+    shifts = np.arange(width, dtype=np.uint64) * np.uint64(bits)
+    groups = (values[:, None] >> shifts) & np.uint64((1 << bits) - 1)
+    needed = 1 + ((values[:, None] >> shifts[1:]) != 0).sum(axis=1)
+    position = np.arange(width)
+    used = position < needed[:, None]
+    more = position < (needed - 1)[:, None]
+    return groups[used].astype(np.uint8), more[used]
+
+
+def encode_varints(values):
+    """LEB128 varints: seven bits per byte, high bit set while more bytes follow"""
+    groups, more = _groups(values, 7)
+    return (groups | (more.astype(np.uint8) << 7)).tobytes()
+
+
+def decode_varints(data):
+    stream = np.frombuffer(data, dtype=np.uint8)
+    if not len(stream):
+        return np.zeros(0, dtype=np.uint64)
+    last = stream < 0x80
+    starts = np.flatnonzero(np.concatenate([[True], last[:-1]]))
+    value_index = np.concatenate([[0], np.cumsum(last)[:-1]])
+    position = (np.arange(len(stream)) - starts[value_index]).astype(np.uint64)
+    parts = (stream & 0x7f).astype(np.uint64) << (position * np.uint64(7))
+    return np.add.reduceat(parts, starts)
+
+
+def encode_column(values, scale=1):
+    """Fixed-point, delta, zigzag and varint encode a column into BSON binary"""
+    fixed = np.rint(np.asarray(values, dtype=np.float64) * scale).astype(np.int64)
+    return Binary(encode_varints(zigzag(np.diff(fixed, prepend=0))))
+
+
+def decode_column(data, scale=1):
+    fixed = np.cumsum(unzigzag(decode_varints(bytes(data))))
+    return fixed / scale if scale != 1 else fixed
+
+
+def encode_polyline(lat, lon):
+    """Google encoded polyline of a track at 1e-5 degree precision"""
+    fixed = np.rint(np.column_stack([lat, lon]) * POLYLINE_SCALE).astype(np.int64)
+    deltas = np.diff(fixed, axis=0, prepend=np.zeros((1, 2), dtype=np.int64))
+    groups, more = _groups(zigzag(deltas.ravel()), 5)
+    return ((groups | (more.astype(np.uint8) << 5)) + 63).tobytes().decode('ascii')
+
+
+def segment_km(lat, lon):
+    """Great-circle (haversine) length of every segment of a track"""
+    phi, lam = np.radians(lat), np.radians(lon)
+    a = (np.sin(np.diff(phi) / 2) ** 2
+         + np.cos(phi[:-1]) * np.cos(phi[1:]) * np.sin(np.diff(lam) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def cumulative_km(lat, lon):
+    return np.concatenate([[0.0], np.cumsum(segment_km(lat, lon))])
+
+
+def summarize(lat, lon, seconds):
+    """Distance, elapsed time, average pace and whole-kilometre splits of a track"""
+    distance = cumulative_km(lat, lon)
+    summary = {'distance_km': round(float(distance[-1]), 3), 'elapsed_s': None,
+               'pace_s_per_km': None, 'splits_s': []}
+    if seconds is not None:
+        elapsed = int(seconds[-1])
+        summary['elapsed_s'] = elapsed
+        if distance[-1] > 0:
+            summary['pace_s_per_km'] = round(elapsed / float(distance[-1]), 1)
+        marks = np.arange(1, int(distance[-1]) + 1)
+        if len(marks):
+            at = np.interp(np.concatenate([[0], marks]), distance, seconds)
+            summary['splits_s'] = np.rint(np.diff(at)).astype(int).tolist()
+    return summary
+
+
+def track_document(activity_id, user_id, lat, lon, seconds):
+    doc = {
+        '_id': activity_id,
+        'user_id': str(user_id),
+        'points': len(lat),
+        'lat': encode_column(lat, COORDINATE_SCALE),
+        'lon': encode_column(lon, COORDINATE_SCALE),
+    }
+    if seconds is not None:
+        doc['t'] = encode_column(seconds)
+    doc.update(summarize(lat, lon, seconds))
+    return doc
+
+
+def store_track(db, doc):
+    db[TRACK_COLLECTION].replace_one({'_id': doc['_id']}, doc, upsert=True)
+
+
+def downsample(lat, lon, max_points):
+    """Indices of at most `max_points` track points spaced evenly by distance
+
+    Original points are kept (first and last always), so corners survive
+    better than with a fixed stride on points recorded at uneven speeds.
+    """
+    if len(lat) <= max_points:
+        return np.arange(len(lat))
+    distance = cumulative_km(lat, lon)
+    targets = np.linspace(0.0, distance[-1], max_points)
+    indices = np.searchsorted(distance, targets).clip(0, len(lat) - 1)
+    return np.unique(np.concatenate([[0], indices, [len(lat) - 1]]))
+
+
+def track_response(doc, max_points, output):
+    """Downsampled track as a polyline (plus times) or as [lat, lon, seconds] points"""
+    lat = decode_column(doc['lat'], COORDINATE_SCALE)
+    lon = decode_column(doc['lon'], COORDINATE_SCALE)
+    seconds = decode_column(doc['t']) if 't' in doc else None
+    keep = downsample(lat, lon, max_points)
+    response = {
+        'activity_id': str(doc['_id']),
+        'points': int(doc['points']),
+        'returned_points': len(keep),
+        'distance_km': doc['distance_km'],
+        'elapsed_s': doc['elapsed_s'],
+        'pace_s_per_km': doc['pace_s_per_km'],
+        'splits_s': doc['splits_s'],
+    }
+    if output == 'points':
+        columns = [np.round(lat[keep], 6).tolist(), np.round(lon[keep], 6).tolist()]
+        if seconds is not None:
+            columns.append(seconds[keep].tolist())
+        response['track'] = [list(point) for point in zip(*columns)]
+    else:
+        response['polyline'] = encode_polyline(lat[keep], lon[keep])
+        response['seconds'] = seconds[keep].tolist() if seconds is not None else None
+    return response
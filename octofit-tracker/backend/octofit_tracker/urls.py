@@ -22,7 +22,7 @@ from rest_framework.response import Response
 from rest_framework.reverse import reverse
 from .views import (
     UserViewSet, TeamViewSet, ActivityViewSet,
-    LeaderboardViewSet, WorkoutViewSet
+    LeaderboardViewSet, WorkoutViewSet, dashboard, login, logout, refresh, search, sync
 )
 
 # Configure router
@@ -52,6 +52,10 @@ def api_root(request, format=None):
         'activities': reverse('activity-list', request=request, format=format),
         'leaderboard': reverse('leaderboard-list', request=request, format=format),
         'workouts': reverse('workout-list', request=request, format=format),
+        'search': reverse('search', request=request, format=format),
+        'sync': reverse('sync', request=request, format=format),
+        'dashboard': reverse('dashboard', request=request, format=format),
+        'login': reverse('login', request=request, format=format),
         'admin': f"{base_url}/admin/",
     })
 
@@ -60,5 +64,11 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('', api_root, name='api-root'),
     path('api/', api_root, name='api-root'),
+    path('api/search/', search, name='search'),
+    path('api/sync/', sync, name='sync'),
+    path('api/dashboard/', dashboard, name='dashboard'),
+    path('api/auth/login/', login, name='login'),
+    path('api/auth/refresh/', refresh, name='token-refresh'),
+    path('api/auth/logout/', logout, name='logout'),
     path('api/', include(router.urls)),
 ]
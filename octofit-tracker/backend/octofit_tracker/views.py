@@ -1,68 +1,231 @@
+import sys
+from datetime import datetime, time, timedelta
+from bson import ObjectId
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from django.forms.models import model_to_dict
+from django.http import Http404, HttpResponse
+from django.utils.cache import patch_cache_control
+from django.utils.dateparse import parse_date, parse_datetime
 from rest_framework import viewsets, status
-from rest_framework.decorators import action
+from rest_framework.authentication import get_authorization_header
+from rest_framework.decorators import action, api_view, authentication_classes
 from rest_framework.response import Response
-from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError
+from .activity_store import ARCHIVE_COLLECTION, TRACK_COLLECTION, activity_range_query, natural_key_query
+from .cursors import decode_cursor, encode_cursor
+from .dashboard import build_dashboard, cache_key, payload_etag
+from .feed import (
+    cursor_key, instance_activity, member_added, member_removed, replace_activity,
+    team_feed,
+)
+from .idempotency import IDEMPOTENCY_HEADER, lookup_response, request_fingerprint, scoped_key, store_response
+from .ids import fetch_by_ids, id_filter, stringify_ids
+from .ingest import API_SOURCE, get_journal, record_activities, retract_activities, wait_for_ingest
+from .invalidation import publish
 from .models import User, Team, Activity, Leaderboard, Workout
+from .mongo import get_db, get_read_db
+from .rank_history import user_history
+from .ranking import PERIODS, RANK_METRICS, user_rank
+from .replica import reference_body, request_reference_refresh
+from .rows import fetch_activity_rows, fetch_leaderboard_rows, serialize_rows
+from .search import SEARCHABLE, index_document, remove_document, search as search_index
 from .serializers import (
     UserSerializer, TeamSerializer, ActivitySerializer,
     LeaderboardSerializer, WorkoutSerializer
 )
+from .sync import SEQ_FIELD, changes_since, decode_token, record_deletion, reserve_seqs, stamp
+from .tokens import issue_tokens, read_access_token, read_refresh_token, revocations, verify_password
+
+
+def _parse_date_param(value):
+    """Parse an ISO date or datetime query parameter into an aware datetime"""
+    if not value:
+        return None
+    parsed = parse_datetime(value)
+    if parsed is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(f'Invalid date: {value}')
+        parsed = datetime.combine(day, time.min)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+class ObjectIdLookupMixin:
+    """Answer 404 instead of 500 when the URL id is not an ObjectId"""
+    
+    def get_object(self):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        if not ObjectId.is_valid(str(self.kwargs.get(lookup_url_kwarg, ''))):
+            raise Http404('Invalid id')
+        return super().get_object()
+
+
+class SearchIndexMixin:
+    """Keep the /api/search/ prefix index in step with writes through the viewset"""
+    search_kind = None
+    
+    def perform_create(self, serializer):
+        instance = serializer.save()
+        index_document(get_db(), self.search_kind, model_to_dict(instance))
+    
+    def perform_update(self, serializer):
+        instance = serializer.save()
+        index_document(get_db(), self.search_kind, model_to_dict(instance))
+    
+    def perform_destroy(self, instance):
+        pk = instance.pk
+        instance.delete()
+        remove_document(get_db(), self.search_kind, pk)
+
 
+class ChangeSeqMixin:
+    """Give documents written through the viewset a new change sequence for /api/sync/
+    
+    Also bumps the collection's generation so cached payloads built from it are
+    dropped, and keeps the new generation in `published` for caches this
+    process updates itself. Deletes are tombstoned with `tombstone_fields`,
+    by the model's pre_delete receiver when `tombstoned_on_delete` is set.
+    """
+    sync_collection = None
+    published = None
+    tombstone_fields = {}
+    tombstoned_on_delete = False
+    
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        stamp(get_db(), self.sync_collection, [serializer.instance.pk])
+        self.published = publish(self.sync_collection)
+    
+    def perform_update(self, serializer):
+        super().perform_update(serializer)
+        stamp(get_db(), self.sync_collection, [serializer.instance.pk])
+        self.published = publish(self.sync_collection)
+    
+    def perform_destroy(self, instance):
+        pk = instance.pk
+        instance.tombstone_fields = self.tombstone_fields
+        super().perform_destroy(instance)
+        if not self.tombstoned_on_delete:
+            record_deletion(get_db(), self.sync_collection, pk, **self.tombstone_fields)
+        self.published = publish(self.sync_collection)
 
-class UserViewSet(viewsets.ModelViewSet):
+
+class BatchLookupMixin:
+    """Resolve many ids in one request: `?ids=a,b,c` on list, or POST {"ids": [...]} to batch/
+    
+    Each collection is read with one `$in` query and the response lists the
+    documents in the order requested, with null for ids that match nothing.
+    """
+    batch_collection = None
+    batch_read_preference = None
+    batch_projection = None
+    batch_list_field = None
+    
+    def batch_list(self, request):
+        """Response for a list request carrying `ids`, or None for a plain list"""
+        if 'ids' not in request.query_params:
+            return None
+        return self.batch_response([value for value in request.query_params['ids'].split(',') if value])
+    
+    @action(detail=False, methods=['post'])
+    def batch(self, request):
+        ids = request.data.get('ids')
+        if not isinstance(ids, list):
+            return Response({'error': 'ids must be a list'}, status=status.HTTP_400_BAD_REQUEST)
+        return self.batch_response(ids)
+    
+    def batch_response(self, ids):
+        if len(ids) > settings.BATCH_MAX_IDS:
+            return Response({'error': f'at most {settings.BATCH_MAX_IDS} ids per request'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        db = get_read_db(self.batch_read_preference) if self.batch_read_preference else get_db()
+        docs = fetch_by_ids(db[self.batch_collection], ids, self.batch_projection)
+        for doc in docs:
+            if doc is not None:
+                stringify_ids(doc)
+                if self.batch_list_field:
+                    doc.setdefault(self.batch_list_field, [])
+        return Response(docs)
+
+
+class UserViewSet(ObjectIdLookupMixin, BatchLookupMixin, SearchIndexMixin, viewsets.ModelViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
+    search_kind = 'user'
+    batch_collection = 'users'
+    batch_projection = {'password': 0}
+    
+    def list(self, request, *args, **kwargs):
+        batched = self.batch_list(request)
+        if batched is not None:
+            return batched
+        return super().list(request, *args, **kwargs)
     
     @action(detail=False, methods=['post'])
     def register(self, request):
         serializer = self.get_serializer(data=request.data)
         if serializer.is_valid():
-            serializer.save()
+            self.perform_create(serializer)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class TeamViewSet(viewsets.ModelViewSet):
+class TeamViewSet(ChangeSeqMixin, BatchLookupMixin, SearchIndexMixin, viewsets.ModelViewSet):
     queryset = Team.objects.none()  # Disable default queryset
     serializer_class = TeamSerializer
+    search_kind = 'team'
+    sync_collection = 'teams'
+    batch_collection = 'teams'
+    batch_list_field = 'members'
+    
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        request_reference_refresh()
+    
+    def perform_update(self, serializer):
+        super().perform_update(serializer)
+        request_reference_refresh()
+    
+    def perform_destroy(self, instance):
+        super().perform_destroy(instance)
+        request_reference_refresh()
     
     def list(self, request):
         """Override list to fetch directly from MongoDB"""
+        batched = self.batch_list(request)
+        if batched is not None:
+            return batched
+        body = reference_body('teams')
+        if body is not None:
+            return HttpResponse(body, content_type='application/json')
         try:
-            client = MongoClient('localhost', 27017)
-            db = client['octofit_db']
+            db = get_db()
             teams_data = list(db.teams.find())
             
             # Convert MongoDB _id to string and ensure proper field names
             for team in teams_data:
-                if '_id' in team:
-                    team['id'] = str(team['_id'])
+                stringify_ids(team)
                 # Ensure members is properly formatted
                 if 'members' not in team:
                     team['members'] = []
                     
-            client.close()
             return Response(teams_data)
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
     
     def retrieve(self, request, pk=None):
         """Override retrieve to fetch directly from MongoDB"""
+        team_id = id_filter(pk)
         try:
-            client = MongoClient('localhost', 27017)
-            db = client['octofit_db']
-            
-            # Try to convert pk to int
-            try:
-                team_id = int(pk)
-            except ValueError:
-                team_id = pk
-                
+            db = get_db()
             team_data = db.teams.find_one({'_id': team_id})
-            client.close()
             
             if team_data:
-                team_data['id'] = str(team_data['_id'])
+                stringify_ids(team_data)
                 if 'members' not in team_data:
                     team_data['members'] = []
                 return Response(team_data)
@@ -70,19 +233,38 @@ class TeamViewSet(viewsets.ModelViewSet):
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
     
+    @action(detail=True, methods=['get'])
+    def feed(self, request, pk=None):
+        """Teammates' recent activities, newest first; pass `next_cursor` back as `cursor`"""
+        try:
+            limit = min(int(request.query_params.get('limit', settings.TEAM_FEED_PAGE_SIZE)),
+                        settings.TEAM_FEED_MAX_PAGE_SIZE)
+        except ValueError:
+            return Response({'error': 'limit must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+        if limit < 1:
+            return Response({'error': 'limit must be positive'}, status=status.HTTP_400_BAD_REQUEST)
+        after = None
+        if request.query_params.get('cursor'):
+            after = cursor_key(decode_cursor(request.query_params['cursor']))
+            if after is None:
+                return Response({'error': 'Invalid cursor'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        db = get_db()
+        team = db.teams.find_one({'_id': id_filter(pk)}, {'members': 1})
+        if team is None:
+            return Response({'error': 'Team not found'}, status=status.HTTP_404_NOT_FOUND)
+        rows, next_key = team_feed(db, team, after, limit)
+        return Response({
+            'results': serialize_rows(rows),
+            'next_cursor': encode_cursor(list(next_key)) if next_key else None,
+        })
+    
     @action(detail=True, methods=['post'])
     def add_member(self, request, pk=None):
         """Add a member to a team"""
+        team_id = id_filter(pk)
         try:
-            client = MongoClient('localhost', 27017)
-            db = client['octofit_db']
-            
-            # Try to convert pk to int
-            try:
-                team_id = int(pk)
-            except ValueError:
-                team_id = pk
-                
+            db = get_db()
             user_id = request.data.get('user_id')
             if not user_id:
                 return Response({'error': 'user_id is required'}, 
@@ -90,18 +272,20 @@ class TeamViewSet(viewsets.ModelViewSet):
             
             team = db.teams.find_one({'_id': team_id})
             if not team:
-                client.close()
                 return Response({'error': 'Team not found'}, 
                               status=status.HTTP_404_NOT_FOUND)
             
             members = team.get('members', [])
             if user_id not in members:
                 members.append(user_id)
-                db.teams.update_one({'_id': team_id}, {'$set': {'members': members}})
+                with reserve_seqs(db) as seq:
+                    db.teams.update_one({'_id': team_id}, {'$set': {'members': members, SEQ_FIELD: seq}})
+                member_added(db, dict(team, members=members))
             
             updated_team = db.teams.find_one({'_id': team_id})
-            updated_team['id'] = str(updated_team['_id'])
-            client.close()
+            stringify_ids(updated_team)
+            publish('teams')
+            request_reference_refresh()
             return Response(updated_team)
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -109,16 +293,9 @@ class TeamViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=['post'])
     def remove_member(self, request, pk=None):
         """Remove a member from a team"""
+        team_id = id_filter(pk)
         try:
-            client = MongoClient('localhost', 27017)
-            db = client['octofit_db']
-            
-            # Try to convert pk to int
-            try:
-                team_id = int(pk)
-            except ValueError:
-                team_id = pk
-                
+            db = get_db()
             user_id = request.data.get('user_id')
             if not user_id:
                 return Response({'error': 'user_id is required'}, 
@@ -126,105 +303,372 @@ class TeamViewSet(viewsets.ModelViewSet):
             
             team = db.teams.find_one({'_id': team_id})
             if not team:
-                client.close()
                 return Response({'error': 'Team not found'}, 
                               status=status.HTTP_404_NOT_FOUND)
             
             members = team.get('members', [])
             if user_id in members:
                 members.remove(user_id)
-                db.teams.update_one({'_id': team_id}, {'$set': {'members': members}})
+                with reserve_seqs(db) as seq:
+                    db.teams.update_one({'_id': team_id}, {'$set': {'members': members, SEQ_FIELD: seq}})
+                member_removed(db, team['_id'], user_id)
             else:
-                client.close()
                 return Response({'error': 'User not found in team'}, 
                               status=status.HTTP_400_BAD_REQUEST)
             
             updated_team = db.teams.find_one({'_id': team_id})
-            updated_team['id'] = str(updated_team['_id'])
-            client.close()
+            stringify_ids(updated_team)
+            publish('teams')
+            request_reference_refresh()
             return Response(updated_team)
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
-class ActivityViewSet(viewsets.ModelViewSet):
+class ActivityViewSet(ObjectIdLookupMixin, ChangeSeqMixin, viewsets.ModelViewSet):
     queryset = Activity.objects.all()
     serializer_class = ActivitySerializer
+    sync_collection = 'activities'
+    # Noted on the tombstone: the API retracts the totals itself
+    tombstone_fields = {'source': API_SOURCE}
+    tombstoned_on_delete = True
+    
+    def create(self, request, *args, **kwargs):
+        """Create an activity, replaying earlier responses for retried requests
+
+        A request with an Idempotency-Key header that was already answered gets
+        the stored response back. Without a key, an activity matching an
+        existing one on (user_id, activity_type, date, duration) is returned
+        with 200 instead of being stored again.
+        """
+        db = get_db()
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        fingerprint = request_fingerprint(request.data)
+        if key:
+            key = scoped_key(request, key)
+            stored = lookup_response(db, key)
+            if stored:
+                if stored['fingerprint'] != fingerprint:
+                    return Response({'error': 'Idempotency-Key was already used with a different payload'},
+                                    status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+                return Response(stored['body'], status=stored['status'],
+                                headers={'Idempotent-Replayed': 'true'})
+        
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        track = self._prepare_track(serializer.validated_data)
+        
+        existing = self._find_duplicate(db, serializer.validated_data)
+        if existing is None:
+            if settings.ACTIVITY_INGEST_MODE == 'queued':
+                activity_id = get_journal().append(serializer.validated_data)
+                response = Response({'_id': activity_id, 'status': 'queued'},
+                                    status=status.HTTP_202_ACCEPTED)
+                self._store_track(db, track, ObjectId(activity_id))
+            else:
+                try:
+                    self.perform_create(serializer)
+                    response = Response(serializer.data, status=status.HTTP_201_CREATED,
+                                        headers=self.get_success_headers(serializer.data))
+                    self._store_track(db, track, serializer.instance.pk)
+                except DuplicateKeyError:
+                    # Lost a race against a concurrent retry on the natural-key index
+                    existing = self._find_duplicate(db, serializer.validated_data)
+                    if existing is None:
+                        raise
+        if existing is not None:
+            response = Response(serialize_rows([existing])[0], status=status.HTTP_200_OK)
+        
+        if key:
+            store_response(db, key, fingerprint, response.status_code, response.data)
+        return response
+    
+    def _prepare_track(self, activity):
+        """Take a posted GPS track off the activity, deriving distance from it if none was given"""
+        track = activity.pop('track', None)
+        if track is None:
+            return None
+        from .tracks import track_document
+        
+        doc = track_document(None, activity['user_id'], *track)
+        if activity.get('distance') is None:
+            activity['distance'] = doc['distance_km']
+        return doc
+    
+    def _store_track(self, db, track, activity_id):
+        if track is not None:
+            from .tracks import store_track
+            
+            store_track(db, dict(track, _id=activity_id))
+    
+    def _find_duplicate(self, db, activity):
+        rows = fetch_activity_rows(db.activities, natural_key_query(activity), limit=1)
+        return rows[0] if rows else None
+    
+    def list(self, request, *args, **kwargs):
+        """List activities as compact rows instead of model instances"""
+        return Response(serialize_rows(fetch_activity_rows(get_db().activities)))
+    
+    def perform_create(self, serializer):
+        """Insert directly so the document carries the API source tag in the same write"""
+        db = get_db()
+        wait_for_ingest(db)
+        doc = dict(serializer.validated_data, _id=ObjectId(), source=API_SOURCE)
+        with reserve_seqs(db) as seq:
+            doc[SEQ_FIELD] = seq
+            db.activities.insert_one(doc)
+        serializer.instance = Activity(**{field: value for field, value in doc.items()
+                                          if field not in ('source', SEQ_FIELD)})
+        record_activities(db, [doc])
+        publish('activities')
+    
+    def perform_update(self, serializer):
+        track = self._prepare_track(serializer.validated_data)
+        super().perform_update(serializer)
+        db = get_db()
+        self._store_track(db, track, serializer.instance.pk)
+        replace_activity(db, instance_activity(serializer.instance))
+    
+    def perform_destroy(self, instance):
+        db = get_db()
+        wait_for_ingest(db)
+        activity = instance_activity(instance)
+        super().perform_destroy(instance)
+        db[TRACK_COLLECTION].delete_one({'_id': activity['_id']})
+        retract_activities(db, [activity])
+    
+    @action(detail=True, methods=['get'])
+    def track(self, request, pk=None):
+        """The activity's GPS track, downsampled to `points`, as a polyline or (`output=points`) a point list"""
+        from .tracks import track_response
+        
+        if not ObjectId.is_valid(str(pk)):
+            raise Http404('Invalid id')
+        try:
+            points = int(request.query_params.get('points', settings.TRACK_RESPONSE_POINTS))
+        except ValueError:
+            return Response({'error': 'points must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+        if points < 2:
+            return Response({'error': 'points must be at least 2'}, status=status.HTTP_400_BAD_REQUEST)
+        output = request.query_params.get('output', 'polyline')
+        if output not in ('polyline', 'points'):
+            return Response({'error': 'output must be polyline or points'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        doc = get_db()[TRACK_COLLECTION].find_one({'_id': ObjectId(pk)})
+        if doc is None:
+            return Response({'error': 'Activity has no track'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(track_response(doc, min(points, settings.TRACK_RESPONSE_MAX_POINTS), output))
     
     @action(detail=False, methods=['get'])
     def user_activities(self, request):
+        """List a user's activities, optionally limited to a date range and type"""
         user_id = request.query_params.get('user_id')
-        if user_id:
-            activities = Activity.objects.filter(user_id=user_id)
-            serializer = self.get_serializer(activities, many=True)
-            return Response(serializer.data)
-        return Response({'error': 'user_id parameter required'}, 
-                       status=status.HTTP_400_BAD_REQUEST)
+        if not user_id:
+            return Response({'error': 'user_id parameter required'}, 
+                           status=status.HTTP_400_BAD_REQUEST)
+        
+        try:
+            since = _parse_date_param(request.query_params.get('since'))
+            until = _parse_date_param(request.query_params.get('until'))
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        activity_type = request.query_params.get('activity_type')
+        
+        # Served by the (user_id, date) index
+        db = get_db()
+        query = activity_range_query(user_id, since, until, activity_type)
+        activities = fetch_activity_rows(db.activities, query)
+        
+        archive_horizon = timezone.now() - timedelta(days=settings.ACTIVITY_ARCHIVE_AFTER_DAYS)
+        include_archive = request.query_params.get('include_archive', '').lower() in ('1', 'true')
+        if include_archive and (since is None or since < archive_horizon):
+            activities += fetch_activity_rows(db[ARCHIVE_COLLECTION], query)
+        
+        return Response(serialize_rows(activities))
+    
+    @action(detail=False, methods=['get'])
+    def trends(self, request):
+        """Moving averages, week-over-week deltas, streaks and personal bests per activity type"""
+        # analytics needs numpy; importing it here keeps it off worker startup
+        from .analytics import METRICS, compute_trends, load_activity_columns
+        
+        user_id = request.query_params.get('user_id')
+        team_id = request.query_params.get('team_id')
+        if not user_id and not team_id:
+            return Response({'error': 'user_id or team_id parameter required'}, 
+                           status=status.HTTP_400_BAD_REQUEST)
+        metric = request.query_params.get('metric', 'calories')
+        if metric not in METRICS:
+            return Response({'error': f'metric must be one of {", ".join(METRICS)}'},
+                           status=status.HTTP_400_BAD_REQUEST)
+        try:
+            window = int(request.query_params.get('window', 7))
+            weeks = int(request.query_params.get('weeks', 8))
+        except ValueError:
+            return Response({'error': 'window and weeks must be integers'},
+                           status=status.HTTP_400_BAD_REQUEST)
+        if window < 1 or weeks < 1:
+            return Response({'error': 'window and weeks must be positive'},
+                           status=status.HTTP_400_BAD_REQUEST)
+        
+        try:
+            db = get_db()
+            if user_id:
+                user_ids = [user_id]
+            else:
+                team = db.teams.find_one({'_id': id_filter(team_id)}, {'members': 1})
+                if not team:
+                    return Response({'error': 'Team not found'}, status=status.HTTP_404_NOT_FOUND)
+                user_ids = [str(member) for member in team.get('members', [])]
+            
+            columns = load_activity_columns(db, user_ids)
+            trends = compute_trends(columns, metric=metric, window=window, weeks=weeks,
+                                    today=timezone.now().date())
+            trends['activities'] = len(columns)
+            return Response(trends)
+        except Exception as e:
+            return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
-class LeaderboardViewSet(viewsets.ModelViewSet):
+class LeaderboardViewSet(ObjectIdLookupMixin, viewsets.ModelViewSet):
     queryset = Leaderboard.objects.all()
     serializer_class = LeaderboardSerializer
     
+    def list(self, request, *args, **kwargs):
+        """List leaderboard entries as compact rows instead of model instances"""
+        return Response(serialize_rows(fetch_leaderboard_rows(get_read_db('leaderboard').leaderboard)))
+    
     @action(detail=False, methods=['get'])
     def top_users(self, request):
         limit = int(request.query_params.get('limit', 10))
-        leaderboard = Leaderboard.objects.order_by('-total_calories')[:limit]
-        serializer = self.get_serializer(leaderboard, many=True)
-        return Response(serializer.data)
+        leaderboard = fetch_leaderboard_rows(get_read_db('leaderboard').leaderboard, limit=limit)
+        return Response(serialize_rows(leaderboard))
     
     @action(detail=False, methods=['get'])
     def team_leaderboard(self, request):
         team_id = request.query_params.get('team_id')
         if team_id:
-            leaderboard = Leaderboard.objects.filter(team_id=team_id).order_by('-total_calories')
-            serializer = self.get_serializer(leaderboard, many=True)
-            return Response(serializer.data)
+            leaderboard = fetch_leaderboard_rows(get_read_db('leaderboard').leaderboard, {'team_id': team_id})
+            return Response(serialize_rows(leaderboard))
         return Response({'error': 'team_id parameter required'}, 
                        status=status.HTTP_400_BAD_REQUEST)
+    
+    @action(detail=False, methods=['get'])
+    def rank(self, request):
+        """A user's rank and percentile for a metric over all time, this month or this week"""
+        user_id = request.query_params.get('user_id')
+        if not user_id:
+            return Response({'error': 'user_id parameter required'},
+                           status=status.HTTP_400_BAD_REQUEST)
+        metric = request.query_params.get('metric', 'calories')
+        period = request.query_params.get('period', 'month')
+        if metric not in RANK_METRICS:
+            return Response({'error': f'metric must be one of {", ".join(RANK_METRICS)}'},
+                           status=status.HTTP_400_BAD_REQUEST)
+        if period not in PERIODS:
+            return Response({'error': f'period must be one of {", ".join(PERIODS)}'},
+                           status=status.HTTP_400_BAD_REQUEST)
+        try:
+            when = _parse_date_param(request.query_params.get('date'))
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        return Response(user_rank(get_read_db('leaderboard'), user_id, metric, period, when))
+    
+    @action(detail=False, methods=['get'])
+    def history(self, request):
+        """A user's daily rank and totals from the snapshot_leaderboard job, oldest first"""
+        user_id = request.query_params.get('user_id')
+        if not user_id:
+            return Response({'error': 'user_id parameter required'},
+                           status=status.HTTP_400_BAD_REQUEST)
+        try:
+            until = _parse_date_param(request.query_params.get('until'))
+            until = until.date() if until else timezone.now().date()
+            days = int(request.query_params.get('days', 365))
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if not 1 <= days <= settings.RANK_HISTORY_MAX_DAYS:
+            return Response({'error': f'days must be between 1 and {settings.RANK_HISTORY_MAX_DAYS}'},
+                           status=status.HTTP_400_BAD_REQUEST)
+        
+        since = until - timedelta(days=days - 1)
+        history = user_history(get_read_db('leaderboard'), str(user_id), since, until)
+        return Response({'user_id': str(user_id), 'since': since.isoformat(),
+                         'until': until.isoformat(), 'history': history})
 
 
-class WorkoutViewSet(viewsets.ModelViewSet):
+class WorkoutViewSet(ChangeSeqMixin, BatchLookupMixin, SearchIndexMixin, viewsets.ModelViewSet):
     queryset = Workout.objects.none()  # Disable default queryset
     serializer_class = WorkoutSerializer
+    search_kind = 'workout'
+    sync_collection = 'workouts'
+    batch_collection = 'workouts'
+    batch_read_preference = 'workouts'
+    batch_list_field = 'exercises'
+    
+    def _loaded_recommend(self):
+        """The recommend module, if this process has loaded it
+        
+        recommend imports numpy, so it is only loaded by the first
+        recommendation request. Before that there is no index to keep current.
+        """
+        return sys.modules.get('octofit_tracker.recommend')
+    
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        recommend = self._loaded_recommend()
+        if recommend:
+            recommend.workout_saved(model_to_dict(serializer.instance), self.published)
+        request_reference_refresh()
+    
+    def perform_update(self, serializer):
+        super().perform_update(serializer)
+        recommend = self._loaded_recommend()
+        if recommend:
+            recommend.workout_saved(model_to_dict(serializer.instance), self.published)
+        request_reference_refresh()
+    
+    def perform_destroy(self, instance):
+        pk = instance.pk
+        super().perform_destroy(instance)
+        recommend = self._loaded_recommend()
+        if recommend:
+            recommend.workout_removed(pk, self.published)
+        request_reference_refresh()
     
     def list(self, request):
         """Override list to fetch directly from MongoDB"""
+        batched = self.batch_list(request)
+        if batched is not None:
+            return batched
+        body = reference_body('workouts')
+        if body is not None:
+            return HttpResponse(body, content_type='application/json')
         try:
-            client = MongoClient('localhost', 27017)
-            db = client['octofit_db']
+            db = get_read_db('workouts')
             workouts_data = list(db.workouts.find())
             
             # Convert MongoDB _id to string and ensure proper field names
             for workout in workouts_data:
-                if '_id' in workout:
-                    workout['id'] = str(workout['_id'])
+                stringify_ids(workout)
                 # Ensure exercises is properly formatted
                 if 'exercises' not in workout:
                     workout['exercises'] = []
                     
-            client.close()
             return Response(workouts_data)
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
     
     def retrieve(self, request, pk=None):
         """Override retrieve to fetch directly from MongoDB"""
+        workout_id = id_filter(pk)
         try:
-            client = MongoClient('localhost', 27017)
-            db = client['octofit_db']
-            
-            # Try to convert pk to int
-            try:
-                workout_id = int(pk)
-            except ValueError:
-                workout_id = pk
-                
+            db = get_read_db('workouts')
             workout_data = db.workouts.find_one({'_id': workout_id})
-            client.close()
             
             if workout_data:
-                workout_data['id'] = str(workout_data['_id'])
+                stringify_ids(workout_data)
                 if 'exercises' not in workout_data:
                     workout_data['exercises'] = []
                 return Response(workout_data)
@@ -240,17 +684,14 @@ class WorkoutViewSet(viewsets.ModelViewSet):
                           status=status.HTTP_400_BAD_REQUEST)
         
         try:
-            client = MongoClient('localhost', 27017)
-            db = client['octofit_db']
+            db = get_read_db('workouts')
             workouts_data = list(db.workouts.find({'category': category}))
             
             for workout in workouts_data:
-                if '_id' in workout:
-                    workout['id'] = str(workout['_id'])
+                stringify_ids(workout)
                 if 'exercises' not in workout:
                     workout['exercises'] = []
                     
-            client.close()
             return Response(workouts_data)
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -263,17 +704,169 @@ class WorkoutViewSet(viewsets.ModelViewSet):
                           status=status.HTTP_400_BAD_REQUEST)
         
         try:
-            client = MongoClient('localhost', 27017)
-            db = client['octofit_db']
+            db = get_read_db('workouts')
             workouts_data = list(db.workouts.find({'difficulty_level': difficulty}))
             
             for workout in workouts_data:
-                if '_id' in workout:
-                    workout['id'] = str(workout['_id'])
+                stringify_ids(workout)
                 if 'exercises' not in workout:
                     workout['exercises'] = []
                     
-            client.close()
             return Response(workouts_data)
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    
+    @action(detail=False, methods=['get'])
+    def recommended(self, request):
+        """Rank workouts against the mix of a user's recent activities"""
+        from .recommend import RECENT_ACTIVITY_LIMIT, get_workout_index
+        
+        user_id = request.query_params.get('user_id')
+        if not user_id:
+            return Response({'error': 'user_id parameter required'}, 
+                          status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = int(request.query_params.get('limit', 10))
+        except ValueError:
+            return Response({'error': 'limit must be an integer'},
+                          status=status.HTTP_400_BAD_REQUEST)
+        
+        try:
+            db = get_read_db('workouts')
+            activities = list(
+                db.activities.find({'user_id': user_id},
+                                   {'activity_type': 1, 'duration': 1, 'calories': 1})
+                .sort('date', -1).limit(RECENT_ACTIVITY_LIMIT)
+            )
+            index = get_workout_index(db, settings.RECOMMENDATION_INDEX_MAX_AGE)
+            
+            workouts_data = []
+            for workout, score in index.recommend(activities, limit):
+                workout = stringify_ids(dict(workout, score=round(score, 4)))
+                if 'exercises' not in workout:
+                    workout['exercises'] = []
+                workouts_data.append(workout)
+            return Response(workouts_data)
+        except Exception as e:
+            return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['GET'])
+def search(request):
+    """Prefix search over users, teams and workouts for typeahead"""
+    q = request.query_params.get('q', '').strip()
+    if not q:
+        return Response({'error': 'q parameter required'},
+                        status=status.HTTP_400_BAD_REQUEST)
+    kinds = [k for k in request.query_params.get('type', '').split(',') if k]
+    unknown = set(kinds) - set(SEARCHABLE)
+    if unknown:
+        return Response({'error': f'Unknown type: {", ".join(sorted(unknown))}'},
+                        status=status.HTTP_400_BAD_REQUEST)
+    try:
+        limit = min(int(request.query_params.get('limit', 10)), 50)
+    except ValueError:
+        return Response({'error': 'limit must be an integer'},
+                        status=status.HTTP_400_BAD_REQUEST)
+    if limit < 1:
+        return Response({'error': 'limit must be at least 1'},
+                        status=status.HTTP_400_BAD_REQUEST)
+    return Response(search_index(get_db(), q, kinds or None, limit))
+
+
+@api_view(['GET'])
+def sync(request):
+    """Activities, teams and workouts changed since a sync token
+
+    Without `since` (or with an expired token) every document is sent and
+    `reset` is true, so the client should replace its copy. Clients upsert
+    `changes` by id, then drop the ids in `deleted`, then call again with the
+    returned `token` while `has_more` is true.
+    """
+    since = request.query_params.get('since')
+    seq = decode_token(since) if since else None
+    try:
+        limit = min(int(request.query_params.get('limit', settings.SYNC_PAGE_SIZE)), settings.SYNC_PAGE_SIZE)
+    except ValueError:
+        return Response({'error': 'limit must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+    if limit < 1:
+        return Response({'error': 'limit must be positive'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    result = changes_since(get_db(), seq, limit)
+    result['reset'] = seq is None
+    return Response(result)
+
+
+@api_view(['GET'])
+def dashboard(request):
+    """User, team, recent activities, top users and workouts in one response
+    
+    The sections are read concurrently, and the combined payload is cached
+    for DASHBOARD_CACHE_SECONDS, or until a team or workout is written.
+    Clients can revalidate with If-None-Match.
+    """
+    user_id = request.query_params.get('user_id')
+    if not user_id:
+        return Response({'error': 'user_id parameter required'},
+                        status=status.HTTP_400_BAD_REQUEST)
+    id_filter(user_id)  # 404 for ids no user can have
+    
+    key = cache_key(user_id)
+    cached = cache.get(key)
+    if cached is None:
+        payload = build_dashboard(user_id)
+        cached = (payload, payload_etag(payload))
+        if not payload['errors']:
+            cache.set(key, cached, settings.DASHBOARD_CACHE_SECONDS)
+    payload, etag = cached
+    
+    if request.headers.get('If-None-Match') == etag:
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        response = Response(payload)
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, max_age=settings.DASHBOARD_CACHE_SECONDS)
+    return response
+
+
+@api_view(['POST'])
+@authentication_classes([])
+def login(request):
+    """Access and refresh tokens for a username (or email) and password"""
+    username = request.data.get('username') or request.data.get('email')
+    password = request.data.get('password')
+    if not username or not password:
+        return Response({'error': 'username and password required'},
+                        status=status.HTTP_400_BAD_REQUEST)
+    db = get_db()
+    user = db.users.find_one({'$or': [{'username': username}, {'email': username}]},
+                             {'_id': 1, 'password': 1})
+    if user is None or not verify_password(db, user, password):
+        return Response({'error': 'Invalid credentials'}, status=status.HTTP_401_UNAUTHORIZED)
+    return Response(issue_tokens(user['_id']))
+
+
+@api_view(['POST'])
+@authentication_classes([])
+def refresh(request):
+    """Swap a refresh token for a new token pair; the old refresh token stops working"""
+    claims = read_refresh_token(str(request.data.get('refresh', '')))
+    if claims is None or revocations.is_revoked(claims['jti']):
+        return Response({'error': 'Invalid or expired refresh token'},
+                        status=status.HTTP_401_UNAUTHORIZED)
+    revocations.revoke(claims['jti'], settings.REFRESH_TOKEN_LIFETIME)
+    return Response(issue_tokens(claims['uid']))
+
+
+@api_view(['POST'])
+@authentication_classes([])
+def logout(request):
+    """Revoke the bearer access token and, if sent, the refresh token"""
+    auth = get_authorization_header(request).split()
+    access = read_access_token(auth[1].decode(errors='replace')) if len(auth) == 2 else None
+    if access is not None:
+        revocations.revoke(access['jti'], settings.ACCESS_TOKEN_LIFETIME)
+    refresh_claims = read_refresh_token(str(request.data.get('refresh', '')))
+    if refresh_claims is not None:
+        revocations.revoke(refresh_claims['jti'], settings.REFRESH_TOKEN_LIFETIME)
+    return Response(status=status.HTTP_204_NO_CONTENT)